@@ -1,10 +1,12 @@
 import logging
 import asyncio
 import json
+import os
 import sys
 import time
 
 from lync import LyncRemote
+from lync.tracing import LyncTracer
 
 from amqtt.client import MQTTClient, ClientException
 from amqtt.mqtt.constants import QOS_0, QOS_1, QOS_2
@@ -40,6 +42,13 @@ MQTT_TOPIC_PREFIX = "home/speakers/"
 MQTT_STATE_TOPIC = "state"
 MQTT_REFRESH_TOPIC = "+/get"
 MQTT_COMMAND_TOPIC = "+/set"
+# File the latency spans of every directive are appended to, only when set in the
+# environment since it grows without limit, summarize with: lync-trace <file>
+TRACE_FILE = os.environ.get("LYNC_TRACE_FILE")
+# Directives between latency summaries in the log
+TRACE_SUMMARY_EVERY = 100
+
+tracer = LyncTracer(TRACE_FILE)
 
 def state_to_json():
     return json.dumps(status)
@@ -55,14 +64,15 @@ async def update_state(client, zone, state):
 
 def lync_update(lync, zone):
     # Try to connect to the lync
-    tries = 3
-    while not lync.is_connected() and tries > 0:
-        lync.connect()
-        if lync.is_connected():
-            lync.update(zone)
-        else:
-            time.sleep(3)
-            tries -= 1
+    with tracer.span('connect'):
+        tries = 3
+        while not lync.is_connected() and tries > 0:
+            lync.connect()
+            if lync.is_connected():
+                lync.update(zone)
+            else:
+                time.sleep(3)
+                tries -= 1
 
 
 def set_power(lync, zone, state):
@@ -124,6 +134,8 @@ def set_mute(lync, zone, state):
 async def mqtt_coro():
     # Create websocket lync connection
     lync = LyncRemote(DEFAULT_IP)
+    lync.tracer = tracer
+    directives = 0
     # Connect to the Lync
     lync.connect()
     if not lync.is_connected():
@@ -152,37 +164,51 @@ async def mqtt_coro():
         try:
             # Get next command packet
             message = await C.deliver_message()
+            # amqtt keeps no arrival time, so the time a message waited in the
+            # client before deliver_message returned is not part of the trace
+            received = time.monotonic()
             packet = message.publish_packet
             data = json.loads(packet.payload.data.decode())
+            parsed = time.monotonic()
             _LOGGER.info("%s => %s" % (packet.variable_header.topic_name, data))
+            # one trace per directive
+            traces = [tracer.new_id() for item in data]
             # Take action
-            for item in data:
-                if not 'zone' in item:
-                    _LOGGER.warning("No name in item")
-                else:
-                    # Look up the name as a speaker identifier
-                    _LOGGER.debug("Found zone: %s" % item['zone'])
-                    # Check for command types directives 
-                    if not 'directive' in item:
-                        _LOGGER.warning("No directive in the message")
+            for (item, trace_id) in zip(data, traces):
+                with tracer.trace(trace_id):
+                    tracer.record(trace_id, 'parse', received, parsed)
+                    if not 'zone' in item:
+                        _LOGGER.warning("No name in item")
                     else:
-                        # Parse directive types
-                        if item['directive'] == "TurnOn":
-                            set_power(lync, item['zone'], item['powerState'])
-                        if item['directive'] == "TurnOff":
-                            set_power(lync, item['zone'], item['powerState'])
-                        if item['directive'] == "SetVolume":
-                            set_volume(lync, item['zone'], item['volume'])
-                        if item['directive'] == "SetMute":
-                            set_mute(lync, item['zone'], item['muted'])
-                        if item['directive'] == "SelectInput":
-                            _LOGGER.info("Input select not implemented")
+                        # Look up the name as a speaker identifier
+                        _LOGGER.debug("Found zone: %s" % item['zone'])
+                        # Check for command types directives 
+                        if not 'directive' in item:
+                            _LOGGER.warning("No directive in the message")
+                        else:
+                            # Parse directive types
+                            if item['directive'] == "TurnOn":
+                                set_power(lync, item['zone'], item['powerState'])
+                            if item['directive'] == "TurnOff":
+                                set_power(lync, item['zone'], item['powerState'])
+                            if item['directive'] == "SetVolume":
+                                set_volume(lync, item['zone'], item['volume'])
+                            if item['directive'] == "SetMute":
+                                set_mute(lync, item['zone'], item['muted'])
+                            if item['directive'] == "SelectInput":
+                                _LOGGER.info("Input select not implemented")
 
             # Wait for update to apply
-            time.sleep(1)
+            settle = time.monotonic()
+            await asyncio.sleep(1)
+            for trace_id in traces:
+                tracer.record(trace_id, 'settle', settle, time.monotonic())
             # Refetch the state and end it back
-            for item in data:
+            for (item, trace_id) in zip(data, traces):
                 if 'zone' in item:
+                    # don't publish zones which are not installed
+                    if not lync.zone_exists(lync.zone_to_num(item['zone'])):
+                        continue
                     state = lync.get_zone_info(item['zone'])
                     _LOGGER.debug("Update state %s" % state)
                     #update_state(C, item['zone'], state)
@@ -190,12 +216,17 @@ async def mqtt_coro():
                     pkt = bytearray()
                     pkt.extend(json_state.encode())
                     topic = MQTT_TOPIC_PREFIX + item['zone'] + "/" + MQTT_STATE_TOPIC
-                    await C.publish(topic, pkt, qos=QOS_2)
+                    with tracer.span('publish', trace_id, zone=item['zone']):
+                        await C.publish(topic, pkt, qos=QOS_2)
                     _LOGGER.info("Update Sent to Topic: %s", topic)
+            directives += len(data)
+            if directives >= TRACE_SUMMARY_EVERY:
+                directives = 0
+                tracer.log_summary()
 
         except ClientException as ce:
             _LOGGER.error("Client exception: %s" % ce)
-            time.sleep(TIMEOUT_DELAY)
+            await asyncio.sleep(TIMEOUT_DELAY)
 
 
 if __name__ == '__main__':
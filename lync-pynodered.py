@@ -1,8 +1,9 @@
 """ Used for adhoc testing.  in time can create formal tests. """
 
 import logging
-import time
-from lync import LyncRemote
+import concurrent.futures
+import queue
+from lync import LyncRemote, LyncWorker
 
 from pynodered import node_red, NodeProperty
 
@@ -15,6 +16,41 @@ DEFAULT_PORT = '8000'
 DEFAULT_IP = 'HTD-GW-SL1'
 
 server = LyncRemote(DEFAULT_IP)
+# Commands run on one long lived worker which keeps the connection warm
+worker = LyncWorker(server)
+
+def submit(msg, method, *args, confirm=None):
+    """ Queue a command and optionally wait for it when msg['wait'] gives a timeout
+        The queue depth and command latency are reported in msg['lync'].
+        The payload is 'busy' when the worker queue is full.
+    """
+    timeout = msg.get('wait')
+    try:
+        if timeout is None:
+            future = worker.submit(method, *args)
+        else:
+            future = worker.submit(method, *args, confirm=confirm, timeout=timeout)
+    except queue.Full:
+        _LOGGER.warning("Lync worker queue is full, dropping %s", method)
+        msg['payload'] = 'busy'
+        msg['lync'] = { 'queue_depth' : worker.queue_depth() }
+        return msg
+    if timeout is None:
+        msg['lync'] = { 'queue_depth' : worker.queue_depth() }
+        return msg
+    try:
+        result = future.result(timeout)
+        msg['payload'] = 'confirmed' if result or confirm is None else 'timeout'
+    except concurrent.futures.TimeoutError:
+        msg['payload'] = 'timeout'
+    except ConnectionError:
+        msg['payload'] = 'not connected'
+    except Exception as e:
+        _LOGGER.error("Lync command %s failed: %s", method, e)
+        msg['payload'] = 'error'
+    msg['lync'] = { 'queue_depth' : worker.queue_depth(),
+                    'latency' : future.latency }
+    return msg
 
 @node_red(category="pyfuncs",
           properties=dict(address=NodeProperty("IP Address", value=DEFAULT_IP)))
@@ -41,31 +77,14 @@ def set_power(node, msg):
         _LOGGER.error("No topic name in message")
         return None
     payload = str(msg['payload'])
-    if payload is '1':
+    if payload == '1':
         state = 'on'
-    elif payload is '0':
+    elif payload == '0':
         state = 'off'
     else:
         state = payload
-    # Try to connect to the server
-    tries = 3
-    while not server.is_connected() and tries > 0:
-        server.connect(node.address.value)
-        if server.is_connected():
-            server.update(zone)
-        else:
-            time.sleep(3)
-            tries -= 1
-
-    if not server.is_connected():
-        _LOGGER.error("Can't connected to server at %s", node.address.value)
-        msg['payload'] = 'not connected'
-        return msg
-    # Set the power state
-    server.set_power(zone, state)
-    # Shutdown the connection
-    server.close(delay=30)
-    return msg
+    worker.connect_args = (node.address.value,)
+    return submit(msg, 'set_power', zone, state, confirm=(zone, { 'power' : state }))
 
 @node_red(category="pyfuncs",
           properties=dict(address=NodeProperty("IP Address", value=DEFAULT_IP)))
@@ -80,24 +99,6 @@ def set_volume(node, msg):
     if vol < 0 or vol > 100:
         _LOGGER.error("Invalid message payload %s", str(vol))
         return None
-    # Try to connect to the server
-    tries = 3
-    while not server.is_connected() and tries > 0:
-        server.connect(node.address.value)
-        if server.is_connected():
-            server.update(zone)
-        else:
-            time.sleep(3)
-            tries -= 1
-
-    if not server.is_connected():
-        _LOGGER.error("Can't connected to server at %s", node.address.value)
-        msg['payload'] = 'not connected'
-        return msg
-
-    # Set the volume
-    server.set_volume(zone, vol)
-    # Shutdown the connection
-    server.close(delay=30)
-    return msg
-    
+    worker.connect_args = (node.address.value,)
+    return submit(msg, 'set_volume', zone, vol,
+                  confirm=(zone, { 'volume' : server.volume_to_db(vol) }))
@@ -6,4 +6,13 @@ __author__ = """Dustin McIntire"""
 __email__ = 'dustin.mcintire@gmail.com'
 
 from .lync import *
+from .capture import *
+from .trace import *
+from .scheduler import *
+from .ramp import *
+from .flow import *
+from .state import *
+from .worker import *
+from .events import *
+from .simulator import *
 
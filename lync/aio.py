@@ -0,0 +1,144 @@
+"""
+asyncio client for the HTD Lync.
+
+LyncAsyncClient runs the LyncProtocol engine on an asyncio stream, the Unix
+socket of a LyncProxy or a TCP serial bridge, without any threads.  Commands
+are coroutines which return once the frames are written, the state is
+waited for with wait_state and changes are read with 'async for' over
+events().
+"""
+
+import asyncio
+import logging
+
+from .lync import LyncProtocol, LYNC_BATCH_FRAMES, LYNC_BATCH_PACING
+from .proxy import LYNC_PROXY_SOCKET
+
+_LOGGER = logging.getLogger(__name__)
+
+class LyncAsyncClient(LyncProtocol):
+    """ class to operate the HTD lync from an asyncio event loop
+        :param path: Unix socket of a LyncProxy
+        :param host: host of a TCP serial bridge, used instead of path when given
+        :param port: port of the TCP serial bridge
+    """
+    def __init__(self, path=LYNC_PROXY_SOCKET, host=None, port=None):
+        self._path = path
+        self._host = host
+        self._port = port
+        self._reader = None
+        self._writer = None
+        self._task = None
+        # set and replaced whenever a new snapshot is published
+        self._changed = None
+        super().__init__()
+
+    async def connect(self):
+        """ Open the stream and start processing received data """
+        if self.is_connected():
+            return True
+        try:
+            if self._host is not None:
+                (reader, writer) = await asyncio.open_connection(self._host, self._port)
+            else:
+                (reader, writer) = await asyncio.open_unix_connection(self._path)
+        except OSError as e:
+            _LOGGER.error("Error trying to connect to Lync: %s", e)
+            return False
+        self._reader = reader
+        self._writer = writer
+        self._changed = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self.__read_forever(reader))
+        return True
+
+    def is_connected(self):
+        return self._writer is not None
+
+    async def close(self):
+        if self._writer is None:
+            return
+        writer = self._writer
+        self._writer = None
+        self._task.cancel()
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    async def __read_forever(self, reader):
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            self.process_data(data)
+        _LOGGER.info("Lync connection closed")
+        self._writer = None
+
+    def _state_changed(self):
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = asyncio.Event()
+
+    async def __wait_for(self, predicate, timeout):
+        async def wait():
+            while not predicate():
+                await self._changed.wait()
+        try:
+            await asyncio.wait_for(wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def send(self, data):
+        """ write raw frame data, None is ignored """
+        if data is None:
+            return
+        if self._writer is None:
+            raise ConnectionError("Lync is not connected")
+        self._writer.write(data)
+        await self._writer.drain()
+
+    async def wait_state(self, zone, expected, timeout=None):
+        """ Wait for the cached state of a zone to match
+            :param zone: The zone as a 1 based number or name.
+            :param expected: dict of zone info keys to the values to wait for
+            :return True if the state matched before the timeout
+        """
+        zn = self.zone_to_num(zone)
+        def matches():
+            info = self._snapshot.zones[zn]
+            return all(info.get(key) == value for (key, value) in expected.items())
+        return await self.__wait_for(matches, timeout)
+
+    async def refresh_zone(self, zone=0):
+        await self.send(self.create_send_message('query all zones', self.zone_to_name(zone)))
+
+    async def set_power(self, zone, power):
+        await self.send(super().set_power(zone,power))
+
+    async def set_volume(self, zone, volume):
+        await self.send(super().set_volume(zone,volume))
+
+    async def set_source(self, zone, source):
+        await self.send(super().set_source(zone,source))
+
+    async def all_on_off(self, power):
+        await self.send(super().all_on_off(power))
+
+    async def set_mute(self, zone, mute):
+        await self.send(super().set_mute(zone,mute))
+
+    async def set_scene(self, scene, timeout=None):
+        """ Apply a scene in paced bursts of frames
+        :param timeout: seconds to wait for the controller to confirm the scene or None
+        :param return True if the scene was sent, or confirmed when a timeout is given
+        """
+        frames = super().set_scene(scene)
+        for i in range(0, len(frames), LYNC_BATCH_FRAMES):
+            if i:
+                await asyncio.sleep(LYNC_BATCH_PACING)
+            await self.send(b''.join(frames[i:i + LYNC_BATCH_FRAMES]))
+        if timeout is None:
+            return True
+        return await self.__wait_for(lambda: not self._scene_pending, timeout)
@@ -0,0 +1,173 @@
+"""
+Benchmark of the Lync protocol engine.
+
+Every transport, the asyncio client, the simulator and capture replay run the
+same LyncProtocol, so it is measured once here:
+
+    python -m lync.benchmark [--frames N] [--json]
+
+decode      state frames fed in one piece, in gateway sized chunks and in
+            small serial reads
+repeats     a stream where every frame after the first of its zone repeats
+            it, as when an idle controller is polled, with the fraction of
+            frames skipped as repeats
+encode      command frames built by the set_* methods
+simulator   command to reply round trips through LyncSimulator
+export      snapshots of a 12 zone controller exported after each volume
+            change, as binary deltas by encode_state and as json
+latency     99th percentile milliseconds writes of each priority class
+            waited in the send queue of a LyncSimulatorClient during a flood
+            of background refreshes with a user command every tenth write,
+            and of the user commands when all writes share one class (fifo)
+
+The other results are rates in frames or snapshots per second.
+"""
+
+import argparse
+import json
+import logging
+import time
+
+from .lync import LyncProtocol, LYNC_PRIORITIES
+from .simulator import LyncSimulator, LyncSimulatorClient
+from .state import encode_state
+
+# Frames in the benchmark stream
+LYNC_BENCH_FRAMES = 20000
+# Chunk sizes fed to the decoder, None for the whole stream at once
+LYNC_BENCH_CHUNKS = (None, 4096, 64)
+# Writes in the priority benchmark and the simulated reply latency in seconds
+LYNC_BENCH_WRITES = 400
+LYNC_BENCH_LATENCY = 0.002
+
+def status_stream(frames=LYNC_BENCH_FRAMES):
+    """ return a stream of 'zone status' frames where no frame repeats the last of its zone """
+    proto = LyncProtocol()
+    info = dict(proto.zone_info[0], source=1)
+    stream = bytearray()
+    for i in range(frames):
+        info['source'] = 1 + i % 6
+        info['volume'] = -(i % 61)
+        stream.extend(proto.status_frame(1 + i % 12, info))
+    return bytes(stream)
+
+def repeat_stream(frames=LYNC_BENCH_FRAMES):
+    """ return a stream of 'zone status' frames where every frame after the first of
+        its zone repeats the last one of that zone
+    """
+    first = status_stream(12)
+    size = len(first) // 12
+    return (first * (frames // 12 + 1))[:frames * size]
+
+def bench_decode(stream, frames, chunk=None, proto=None):
+    """ return the rate a LyncProtocol decodes a stream fed in chunks of chunk bytes """
+    proto = proto if proto is not None else LyncProtocol()
+    chunk = chunk or len(stream)
+    start = time.perf_counter()
+    for i in range(0, len(stream), chunk):
+        proto.process_data(stream[i:i + chunk])
+    return frames / (time.perf_counter() - start)
+
+def bench_encode(frames=LYNC_BENCH_FRAMES):
+    """ return the rate of command frames built for named zones """
+    proto = LyncProtocol()
+    proto.zone_lookup['office'] = '1'
+    proto.zone_info[1]['name'] = 'office'
+    start = time.perf_counter()
+    for i in range(frames // 2):
+        proto.set_power('office', 'on' if i & 1 else 'off')
+        proto.set_volume('office', i % 101)
+    return frames / (time.perf_counter() - start)
+
+def bench_simulator(frames=LYNC_BENCH_FRAMES):
+    """ return the rate of commands answered by a LyncSimulator and decoded """
+    sim = LyncSimulator()
+    proto = LyncProtocol()
+    proto.process_data(sim.receive_data(proto.build_frame('query all zones', 0)))
+    commands = [proto.set_volume(1 + i % 6, i % 101) for i in range(frames)]
+    start = time.perf_counter()
+    for command in commands:
+        proto.process_data(sim.receive_data(command))
+    return frames / (time.perf_counter() - start)
+
+def bench_export(frames=LYNC_BENCH_FRAMES):
+    """ return the rates of snapshots exported as binary deltas and as json """
+    sim = LyncSimulator(zones=12)
+    proto = LyncProtocol()
+    proto.process_data(sim.receive_data(proto.build_frame('query all zones', 0)))
+    snapshots = []
+    for i in range(frames):
+        proto.process_data(sim.receive_data(proto.set_volume(1 + i % 12, i % 101)))
+        snapshots.append(proto.snapshot())
+    start = time.perf_counter()
+    base = None
+    for snap in snapshots:
+        encode_state(snap, base)
+        base = snap
+    binary = frames / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for snap in snapshots:
+        json.dumps({ 'zones' : snap.zones, 'sources' : snap.sources, 'mp3' : snap.mp3 })
+    return (binary, frames / (time.perf_counter() - start))
+
+def bench_priority(writes=LYNC_BENCH_WRITES, fifo=False):
+    """ return the p99 milliseconds the writes of each class waited behind a refresh flood
+        :param fifo: write the refreshes as interactive too, as one queue would
+    """
+    client = LyncSimulatorClient(latency=LYNC_BENCH_LATENCY)
+    client.connect()
+    client.init()
+    zones = client.active_zones()
+    for i in range(writes):
+        zone = zones[i % len(zones)]
+        if i % 10 == 0:
+            client.set_mute(zone, 'on' if i & 1 else 'off')
+        else:
+            client.send_command('query all zones', client.zone_to_name(zone),
+                                priority='interactive' if fifo else None)
+    while client.tx_pending():
+        time.sleep(0.01)
+    latency = client.tx_latency()
+    client.close()
+    return { p : latency[p]['p99'] * 1000 for p in LYNC_PRIORITIES if latency[p]['count'] }
+
+def run(frames=LYNC_BENCH_FRAMES):
+    """ run all benchmarks and return a dict of name to frames per second """
+    stream = status_stream(frames)
+    results = {}
+    for chunk in LYNC_BENCH_CHUNKS:
+        results['decode/%s' % (chunk or 'all')] = bench_decode(stream, frames, chunk)
+    proto = LyncProtocol()
+    results['repeats'] = bench_decode(repeat_stream(frames), frames, 4096, proto)
+    results['repeats/hit_rate'] = proto.dedup_hit_rate()
+    results['encode'] = bench_encode(frames)
+    results['simulator'] = bench_simulator(frames)
+    (results['export/binary'], results['export/json']) = bench_export(frames)
+    for (priority, p99) in bench_priority().items():
+        results['latency/%s' % priority] = p99
+    results['latency/fifo'] = bench_priority(fifo=True)['interactive']
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Lync protocol engine")
+    parser.add_argument('--frames', type=int, default=LYNC_BENCH_FRAMES,
+                        help="frames per benchmark")
+    parser.add_argument('--json', action='store_true', help="print the results as json")
+    args = parser.parse_args()
+    # the decoder logs every frame it does not process at info level
+    logging.basicConfig(level=logging.WARNING)
+    results = run(args.frames)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for (name, value) in results.items():
+            if name.startswith('latency/'):
+                print("%-20s %10.1f ms p99" % (name, value))
+            elif name.endswith('/hit_rate'):
+                print("%-20s %10.1f %%" % (name, 100 * value))
+            else:
+                print("%-20s %10.0f /s" % (name, value))
+    return 0
+
+if __name__ == '__main__':
+    main()
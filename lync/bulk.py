@@ -0,0 +1,162 @@
+"""
+Vectorized bulk decoder for large buffers of Lync RX data such as capture files.
+
+Requires numpy, which is an optional dependency.  The frames found are the same
+frames the streaming decoder in LyncProtocol.process_command finds when the whole
+buffer is processed in one piece, including its resync behaviour on invalid
+command ids.  'zone status' frames are extracted into columnar arrays.
+"""
+
+import bisect
+import logging
+
+from .lync import LYNC_HEADER, LYNC_RX_CMDS, LYNC_MAX_ZONES
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_LOGGER = logging.getLogger(__name__)
+
+# id of the 'zone status' frame
+LYNC_ZONE_STATUS = 0x05
+
+class LyncBulkFrames:
+    """ columnar result of a bulk decode
+
+        offset, zone, cmd and checksum_ok hold one entry per decoded frame.
+        resyncs is counted like the 'resyncs' stat of LyncProtocol.
+        status holds one array per 'zone status' field in frame order.
+    """
+    def __init__(self, offset, zone, cmd, checksum_ok, resyncs, status):
+        self.offset = offset
+        self.zone = zone
+        self.cmd = cmd
+        self.checksum_ok = checksum_ok
+        self.resyncs = resyncs
+        self.status = status
+
+    def __len__(self):
+        return len(self.offset)
+
+    def checksum_errors(self):
+        """ return the number of frames with a bad checksum """
+        return int(len(self.checksum_ok) - np.count_nonzero(self.checksum_ok))
+
+    def apply(self, lync):
+        """ Update the zone status fields of a LyncProtocol with the last status of each zone """
+        status = self.status
+        zones = status['zone']
+        if not len(zones):
+            return
+        # index of the last status frame for every zone
+        last = len(zones) - 1 - np.unique(zones[::-1], return_index=True)[1]
+        for i in last.tolist():
+            zone = int(zones[i])
+            if zone >= LYNC_MAX_ZONES:
+                continue
+            info = lync.zone_info[zone]
+            info['power'] = 'on' if status['power'][i] else 'off'
+            info['mute'] = 'on' if status['mute'][i] else 'off'
+            info['dnd'] = 'on' if status['dnd'][i] else 'off'
+            for key in ('source', 'volume', 'treble', 'bass', 'balance'):
+                info[key] = int(status[key][i])
+        # the state no longer matches the last frames seen by the streaming decoder
+        lync._fingerprints.clear()
+        lync._publish()
+
+def bulk_decode(buf):
+    """ Decode every frame in a buffer
+        :param buf: bytes, bytearray, memoryview or mmap of RX data
+        :return a LyncBulkFrames
+    """
+    if np is None:
+        raise ImportError("numpy is required for the Lync bulk decoder")
+    a = np.frombuffer(buf, dtype=np.uint8)
+    n = len(a)
+    # per command id tables, length 0 marks invalid or undefined commands
+    lengths = np.zeros(256, dtype=np.int64)
+    for (cmd_id, cmd_info) in LYNC_RX_CMDS.items():
+        if cmd_info[0] != 'undefined':
+            lengths[cmd_id] = cmd_info[1]
+
+    # every header position is a candidate frame start
+    cand = np.flatnonzero((a[:-1] == LYNC_HEADER[0]) & (a[1:] == LYNC_HEADER[1]))
+    has_cmd = cand + 4 <= n
+    cmd = np.zeros(len(cand), dtype=np.int64)
+    cmd[has_cmd] = a[cand[has_cmd] + 3]
+    length = lengths[cmd]
+    valid = has_cmd & (length > 0)
+    # offset of the checksum byte
+    csum_idx = cand + 4 + length
+    complete = valid & (csum_idx < n)
+    # decoding stops at the first frame which needs more data
+    stop = ~has_cmd | (valid & ~complete)
+    nxt = np.where(valid, csum_idx + 1, cand + len(LYNC_HEADER))
+    nxt_idx = np.searchsorted(cand, nxt)
+
+    # follow the chain of frames the streaming decoder visits.  Runs of
+    # candidates which lead straight to the next candidate are taken whole so
+    # only resync points and headers inside payloads are walked one by one.
+    ncand = len(cand)
+    breaks = np.flatnonzero((nxt_idx != np.arange(1, ncand + 1)) | stop).tolist()
+    # the remaining buffer must hold at least a header and 4 bytes
+    limit = n - len(LYNC_HEADER) - 4
+    runs = []
+    pos = 0
+    i = 0
+    while i < ncand and pos <= limit and not stop[i]:
+        k = breaks[bisect.bisect_left(breaks, i)] if breaks and breaks[-1] >= i else ncand
+        if k == i:
+            runs.append(np.arange(i, i + 1))
+            pos = int(nxt[i])
+            i = int(nxt_idx[i])
+            continue
+        # candidates i+1..k are visited while the position before them is in range
+        count = int(np.searchsorted(nxt[i:k], limit, side='right'))
+        if count < k - i:
+            runs.append(np.arange(i, i + count + 1))
+            pos = int(nxt[i + count])
+            break
+        runs.append(np.arange(i, k))
+        pos = int(nxt[k - 1])
+        i = k
+    accepted = np.concatenate(runs) if runs else np.zeros(0, dtype=np.int64)
+    # a resync is counted for every invalid command and every run of bytes
+    # skipped to reach a header, also the header of a frame which needs more data
+    searched = np.concatenate(([0], nxt[accepted[:-1]]))
+    resyncs = int(np.count_nonzero(~valid[accepted]) + np.count_nonzero(cand[accepted] != searched))
+    if i < ncand and pos <= limit and stop[i] and cand[i] != pos:
+        resyncs += 1
+    accepted = accepted[valid[accepted]]
+
+    offset = cand[accepted]
+    frame_cmd = cmd[accepted]
+    csum = csum_idx[accepted]
+    if len(offset):
+        # frames never overlap so the sums of [offset, csum) are every other reduction
+        bounds = np.column_stack((offset, csum)).ravel()
+        sums = np.add.reduceat(a, bounds, dtype=np.int64)[::2]
+        checksum_ok = (sums & 0xff) == a[csum]
+    else:
+        checksum_ok = np.zeros(0, dtype=bool)
+
+    # columnar zone status fields
+    so = offset[frame_cmd == LYNC_ZONE_STATUS] + 4
+    flags = a[so]
+    info = LYNC_RX_CMDS[LYNC_ZONE_STATUS][2]
+    status = {
+        'offset' : so - 4,
+        'zone' : a[so - 2],
+        'power' : (flags & info['power']) != 0,
+        'mute' : (flags & info['mute']) != 0,
+        'dnd' : (flags & info['dnd']) != 0,
+        'source' : a[so + 4],
+        'volume' : a[so + 5].view(np.int8),
+        'treble' : a[so + 6].view(np.int8),
+        'bass' : a[so + 7].view(np.int8),
+        'balance' : a[so + 8].view(np.int8),
+        }
+    return LyncBulkFrames(offset, a[offset + 2], frame_cmd.astype(np.uint8),
+                          checksum_ok, resyncs, status)
@@ -0,0 +1,135 @@
+"""
+Binary wire capture and replay for the HTD Lync serial protocol.
+
+A capture file starts with the 8 byte LYNC_CAPTURE_MAGIC followed by one record
+per raw chunk read from or written to the Lync:
+
+    timestamp   double, seconds from time.monotonic()
+    direction   byte, LYNC_CAPTURE_RX or LYNC_CAPTURE_TX
+    length      unsigned 32 bit length of the data
+    data        the raw bytes
+
+All values are little endian.  Replay memory maps the file so long captures can
+be processed without reading them into memory.
+"""
+
+import logging
+import mmap
+import struct
+import threading
+import time
+
+__all__ = ['LyncCapture', 'LyncReplay', 'LYNC_CAPTURE_MAGIC', 'LYNC_CAPTURE_RX',
+           'LYNC_CAPTURE_TX', 'LYNC_CAPTURE_RECORD']
+
+# capture file identifier and format version
+LYNC_CAPTURE_MAGIC = b'LYNCCAP\x01'
+# record directions
+LYNC_CAPTURE_RX = 0
+LYNC_CAPTURE_TX = 1
+# record header: timestamp, direction, length
+LYNC_CAPTURE_RECORD = struct.Struct('<dBI')
+
+_LOGGER = logging.getLogger(__name__)
+
+class LyncCapture:
+    """ writes raw wire data to a capture file """
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()   # reader and writer threads both record
+        self._file = open(path, 'wb')
+        self._file.write(LYNC_CAPTURE_MAGIC)
+
+    def record(self, direction, data):
+        """ Append one chunk of raw data
+            :param direction: LYNC_CAPTURE_RX or LYNC_CAPTURE_TX
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            # stamped under the lock so the records of both threads stay in time order
+            self._file.write(LYNC_CAPTURE_RECORD.pack(time.monotonic(), direction, len(data)))
+            self._file.write(data)
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+        _LOGGER.info("Closed capture %s", self._path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+class LyncReplay:
+    """ reads a capture file through a memory map """
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[0:len(LYNC_CAPTURE_MAGIC)] != LYNC_CAPTURE_MAGIC:
+            self.close()
+            raise ValueError("Not a Lync capture file: %s" % path)
+
+    def __iter__(self):
+        """ yield (timestamp, direction, data) for every record """
+        mm = self._map
+        end = len(mm)
+        offset = len(LYNC_CAPTURE_MAGIC)
+        while offset + LYNC_CAPTURE_RECORD.size <= end:
+            (ts, direction, length) = LYNC_CAPTURE_RECORD.unpack_from(mm, offset)
+            offset += LYNC_CAPTURE_RECORD.size
+            if offset + length > end:
+                _LOGGER.warning("Truncated record at end of capture %s", self._path)
+                return
+            yield (ts, direction, mm[offset:offset + length])
+            offset += length
+
+    def data(self, direction=LYNC_CAPTURE_RX):
+        """ return all the data for one direction as a single bytes buffer """
+        return b''.join(chunk for (ts, d, chunk) in self if d == direction)
+
+    def replay(self, lync, realtime=False, speed=1.0, tx=None):
+        """ Feed the received data through a Lync decoder
+            :param lync: LyncProtocol instance to process the data
+            :param realtime: sleep between chunks to reproduce the original timing
+            :param speed: time scale when replaying in real time
+            :param tx: optional function called with the data of every TX record
+            :return the number of RX chunks processed
+        """
+        count = 0
+        start = None
+        for (ts, direction, data) in self:
+            if direction != LYNC_CAPTURE_RX and tx is None:
+                continue
+            if realtime:
+                now = time.monotonic()
+                if start is None:
+                    start = (ts, now)
+                delay = (ts - start[0]) / speed - (now - start[1])
+                if delay > 0:
+                    time.sleep(delay)
+            if direction != LYNC_CAPTURE_RX:
+                tx(data)
+                continue
+            lync.process_data(data)
+            count += 1
+        return count
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
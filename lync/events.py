@@ -0,0 +1,141 @@
+"""
+Event stream of decoded Lync frames and state changes.
+
+Each subscriber gets its own bounded queue so a slow consumer can neither stall
+the reader thread nor grow memory without limit.  What happens when the queue
+is full is chosen per subscriber:
+
+    'drop-oldest'   the oldest queued event is discarded
+    'coalesce'      events for the same zone are merged, state changes are
+                    combined and only the latest frame of each kind is kept
+    'block'         the reader waits for the consumer, up to block_timeout
+                    seconds, before dropping the oldest event.  LyncBase
+                    queues the events after releasing its decoder lock, so
+                    only the reader thread waits, not the state cache.
+
+A subscription is read with get() from threads, by iterating it, or with
+'async for' from an asyncio event loop.
+"""
+
+import asyncio
+import collections
+import logging
+import threading
+import time
+
+__all__ = ['LyncSubscription', 'LyncFrameEvent', 'LyncStateEvent', 'LYNC_EVENT_QUEUE',
+           'LYNC_EVENT_BLOCK_TIMEOUT', 'LYNC_EVENT_POLICIES']
+
+# Default number of events queued per subscriber
+LYNC_EVENT_QUEUE = 256
+# Seconds the reader waits for a blocking subscriber
+LYNC_EVENT_BLOCK_TIMEOUT = 1
+LYNC_EVENT_POLICIES = ('drop-oldest', 'coalesce', 'block')
+
+# A decoded frame, data is the raw payload
+LyncFrameEvent = collections.namedtuple('LyncFrameEvent', ['zone', 'cmd_id', 'cmd', 'data'])
+# Zone info keys which changed, zone is None for the mp3 status
+LyncStateEvent = collections.namedtuple('LyncStateEvent', ['version', 'zone', 'changes'])
+
+_LOGGER = logging.getLogger(__name__)
+
+class LyncSubscription:
+    """ bounded queue of events for one consumer """
+    def __init__(self, source, maxsize=LYNC_EVENT_QUEUE, policy='drop-oldest',
+                 block_timeout=LYNC_EVENT_BLOCK_TIMEOUT):
+        if policy not in LYNC_EVENT_POLICIES:
+            raise ValueError("Unknown event overflow policy %s" % policy)
+        self._source = source
+        self._maxsize = maxsize
+        self._policy = policy
+        self._block_timeout = block_timeout
+        # coalesced events are keyed so a new event can replace a queued one
+        self._events = collections.OrderedDict()
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._loop = None
+        self._waiter = None
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._events)
+
+    def put(self, event):
+        """ Queue an event, called by the decoder """
+        with self._cond:
+            if self._policy == 'coalesce':
+                key = self.__coalesce_key(event)
+                queued = self._events.get(key)
+                if queued is not None:
+                    if isinstance(event, LyncStateEvent):
+                        changes = dict(queued.changes)
+                        changes.update(event.changes)
+                        event = event._replace(changes=changes)
+                    self._events[key] = event
+                    return
+            else:
+                key = self._seq
+                self._seq += 1
+            if len(self._events) >= self._maxsize and self._policy == 'block':
+                deadline = time.monotonic() + self._block_timeout
+                while len(self._events) >= self._maxsize:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        break
+            if len(self._events) >= self._maxsize:
+                self._events.popitem(last=False)
+                self.dropped += 1
+            self._events[key] = event
+            self._cond.notify_all()
+            if self._waiter is not None:
+                self._loop.call_soon_threadsafe(self.__wake, self._waiter)
+                self._waiter = None
+
+    def get(self, timeout=None):
+        """ return the next event or None on timeout """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._events, timeout):
+                return None
+            event = self._events.popitem(last=False)[1]
+            self._cond.notify_all()
+            return event
+
+    def close(self):
+        """ Stop receiving events """
+        self._source.unsubscribe(self)
+
+    def __coalesce_key(self, event):
+        if isinstance(event, LyncStateEvent):
+            return ('state', event.zone)
+        return ('frame', event.zone, event.cmd_id)
+
+    @staticmethod
+    def __wake(waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def __iter__(self):
+        try:
+            while True:
+                yield self.get()
+        finally:
+            self.close()
+
+    def __aiter__(self):
+        self._loop = asyncio.get_running_loop()
+        return self
+
+    async def __anext__(self):
+        while True:
+            with self._cond:
+                if self._events:
+                    event = self._events.popitem(last=False)[1]
+                    self._cond.notify_all()
+                    return event
+                waiter = self._loop.create_future()
+                self._waiter = waiter
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                self.close()
+                raise
@@ -0,0 +1,133 @@
+"""
+Adaptive flow control of the commands written to a Lync link.
+
+The GW-SL1 websocket bridge and the 38400 baud UART both lose commands when
+they are written faster than the controller answers them.  LyncFlowControl
+keeps the commands in flight, the zones waiting for the status reply to a
+command, within a window which adapts AIMD style:
+
+    a prompt reply                      window += LYNC_FLOW_INCREASE / window
+    a delayed reply                     window *= LYNC_FLOW_DECREASE
+    no reply before the timeout         window *= LYNC_FLOW_DECREASE
+    new checksum errors or resyncs      window *= LYNC_FLOW_DECREASE
+
+so the window grows by about one command every round trip while the link
+keeps up, and is cut at most once a round trip when it doesn't.  A reply is
+delayed when its round trip exceeds the shortest recent one by the factor
+LYNC_FLOW_DELAY_FACTOR, which happens both when the gateway queues commands
+and when a command was lost, since the controller's status reply can't be
+told apart from the reply to a later command for the same zone.  The reply
+timeout follows the smoothed round trip time and its deviation the way TCP
+computes its retransmission timeout.
+"""
+
+import collections
+
+__all__ = ['LyncFlowControl', 'LYNC_FLOW_WINDOW', 'LYNC_FLOW_MIN_WINDOW',
+           'LYNC_FLOW_MAX_WINDOW', 'LYNC_FLOW_INCREASE', 'LYNC_FLOW_DECREASE',
+           'LYNC_FLOW_TIMEOUT', 'LYNC_FLOW_MIN_TIMEOUT', 'LYNC_FLOW_MAX_TIMEOUT',
+           'LYNC_FLOW_DELAY_FACTOR', 'LYNC_FLOW_DELAY_MIN', 'LYNC_FLOW_BASE_SAMPLES']
+
+# Commands in flight allowed before any reply was measured
+LYNC_FLOW_WINDOW = 4
+# Limits of the window
+LYNC_FLOW_MIN_WINDOW = 1
+LYNC_FLOW_MAX_WINDOW = 32
+# Window added by every reply, divided by the window
+LYNC_FLOW_INCREASE = 1.0
+# Factor the window is cut by on a lost reply or receive errors
+LYNC_FLOW_DECREASE = 0.5
+# Seconds to wait for a reply, before the first one and the limits after it
+LYNC_FLOW_TIMEOUT = 1
+LYNC_FLOW_MIN_TIMEOUT = 0.2
+LYNC_FLOW_MAX_TIMEOUT = 5
+# Round trip, relative to the shortest recent one, from which a reply is delayed
+LYNC_FLOW_DELAY_FACTOR = 2
+# Seconds a reply must be late by at least to be delayed, covers the jitter of fast links
+LYNC_FLOW_DELAY_MIN = 0.02
+# Recent round trips the shortest one is taken from
+LYNC_FLOW_BASE_SAMPLES = 64
+
+class LyncFlowControl:
+    """ AIMD window of the commands in flight on a link, see LyncBase.flow
+        The caller serializes the calls.
+        :param window: the initial window
+    """
+    def __init__(self, window=LYNC_FLOW_WINDOW, min_window=LYNC_FLOW_MIN_WINDOW,
+                 max_window=LYNC_FLOW_MAX_WINDOW):
+        self.window = float(window)
+        self.min_window = min_window
+        self.max_window = max_window
+        # smoothed round trip time and its mean deviation in seconds
+        self.srtt = None
+        self.rttvar = None
+        self._recent = collections.deque(maxlen=LYNC_FLOW_BASE_SAMPLES)
+        # receive error count at the last check
+        self._errors = None
+        # further cuts are ignored until then, they are the same overrun
+        self._recovery = 0
+        self.stats = { 'increases' : 0,
+                       'decreases' : 0,
+                       'timeouts' : 0,
+                       'delays' : 0,
+                       'errors' : 0,
+                       'blocked' : 0 }
+
+    def can_send(self, in_flight, count=1):
+        """ return True when a command awaiting count replies fits the window,
+            one awaiting more replies than the window holds goes alone
+        """
+        return in_flight == 0 or in_flight + count - 1 < self.window
+
+    def timeout(self):
+        """ return the seconds after which a reply is considered lost """
+        if self.srtt is None:
+            return LYNC_FLOW_TIMEOUT
+        return min(max(self.srtt + 4 * self.rttvar, LYNC_FLOW_MIN_TIMEOUT), LYNC_FLOW_MAX_TIMEOUT)
+
+    def confirmed(self, rtt, now):
+        """ Account a reply received rtt seconds after its command """
+        self._recent.append(rtt)
+        base = min(self._recent)
+        if rtt - base > max(base * (LYNC_FLOW_DELAY_FACTOR - 1), LYNC_FLOW_DELAY_MIN):
+            self.stats['delays'] += 1
+            self.__decrease(now)
+        elif self.window < self.max_window:
+            self.window = min(self.max_window, self.window + LYNC_FLOW_INCREASE / self.window)
+            self.stats['increases'] += 1
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def lost(self, now):
+        """ Account a command whose reply did not come before the timeout """
+        self.stats['timeouts'] += 1
+        self.__decrease(now)
+
+    def errors(self, count, now):
+        """ Check the receive error count, a rise means the link is overrun
+            :param count: total checksum errors and resyncs of the link
+        """
+        if self._errors is not None and count > self._errors:
+            self.stats['errors'] += count - self._errors
+            self.__decrease(now)
+        self._errors = count
+
+    def __decrease(self, now):
+        if now < self._recovery:
+            return
+        self.window = max(self.min_window, self.window * LYNC_FLOW_DECREASE)
+        self._recovery = now + (self.srtt if self.srtt is not None else LYNC_FLOW_TIMEOUT)
+        self.stats['decreases'] += 1
+
+    def metrics(self, in_flight=0):
+        """ return the window, commands in flight, round trip estimates and counters """
+        metrics = { 'window' : self.window,
+                    'in_flight' : in_flight,
+                    'srtt' : self.srtt,
+                    'timeout' : self.timeout() }
+        metrics.update(self.stats)
+        return metrics
@@ -0,0 +1,404 @@
+"""
+Differential fuzzing and performance regression harness for the Lync decoder.
+
+Random byte streams are built from valid LYNC_RX_CMDS frames mixed with bad
+checksums, truncated frames, invalid command ids, repeated frames and
+garbage, then mutated and split into random chunks.  Each stream is decoded
+in one piece by LyncReferenceDecoder, a deliberately simple decoder kept as
+the specification, and chunk by chunk by the decoder under test.  The
+resulting state, counters and events must be identical.
+
+Speed is measured as the rate of the decoder under test relative to the
+reference on the same machine, and compared with the ratios stored in the
+baseline file, so a regression beyond the threshold fails the run on any
+machine.  The reference shares snapshot publishing and the dedup state with
+LyncProtocol, so the ratios only follow framing and parsing.  The decoding
+time is also normalised by a fixed pure Python loop timed alongside it and
+compared with the baseline, which covers the shared code too, on machines
+and Python versions close to the one the baseline was stored on.
+
+    python -m lync.fuzz [--trials N] [--seed S] [--update-baseline]
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+from .lync import LyncProtocol, LYNC_HEADER, LYNC_RX_CMDS, LYNC_MAX_ZONES, LYNC_DEDUP_IDS
+from .events import LyncFrameEvent
+from .benchmark import status_stream, repeat_stream
+
+# Stored speed ratios of the decoder to the reference
+LYNC_FUZZ_BASELINE = os.path.join(os.path.dirname(__file__), 'test', 'decoder_baseline.json')
+# Fraction a speed ratio may drop below the baseline
+LYNC_FUZZ_THRESHOLD = 0.25
+# Fed to both decoders after a stream, flushes garbage shorter than a frame
+LYNC_FUZZ_FLUSH = b'\xff' * 24
+# Frames in the streams used for timing
+LYNC_FUZZ_BENCH_FRAMES = 20000
+# Alternate runs of each decoder, the best of them is timed
+LYNC_FUZZ_BENCH_REPEAT = 15
+# Iterations of the loop the decoding time is normalised by
+LYNC_FUZZ_CALIBRATION = 200000
+
+_LOGGER = logging.getLogger(__name__)
+
+class LyncReferenceDecoder(LyncProtocol):
+    """ simple decoder kept as the reference for differential testing
+        It decodes one frame at a time from the front of the buffer.  Keep it
+        obviously correct rather than fast, it defines what the optimized
+        decoder must do.  Scenes and reply timing are not modelled.
+    """
+    def __init__(self):
+        super().__init__()
+        self._last = {}
+
+    def process_data(self, data):
+        self._buf.extend(data)
+        self.stats['rx_bytes'] += len(data)
+        while True:
+            used = self.__decode(self._buf)
+            if not used:
+                break
+            del self._buf[0:used]
+
+    def __decode(self, buf):
+        """ decode the first frame, return the bytes used or 0 to wait for more data """
+        if len(buf) < len(LYNC_HEADER) + 4:
+            return 0
+        start = buf.find(LYNC_HEADER)
+        if start < 0:
+            # the last byte may be the start of a header
+            return len(buf) - 1 if buf[-1] == LYNC_HEADER[0] else len(buf)
+        if len(buf) < start + 4:
+            return start
+        zone = buf[start + 2]
+        cmd_id = buf[start + 3]
+        if cmd_id not in LYNC_RX_CMDS or LYNC_RX_CMDS[cmd_id][0] == 'undefined':
+            return start + len(LYNC_HEADER)
+        (name, length, flags) = LYNC_RX_CMDS[cmd_id]
+        end = start + 4 + length + 1
+        if len(buf) < end:
+            return start
+        self.stats['rx_frames'] += 1
+        frame = bytes(buf[start:end])
+        data = frame[4:-1]
+        if sum(frame[:-1]) & 0xff != frame[-1]:
+            # frames with a bad checksum are still used
+            self.stats['checksum_errors'] += 1
+        elif self.dedup and cmd_id in LYNC_DEDUP_IDS:
+            if cmd_id == 0x0E:
+                key = (zone, 'source', data[11])
+            elif cmd_id == 0x0C:
+                source = self.zone_info[zone]['source'] if zone < LYNC_MAX_ZONES else 'unknown'
+                key = None if source == 'unknown' else (zone, 'source', source)
+            else:
+                key = (zone, cmd_id)
+            if key is not None:
+                self.stats['dedup_frames'] += 1
+                if self._last.get(key) == frame:
+                    self.stats['dedup_hits'] += 1
+                    return end
+                self._last[key] = frame
+        if zone >= LYNC_MAX_ZONES:
+            return end
+        self.__parse(zone, name, flags, data)
+        if self._pending_events is not None or self._subscribers:
+            self._emit(LyncFrameEvent(zone, cmd_id, name, data))
+        self._publish(None if name == 'keypad exists' else (zone,))
+        return end
+
+    def __parse(self, zone, name, flags, data):
+        info = self.zone_info[zone]
+        if name == 'zone status':
+            for key in ('power', 'mute', 'dnd'):
+                info[key] = 'on' if data[0] & flags[key] else 'off'
+            info['source'] = data[4]
+            for (key, value) in zip(('volume', 'treble', 'bass', 'balance'), data[5:9]):
+                info[key] = value - 256 if value > 127 else value
+        elif name == 'keypad exists':
+            for zn in range(LYNC_MAX_ZONES):
+                byte = 1 if zn < 8 else 3
+                self.zone_info[zn]['exists'] = 'yes' if data[byte] & (1 << (zn % 8)) else 'no'
+                self.zone_info[zn]['keypad'] = 'yes' if data[byte + 1] & (1 << (zn % 8)) else 'no'
+            self._zone_mask = data[1] | (data[3] << 8)
+        elif name == 'zone source name':
+            if info['source'] != 'unknown':
+                self.__name_source(zone, info['source'], _name(data[0:11]))
+        elif name == 'zone name':
+            text = _name(data[0:11])
+            if self.zone_lookup.get(info['name']) == str(zone):
+                del self.zone_lookup[info['name']]
+            info['name'] = text
+            self.zone_lookup[text] = str(zone)
+        elif name == 'source name':
+            self.__name_source(zone, data[11], _name(data[0:10]))
+        elif name in ('mp3 on', 'mp3 off'):
+            self.mp3_status['state'] = name[4:]
+        elif name == 'mp3 file name':
+            self.mp3_status['file'] = data.decode(errors='replace').rstrip('\0')
+        elif name == 'mp3 artist name':
+            self.mp3_status['artist'] = data.decode(errors='replace').rstrip('\0')
+
+    def __name_source(self, zone, source, text):
+        sources = self.source_info[zone]
+        previous = self.zone_info[zone]['source_list'].get(source)
+        if sources.get(previous) == source:
+            del sources[previous]
+        self.zone_info[zone]['source_list'][source] = text
+        sources[text] = source
+
+def _name(data):
+    return data.decode(errors='replace').rstrip('\0').lower()
+
+def random_frame(rng, checksum=True):
+    """ return one frame of a random LYNC_RX_CMDS command """
+    cmd_id = rng.choice(list(LYNC_RX_CMDS))
+    length = LYNC_RX_CMDS[cmd_id][1]
+    zone = rng.randrange(LYNC_MAX_ZONES) if rng.random() < 0.95 else rng.randrange(256)
+    if cmd_id in (0x0C, 0x0D, 0x0E, 0x11, 0x12) and rng.random() < 0.8:
+        # mostly readable names, some with bytes that are not utf-8
+        text = ''.join(rng.choice('abcdefgh ') for i in range(rng.randrange(length)))
+        data = bytearray(text.encode().ljust(length, b'\0'))
+        if rng.random() < 0.1:
+            data[0] = rng.randrange(0x80, 0x100)
+        if cmd_id == 0x0E:
+            data[11] = rng.randrange(1, 19)
+    elif cmd_id == 0x05:
+        data = bytearray([rng.randrange(8), 0, 0, 0, rng.randrange(1, 19)])
+        data += bytes(rng.randrange(256) for i in range(4))
+    else:
+        data = bytearray(rng.randrange(256) for i in range(length))
+    frame = bytearray(LYNC_HEADER) + bytes([zone, cmd_id]) + data
+    csum = sum(frame) & 0xff
+    frame.append(csum if checksum else (csum + rng.randrange(1, 256)) & 0xff)
+    return bytes(frame)
+
+def random_stream(rng, frames=64):
+    """ return a stream of frames mixed with damaged frames and garbage """
+    stream = bytearray()
+    previous = random_frame(rng)
+    for i in range(frames):
+        choice = rng.random()
+        if choice < 0.55:
+            previous = random_frame(rng)
+            stream.extend(previous)
+        elif choice < 0.65:
+            # repeats are skipped by the dedup
+            stream.extend(previous)
+        elif choice < 0.75:
+            stream.extend(random_frame(rng, checksum=False))
+        elif choice < 0.83:
+            frame = random_frame(rng)
+            stream.extend(frame[:rng.randrange(1, len(frame))])
+        elif choice < 0.91:
+            for i in range(rng.randrange(1, 8)):
+                stream.extend(rng.choice((b'\x02', b'\x00', b'\x02\x00', bytes([rng.randrange(256)]))))
+        else:
+            # header with an invalid or undefined command
+            stream.extend(LYNC_HEADER + bytes([rng.randrange(LYNC_MAX_ZONES),
+                                               rng.choice((0x00, 0x02, 0x03, 0x07, 0x20, 0xff))]))
+    return bytes(stream)
+
+def mutate(rng, stream, mutations=4):
+    """ return the stream with random bit flips, deletions, insertions and duplicated slices """
+    stream = bytearray(stream)
+    for i in range(rng.randrange(mutations + 1)):
+        if not stream:
+            break
+        pos = rng.randrange(len(stream))
+        choice = rng.random()
+        if choice < 0.4:
+            stream[pos] ^= 1 << rng.randrange(8)
+        elif choice < 0.6:
+            del stream[pos]
+        elif choice < 0.8:
+            stream.insert(pos, rng.randrange(256))
+        else:
+            end = min(len(stream), pos + rng.randrange(1, 32))
+            stream[pos:pos] = stream[pos:end]
+    return bytes(stream)
+
+def random_chunks(rng, stream):
+    """ split a stream at random points, sometimes into single bytes """
+    if rng.random() < 0.1:
+        return [stream[i:i + 1] for i in range(len(stream))]
+    cuts = sorted(rng.randrange(len(stream) + 1) for i in range(rng.randrange(8)))
+    bounds = [0] + cuts + [len(stream)]
+    return [stream[a:b] for (a, b) in zip(bounds, bounds[1:])]
+
+def decode_state(decoder):
+    """ return everything the decoder state comparison covers """
+    snap = decoder.snapshot()
+    stats = { key : decoder.stats[key] for key in ('rx_bytes', 'rx_frames', 'checksum_errors',
+                                                    'dedup_frames', 'dedup_hits') }
+    return { 'zones' : snap.zones,
+             'sources' : snap.sources,
+             'mp3' : snap.mp3,
+             'version' : snap.version,
+             'zone_lookup' : decoder.zone_lookup,
+             'zone_mask' : decoder._zone_mask,
+             'buffer' : bytes(decoder._buf),
+             'stats' : stats }
+
+def differential(stream, chunks, candidate=LyncProtocol, reference=LyncReferenceDecoder):
+    """ Decode a stream with both decoders
+        :param chunks: the stream split into the chunks fed to the candidate
+        :return None if both agree, otherwise a description of the first difference
+    """
+    ref = reference()
+    expected_events = ref.receive_data(stream) + ref.receive_data(LYNC_FUZZ_FLUSH)
+    expected = decode_state(ref)
+    dut = candidate()
+    events = []
+    for chunk in chunks + [LYNC_FUZZ_FLUSH]:
+        events.extend(dut.receive_data(chunk))
+    state = decode_state(dut)
+    for key in expected:
+        if state[key] != expected[key]:
+            return "%s differs: %r != %r" % (key, state[key], expected[key])
+    for (i, (event, expected_event)) in enumerate(zip(events, expected_events)):
+        if event != expected_event:
+            return "event %d differs: %r != %r" % (i, event, expected_event)
+    if len(events) != len(expected_events):
+        return "%d events != %d" % (len(events), len(expected_events))
+    return None
+
+@contextlib.contextmanager
+def _quiet():
+    """ the decoder logs every damaged frame """
+    previous = logging.root.manager.disable
+    logging.disable(logging.CRITICAL)
+    try:
+        yield
+    finally:
+        logging.disable(previous)
+
+def fuzz(trials=500, seed=0, candidate=LyncProtocol):
+    """ Run random streams through the reference and the candidate decoder
+        :return a list of (trial, stream, chunk sizes, difference) for the failed trials
+    """
+    failures = []
+    with _quiet():
+        for trial in range(trials):
+            rng = random.Random(seed * 1000003 + trial)
+            stream = mutate(rng, random_stream(rng, rng.randrange(1, 96)))
+            chunks = random_chunks(rng, stream)
+            try:
+                difference = differential(stream, chunks, candidate)
+            except Exception as e:
+                difference = "exception %r" % e
+            if difference is not None:
+                failures.append((trial, stream, [len(c) for c in chunks], difference))
+    return failures
+
+def _elapsed(decoder, stream, chunk=4096):
+    proto = decoder()
+    start = time.perf_counter()
+    for offset in range(0, len(stream), chunk):
+        proto.process_data(stream[offset:offset + chunk])
+    return time.perf_counter() - start
+
+def _calibration(n=LYNC_FUZZ_CALIBRATION):
+    """ time a fixed loop of byte and dict work, independent of the decoder """
+    data = bytearray(range(256)) * 4
+    counts = {}
+    start = time.perf_counter()
+    for i in range(n):
+        value = data[i & 1023]
+        counts[value] = counts.get(value, 0) + (value & 0x0f)
+    return time.perf_counter() - start
+
+def speed_figures(candidate=LyncProtocol, frames=LYNC_FUZZ_BENCH_FRAMES, repeat=LYNC_FUZZ_BENCH_REPEAT):
+    """ return (ratios, normalized) for each workload
+        ratios is the speed of the candidate relative to the reference, normalized
+        its speed relative to the calibration loop.  The decoders and the loop run
+        alternately and the best run of each is used, so the figures hold up on a
+        busy machine.
+    """
+    rng = random.Random(0)
+    workloads = { 'status' : status_stream(frames),
+                  'mixed' : random_stream(rng, frames),
+                  # every frame after the first of its zone repeats the last one
+                  'repeats' : repeat_stream(frames) }
+    proto = candidate()
+    proto.process_data(workloads['repeats'])
+    if not proto.stats['dedup_hits']:
+        raise ValueError("The repeats workload has no repeated frames")
+    ratios = {}
+    normalized = {}
+    with _quiet():
+        for (name, stream) in workloads.items():
+            best = { candidate : float('inf'), LyncReferenceDecoder : float('inf'), None : float('inf') }
+            for i in range(repeat):
+                for decoder in best:
+                    elapsed = _calibration() if decoder is None else _elapsed(decoder, stream)
+                    best[decoder] = min(best[decoder], elapsed)
+            ratios[name] = best[LyncReferenceDecoder] / best[candidate]
+            normalized[name] = best[None] / best[candidate]
+    return (ratios, normalized)
+
+def speed_ratios(candidate=LyncProtocol, frames=LYNC_FUZZ_BENCH_FRAMES, repeat=LYNC_FUZZ_BENCH_REPEAT):
+    """ return the speed of the candidate relative to the reference for each workload """
+    return speed_figures(candidate, frames, repeat)[0]
+
+def check_performance(candidate=LyncProtocol, path=LYNC_FUZZ_BASELINE, threshold=None):
+    """ Compare the speed ratios and normalised speeds with the stored baseline
+        :return a list of (workload, figure, baseline figure) which regressed, the
+                normalised speeds are named workload/normalized
+    """
+    with open(path) as f:
+        baseline = json.load(f)
+    threshold = threshold if threshold is not None else baseline.get('threshold', LYNC_FUZZ_THRESHOLD)
+    (ratios, normalized) = speed_figures(candidate)
+    measured = dict(ratios)
+    expected = dict(baseline['ratios'])
+    for (name, value) in normalized.items():
+        measured[name + '/normalized'] = value
+    for (name, value) in baseline.get('normalized', {}).items():
+        expected[name + '/normalized'] = value
+    return [(name, measured.get(name, 0), value) for (name, value) in expected.items()
+            if measured.get(name, 0) < value * (1 - threshold)]
+
+def update_baseline(candidate=LyncProtocol, path=LYNC_FUZZ_BASELINE, threshold=LYNC_FUZZ_THRESHOLD):
+    """ Store the measured figures as the baseline, return (ratios, normalized) """
+    (ratios, normalized) = speed_figures(candidate)
+    with open(path, 'w') as f:
+        json.dump({ 'threshold' : threshold,
+                    'ratios' : { name : round(ratio, 3) for (name, ratio) in ratios.items() },
+                    'normalized' : { name : round(value, 3) for (name, value) in normalized.items() } },
+                  f, indent=2, sort_keys=True)
+        f.write('\n')
+    return (ratios, normalized)
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuzz and time the Lync decoder")
+    parser.add_argument('--trials', type=int, default=2000, help="random streams to decode")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the first trial")
+    parser.add_argument('--baseline', default=LYNC_FUZZ_BASELINE, help="speed baseline file")
+    parser.add_argument('--threshold', type=float, default=None,
+                        help="allowed fractional drop below the baseline")
+    parser.add_argument('--update-baseline', action='store_true',
+                        help="store the measured speed as the new baseline")
+    args = parser.parse_args()
+    failures = fuzz(args.trials, args.seed)
+    for (trial, stream, chunks, difference) in failures[:10]:
+        print("trial %d: %s\n  stream %s\n  chunks %s" % (trial, difference, stream.hex(), chunks))
+    print("%d of %d trials diverged" % (len(failures), args.trials))
+    if args.update_baseline:
+        (ratios, normalized) = update_baseline(path=args.baseline)
+        for (name, ratio) in ratios.items():
+            print("baseline %-8s %.2fx reference, %.3fx calibration" % (name, ratio, normalized[name]))
+        return 1 if failures else 0
+    regressions = check_performance(path=args.baseline, threshold=args.threshold)
+    for (name, ratio, expected) in regressions:
+        print("%s regressed: %.3fx, baseline %.3fx" % (name, ratio, expected))
+    return 1 if failures or regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
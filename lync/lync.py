@@ -16,10 +16,30 @@ the source code distribution for details.
 import logging
 import threading
 import time
+import queue
 import requests
 import websocket
 import serial
-import binascii
+import collections
+import struct
+
+from .capture import LyncCapture, LYNC_CAPTURE_RX, LYNC_CAPTURE_TX
+from .trace import LyncTrace, LYNC_TRACE_SIZE
+from .scheduler import get_scheduler
+from .events import LyncSubscription, LyncFrameEvent, LyncStateEvent, LYNC_EVENT_QUEUE
+from .ramp import LyncRamp
+from .tracing import current_trace, percentiles
+from .flow import LyncFlowControl
+
+__all__ = ['LyncProtocol', 'LyncBase', 'LyncSerial', 'LyncRemote', 'LyncSendQueue',
+           'LyncFrozenDict', 'LyncSnapshot', 'split_tx_frames', 'write_priority', 'LYNC_HEADER',
+           'LYNC_SOCKET_TIMEOUT', 'LYNC_REFRESH_TIMEOUT', 'LYNC_WS_CONNECT_TIMEOUT',
+           'LYNC_HTTP_TIMEOUT', 'LYNC_AUTH_VALID', 'LYNC_MAX_ZONES', 'LYNC_BATCH_FRAMES',
+           'LYNC_BATCH_PACING', 'LYNC_SEND_QUEUE_SIZE', 'LYNC_PRIORITIES',
+           'LYNC_PRIORITY_AGING', 'LYNC_RTT_SAMPLES', 'LYNC_RTT_EXPIRE', 'LYNC_RECONNECT_DELAY',
+           'LYNC_RECONNECT_MAX_DELAY', 'LYNC_CONNECTION_LOG', 'LYNC_SCENE_KEYS', 'LYNC_TX_CMDS',
+           'LYNC_DEDUP_IDS', 'LYNC_QUERY_IDS', 'LYNC_STATUS_CMDS', 'LYNC_TX_LENGTHS',
+           'LYNC_RX_CMDS']
 
 # lync serial header
 LYNC_HEADER = b'\x02\x00'
@@ -29,8 +49,34 @@ LYNC_SOCKET_TIMEOUT = 1
 LYNC_REFRESH_TIMEOUT = 3
 # Intitial open timeout
 LYNC_WS_CONNECT_TIMEOUT = 5
+# Seconds to wait for the gateway login (connect, read)
+LYNC_HTTP_TIMEOUT = (3, 5)
+# Seconds a gateway login is reused before authenticating again
+LYNC_AUTH_VALID = 300
 # Total number of zones supported per lync system
 LYNC_MAX_ZONES = 16
+# Maximum number of frames combined into a single batched write
+LYNC_BATCH_FRAMES = 16
+# Seconds between batched writes so the gateway buffer is not overrun
+LYNC_BATCH_PACING = 0.02
+# Maximum number of writes of each priority class waiting for the writer thread
+LYNC_SEND_QUEUE_SIZE = 64
+# Priority classes of outgoing writes, the writer drains them in this order
+LYNC_PRIORITIES = ('interactive', 'automation', 'background')
+# Seconds a write of a lower class waits behind higher classes before it goes next
+LYNC_PRIORITY_AGING = { 'automation' : 0.5,
+                        'background' : 2 }
+# Command round trip times kept for the percentiles
+LYNC_RTT_SAMPLES = 256
+# Seconds after which a write is no longer matched to a zone status reply
+LYNC_RTT_EXPIRE = 5
+# Seconds before the websocket reconnects, doubled after every failed attempt up to the maximum
+LYNC_RECONNECT_DELAY = 1
+LYNC_RECONNECT_MAX_DELAY = 60
+# Number of connection events kept in the connection log
+LYNC_CONNECTION_LOG = 32
+# Zone state captured and restored by scenes, in the order they are applied
+LYNC_SCENE_KEYS = ('power', 'source', 'volume', 'mute', 'treble', 'bass', 'balance')
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -83,6 +129,25 @@ LYNC_TX_CMDS = {
     'set name to default' : (0x1D, 1, { 'none' : 0 })
     }
 
+# State frames which are skipped when repeated unchanged:
+# zone status, keypad exists, zone source name, zone name and source name.
+# Zone source name and source name frames both name one source of the zone and
+# share its fingerprint, a zone source name frame needs the source to be known.
+LYNC_DEDUP_IDS = (0x05, 0x06, 0x0C, 0x0D, 0x0E)
+
+# Queries, written as background traffic by default:
+# both query all zones, query id, zone name, zone source name, firmware and volume
+LYNC_QUERY_IDS = (0x05, 0x08, 0x0C, 0x0D, 0x0E, 0x0F, 0x10)
+
+# Commands the controller answers with a zone status frame:
+# zone, both query all zones and the volume, balance, treble and bass settings
+LYNC_STATUS_CMDS = (0x04, 0x05, 0x0C, 0x15, 0x16, 0x17, 0x18)
+
+# Argument length of each command id
+LYNC_TX_LENGTHS = { info[0] : info[1] for info in LYNC_TX_CMDS.values() }
+# 0x05 'query all zones' is shadowed by the second entry of that name
+LYNC_TX_LENGTHS[0x05] = 1
+
 # Commands from the Lync
 # id, (name, length, args)
 LYNC_RX_CMDS = {
@@ -103,8 +168,53 @@ LYNC_RX_CMDS = {
     0x1b : ('error', 9, { }),
     }
 
-class LyncBase:
-    '''class providing basic processing for HTD Lync commands'''
+def split_tx_frames(buf):
+    """ Split complete command frames off the front of a buffer
+        :return (list of frames, number of bytes consumed)
+    """
+    frames = []
+    offset = 0
+    while True:
+        start = buf.find(LYNC_HEADER, offset)
+        if start < 0:
+            # keep a possible partial header
+            return (frames, max(offset, len(buf) - 1))
+        if start + len(LYNC_HEADER) + 2 > len(buf):
+            return (frames, start)
+        cmd_id = buf[start + 3]
+        if cmd_id not in LYNC_TX_LENGTHS:
+            _LOGGER.info("Dropping unknown command 0x%x", cmd_id)
+            offset = start + len(LYNC_HEADER)
+            continue
+        end = start + len(LYNC_HEADER) + 3 + LYNC_TX_LENGTHS[cmd_id]
+        if end > len(buf):
+            return (frames, start)
+        frames.append(bytes(buf[start:end]))
+        offset = end
+
+class LyncFrozenDict(dict):
+    '''read only dict used for state snapshots, still serializable with json'''
+    def __readonly(self, *args, **kwargs):
+        raise TypeError("Lync state snapshots are read only")
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = __readonly
+
+    def __reduce__(self):
+        # copy and pickle rebuild it through the constructor, not __setitem__
+        return (self.__class__, (dict(self),))
+
+# volume, treble, bass and balance bytes of a zone status frame
+_SETTINGS = struct.Struct('4b')
+
+# Immutable copy of the state cache.  version increases every time a received
+# frame changes the state so it can be used as a cache key.
+LyncSnapshot = collections.namedtuple('LyncSnapshot', ['version', 'zones', 'sources', 'mp3'])
+
+class LyncProtocol:
+    '''sans-IO engine of the HTD Lync protocol
+       Received bytes go in through receive_data and update the state cache,
+       commands come out of the set_* methods as frames to send.  It has no
+       sockets, threads or sleeps, the transports in LyncBase and its
+       subclasses feed it and write its frames.'''
     def __init__(self):
         # Default initializations
         self.zone_info = [{ 'name' : 'unknown' ,
@@ -124,11 +234,51 @@ class LyncBase:
         self.mp3_status = { 'state' : 'off',
                             'file' : 'unknown',
                             'artist' : 'unkown' }
+        self._buf = bytearray()
+        # metrics from the decoder and transports
+        self.stats = { 'rx_bytes' : 0,
+                       'rx_frames' : 0,
+                       'checksum_errors' : 0,
+                       'resyncs' : 0,
+                       'dedup_frames' : 0,
+                       'dedup_hits' : 0 }
+        # last payload of each state frame, see LYNC_DEDUP_IDS
+        self.dedup = True
+        self._fingerprints = {}
+        # event consumers with a put(event) method, see LyncBase.subscribe
+        self._subscribers = ()
+        # events collected by receive_data
+        self._pending_events = None
+        # in memory frame trace, see start_trace
+        self._trace = None
+        self._trace_dump = False
+        # bitmask of installed zones from the keypad exists frame, None until known
+        self._zone_mask = None
+        # address zones which the controller reports as not installed
+        self.hidden_zones = False
+        # zones still waiting for a scene to be confirmed by a status frame
+        self._scene_pending = {}
+        # zones whose next 'zone status' frame is reported to _status_received
+        self._awaiting = {}
+        self._snapshot = LyncSnapshot(0,
+                                      tuple(self.__freeze(info) for info in self.zone_info),
+                                      tuple(self.__freeze(info) for info in self.source_info),
+                                      self.__freeze(self.mp3_status))
 
     def __signed_byte(self, c):
-        unsigned = ord(c.to_bytes(1,byteorder='little'))
-        signed = unsigned - 256 if unsigned > 127 else unsigned
-        return signed
+        return c - 256 if c > 127 else c
+
+    def __name_source(self, zone, source, name):
+        """ record the name of a source of a zone, replacing its previous name """
+        previous = self.zone_info[zone]['source_list'].get(source)
+        if previous != name and self.source_info[zone].get(previous) == source:
+            del self.source_info[zone][previous]
+        self.zone_info[zone]['source_list'][source] = name
+        self.source_info[zone][name] = source
+
+    def __decode_name(self, data):
+        """ names are zero padded, bytes which are not utf-8 are replaced """
+        return data.decode(errors='replace').rstrip('\0').lower()
 
     def __parse_command(self, zone, cmd, arg_info, data):
         #_LOGGER.debug("Received response: %s", cmd)
@@ -159,130 +309,366 @@ class LyncBase:
                     self.zone_info[i+8]['keypad'] = 'yes'
                 else:
                     self.zone_info[i+8]['keypad'] = 'no'
+            self._zone_mask = data[1] | (data[3] << 8)
         elif cmd == 'zone status':
+            info = self.zone_info[zone]
             # first byte is status bits
-            if data[0] & arg_info['power']:
-                self.zone_info[zone]['power'] = 'on'
-            else:
-                self.zone_info[zone]['power'] = 'off'
-            if data[0] & arg_info['mute']:
-                self.zone_info[zone]['mute'] = 'on'
-            else:
-                self.zone_info[zone]['mute'] = 'off'
-            if data[0] & arg_info['dnd']:
-                self.zone_info[zone]['dnd'] = 'on'
-            else:
-                self.zone_info[zone]['dnd'] = 'off'
+            status = data[0]
+            info['power'] = 'on' if status & arg_info['power'] else 'off'
+            info['mute'] = 'on' if status & arg_info['mute'] else 'off'
+            info['dnd'] = 'on' if status & arg_info['dnd'] else 'off'
             # fifth byte is input
-            self.zone_info[zone]['source'] = data[4]
-            # sixth byte is volume
-            self.zone_info[zone]['volume'] = self.__signed_byte(data[5])
-            # seventh byte is treble
-            self.zone_info[zone]['treble'] = self.__signed_byte(data[6])
-            # eigth byte is bass
-            self.zone_info[zone]['bass'] = self.__signed_byte(data[7])
-            # ninth byte is balance
-            self.zone_info[zone]['balance'] = self.__signed_byte(data[8])
+            info['source'] = data[4]
+            # sixth to ninth bytes are the signed volume, treble, bass and balance
+            (info['volume'], info['treble'], info['bass'], info['balance']) = _SETTINGS.unpack_from(data, 5)
+            if zone in self._scene_pending:
+                self.__check_scene(zone)
         elif cmd == 'zone source name':
-            # remove the extra null bytes
-            self.source_info[zone] = str(data[0:11].decode().rstrip('\0')).lower()
+            # name of the source selected in the zone, remove the extra null bytes
+            name = self.__decode_name(data[0:11])
+            source = self.zone_info[zone]['source']
+            if source != 'unknown':
+                self.__name_source(zone, source, name)
         elif cmd == 'zone name':
-            name = str(data[0:11].decode().rstrip('\0')).lower()
+            name = self.__decode_name(data[0:11])
+            # drop the previous name so renames don't accumulate in the lookup
+            previous = self.zone_info[zone]['name']
+            if previous != name and self.zone_lookup.get(previous) == str(zone):
+                del self.zone_lookup[previous]
             self.zone_info[zone]['name'] = name
             self.zone_lookup[name] = str(zone).lower()
         elif cmd == 'source name':
             source = data[11]
-            name = str(data[0:10].decode().rstrip('\0')).lower()
-            self.zone_info[zone]['source_list'][source] = name
-            self.source_info[zone][name] = source
+            name = self.__decode_name(data[0:10])
+            self.__name_source(zone, source, name)
         elif cmd == 'mp3 on':
             self.mp3_status['state'] = 'on'
         elif cmd == 'mp3 off':
             self.mp3_status['state'] = 'off'
         elif cmd == 'mp3 file name':
-            self.mp3_status['file'] = data.decode().rstrip('\0')
+            self.mp3_status['file'] = data.decode(errors='replace').rstrip('\0')
         elif cmd == 'mp3 artist name':
-            self.mp3_status['artist'] = data.decode().rstrip('\0')
+            self.mp3_status['artist'] = data.decode(errors='replace').rstrip('\0')
         elif cmd == 'error':
             _LOGGER.warning("Error response: %d", int(self.__signed_byte(data[0])))
         else:
             _LOGGER.info("Not processing packet type: %s", cmd)
     
-    def process_command(self, c):
-        """ Process the lync frame data.  Search for the frame sync bytes and process one 
-            frame from the buffer.  Return the start of the next frame. """
+    def process_command(self, c, pos=0):
+        """ Process the lync frame data.  Search for the frame sync bytes from pos and process
+            one frame from the buffer.  Return the start of the next frame, or of the frame
+            waiting for more data. """
         # start with search for command header and Id the command
-        global LYNC_HEADER
         # not enough data
-        if(len(c) < len(LYNC_HEADER) + 4):
-            return 0
-        start = c.find(LYNC_HEADER)
+        size = len(c)
+        if size - pos < len(LYNC_HEADER) + 4:
+            return pos
+        start = c.find(LYNC_HEADER, pos)
         if start < 0:
-            return len(c)
-        if start != 0:
-            _LOGGER.debug("Bad sync buffer: %s", str(binascii.hexlify(c)))
+            # keep a possible first header byte for the next chunk
+            return size - 1 if c[-1] == LYNC_HEADER[0] else size
+        if start != pos:
+            _LOGGER.debug("Bad sync buffer, skipping %d bytes", start - pos)
+            self.stats['resyncs'] += 1
+            if self._trace is not None:
+                self._trace.record(LYNC_CAPTURE_RX, c, pos, start)
         # offsets to packet data
-        zone_idx = start + len(LYNC_HEADER)
-        cmd_idx = zone_idx + 1
-        data_idx = cmd_idx + 1
+        data_idx = start + len(LYNC_HEADER) + 2
         # not enough data, wait for more
-        if(len(c) < data_idx):
-            return 0
+        if size < data_idx:
+            return start
         # Skip over bad command
         # return the minimum packet size for resync
-        if c[cmd_idx] not in LYNC_RX_CMDS:
-            _LOGGER.error("Invalid command value 0x%x", c[cmd_idx])
-            #_LOGGER.debug("Packet buffer: %s", str(binascii.hexlify(c[0:20])))
+        cmd_id = c[data_idx - 1]
+        cmd_info = LYNC_RX_CMDS.get(cmd_id)
+        if cmd_info is None:
+            _LOGGER.error("Invalid command value 0x%x", cmd_id)
+            self.stats['resyncs'] += 1
+            if self._trace is not None:
+                self.__trace_error(c, start, data_idx)
             return start + len(LYNC_HEADER)
-        zone = int(c[zone_idx])
-        cmd_info = LYNC_RX_CMDS[c[cmd_idx]]
-        cmd_name = cmd_info[0]
-        #_LOGGER.debug("Got command: %s zone: %d name: %s", c[cmd_idx], zone, cmd_name)
+        (cmd_name, cmd_length, arg_info) = cmd_info
+        #_LOGGER.debug("Got command: %s zone: %d name: %s", cmd_id, zone, cmd_name)
         if cmd_name == 'undefined':
-            _LOGGER.info("Undefined response command: %02x", int(c[cmd_idx]))
-            _LOGGER.debug("Packet buffer: %s", str(binascii.hexlify(c[0:20])))
+            _LOGGER.info("Undefined response command: %02x", cmd_id)
+            self.stats['resyncs'] += 1
+            if self._trace is not None:
+                self.__trace_error(c, start, data_idx)
             return start + len(LYNC_HEADER)
-        cmd_length = cmd_info[1]
-        # not enough data, wait for more
-        if(len(c) < data_idx+cmd_length):
-            return 0
+        end = data_idx + cmd_length + 1
+        # not enough data including the checksum, wait for more
+        if size < end:
+            return start
+        zone = c[data_idx - 2]
         # process the content to the current state
-        frame=c[start:start + len(LYNC_HEADER) + 2 + cmd_length]
-        csum=c[start + len(LYNC_HEADER) + 2 + cmd_length]
-        fsum = sum(frame) & 0xff
+        self.stats['rx_frames'] += 1
+        csum = c[end - 1]
+        fsum = sum(c[start:end - 1]) & 0xff
         if fsum != csum:
             _LOGGER.info("Bad checksum %02x != %02x", fsum, csum)
-            #_LOGGER.debug("Frame buffer: %s", str(binascii.hexlify(frame)))
-            #_LOGGER.debug("Packet buffer: %s", str(binascii.hexlify(c[0:20])))
-        self.__parse_command(zone, cmd_name, cmd_info[2], c[data_idx:data_idx+cmd_length])
-        return start + len(LYNC_HEADER) + 2 + cmd_length + 1
-
-    def create_send_message(self, cmd, zone_name, val=None):
-        """ send a single command """
-        def gen_frame(cmd=0, zone=0, args=b'\x00'):
-            cmd_id=LYNC_TX_CMDS[cmd][0]
-            frame = bytearray()
-            frame.extend(LYNC_HEADER)
-            frame.extend(int(zone).to_bytes(1,byteorder='little'))
-            frame.extend(cmd_id.to_bytes(1,byteorder='little'))
-            frame.extend(args)
-            # fill
-            s = sum(frame)
-            s &= 0xFF
-            frame.extend(s.to_bytes(1,byteorder='little'))
-            _LOGGER.debug("Sending %s", str(binascii.hexlify(frame)))
-            return frame
-        
-        # Verify the command name
-        if not cmd in LYNC_TX_CMDS:
-            _LOGGER.info("Invalid command name %s", cmd)
-            return
-        # Find the zone number from name
-        if not zone_name.lower() in self.zone_lookup:
-            _LOGGER.info("Zone %s does not exist in the list", zone_name)
+            self.stats['checksum_errors'] += 1
+            if self._trace is not None:
+                self.__trace_error(c, start, end)
+        else:
+            if self._trace is not None:
+                self._trace.record(LYNC_CAPTURE_RX, c, start, end)
+            if self._awaiting and cmd_id == 0x05 and zone in self._awaiting:
+                self._status_received(zone)
+            if self.dedup and cmd_id in LYNC_DEDUP_IDS:
+                # identical repeats of state frames change nothing, skip them
+                key = (zone << 16) | (cmd_id << 8)
+                if cmd_id == 0x0E:
+                    # one source name frame per source
+                    key |= c[data_idx + 11]
+                elif cmd_id == 0x0C:
+                    # names the current source, dropped while it is unknown
+                    source = self.zone_info[zone]['source'] if zone < LYNC_MAX_ZONES else 'unknown'
+                    key = -1 if source == 'unknown' else (zone << 16) | (0x0E << 8) | source
+                if key >= 0:
+                    fingerprint = bytes(c[start:end])
+                    self.stats['dedup_frames'] += 1
+                    if self._fingerprints.get(key) == fingerprint:
+                        self.stats['dedup_hits'] += 1
+                        return end
+                    self._fingerprints[key] = fingerprint
+        if zone >= LYNC_MAX_ZONES:
+            _LOGGER.info("Invalid zone %d for %s", zone, cmd_name)
+            return end
+        data = c[data_idx:end - 1]
+        self.__parse_command(zone, cmd_name, arg_info, data)
+        if self._subscribers or self._pending_events is not None:
+            self._emit(LyncFrameEvent(zone, cmd_id, cmd_name, bytes(data)))
+        self._publish(None if cmd_name == 'keypad exists' else (zone,))
+        return end
+
+    def __freeze(self, value):
+        if not isinstance(value, dict):
+            return value
+        frozen = LyncFrozenDict(value)
+        # only the source list is nested
+        if 'source_list' in value:
+            dict.__setitem__(frozen, 'source_list', LyncFrozenDict(value['source_list']))
+        return frozen
+
+    def _publish(self, zones=None):
+        """ Build a new snapshot if the state of any of the zones changed
+            :param zones: zone numbers which may have changed or None for all zones
+        """
+        snap = self._snapshot
+        if zones is None:
+            zones = range(LYNC_MAX_ZONES)
+        new_zones = None
+        new_sources = None
+        for zone in zones:
+            if self.zone_info[zone] != snap.zones[zone]:
+                if new_zones is None:
+                    new_zones = list(snap.zones)
+                new_zones[zone] = self.__freeze(self.zone_info[zone])
+            if self.source_info[zone] != snap.sources[zone]:
+                if new_sources is None:
+                    new_sources = list(snap.sources)
+                new_sources[zone] = self.__freeze(self.source_info[zone])
+        mp3 = snap.mp3
+        if self.mp3_status != mp3:
+            mp3 = self.__freeze(self.mp3_status)
+        if new_zones is None and new_sources is None and mp3 is snap.mp3:
             return
+        self._snapshot = LyncSnapshot(snap.version + 1,
+                                      snap.zones if new_zones is None else tuple(new_zones),
+                                      snap.sources if new_sources is None else tuple(new_sources),
+                                      mp3)
+        self._state_changed()
+        if self._subscribers or self._pending_events is not None:
+            self.__emit_changes(snap, self._snapshot)
+
+    def _state_changed(self):
+        """ called after a new snapshot is published, for the transports to wake waiters """
+        pass
+
+    def _status_received(self, zone):
+        """ called with a zone listed in _awaiting when its status frame is received """
+        self._awaiting.pop(zone, None)
+
+    def __emit_changes(self, old, new):
+        for zone in range(LYNC_MAX_ZONES):
+            if new.zones[zone] is not old.zones[zone]:
+                changes = { key : value for (key, value) in new.zones[zone].items()
+                            if old.zones[zone].get(key) != value }
+                self._emit(LyncStateEvent(new.version, zone, changes))
+        if new.mp3 is not old.mp3:
+            changes = { key : value for (key, value) in new.mp3.items()
+                        if old.mp3.get(key) != value }
+            self._emit(LyncStateEvent(new.version, None, changes))
+
+    def _emit(self, event):
+        if self._pending_events is not None:
+            self._pending_events.append(event)
+        for subscriber in self._subscribers:
+            subscriber.put(event)
+
+    def subscribe(self, maxsize=LYNC_EVENT_QUEUE, policy='drop-oldest'):
+        """ Receive decoded frames and state changes through a bounded queue
+            :param maxsize: number of events queued before the overflow policy applies
+            :param policy: 'drop-oldest', 'coalesce' or 'block', see lync.events
+            :return a LyncSubscription
+        """
+        subscriber = LyncSubscription(self, maxsize, policy)
+        self._subscribers = self._subscribers + (subscriber,)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._subscribers = tuple(s for s in self._subscribers if s is not subscriber)
+
+    async def events(self, maxsize=LYNC_EVENT_QUEUE, policy='drop-oldest'):
+        """ Async iterator of events:  async for event in lync.events() """
+        subscriber = self.subscribe(maxsize, policy)
+        try:
+            async for event in subscriber:
+                yield event
+        finally:
+            subscriber.close()
+
+    def iter_events(self, maxsize=LYNC_EVENT_QUEUE, policy='drop-oldest'):
+        """ Generator of events for threads, unsubscribes when the generator is closed """
+        return iter(self.subscribe(maxsize, policy))
+
+    def dedup_hit_rate(self):
+        """ return the fraction of state frames skipped as unchanged repeats """
+        frames = self.stats['dedup_frames']
+        return self.stats['dedup_hits'] / frames if frames else 0.0
+
+    def snapshot(self):
+        """ return the current immutable state snapshot
+            The snapshot is replaced, never modified, so it can be used without locking
+            and its version used as a cache key.
+        """
+        return self._snapshot
+
+    def process_data(self, data):
+        """ Add received data to the buffer and process all complete frames in it """
+        buf = self._buf
+        buf.extend(data)
+        self.stats['rx_bytes'] += len(data)
+        pos = 0
+        while True:
+            # process one command from the byte stream
+            end = self.process_command(buf, pos)
+            if end <= pos:
+                break
+            pos = end
+        # drop the processed frames in one go
+        del buf[0:pos]
+
+    def receive_data(self, data):
+        """ Process received bytes and return the events they caused
+            :param data: bytes received from the controller, frames may be split anywhere
+            :return list of LyncFrameEvent and LyncStateEvent in the order they occurred
+        """
+        self._pending_events = []
+        try:
+            self.process_data(data)
+            return self._pending_events
+        finally:
+            self._pending_events = None
+
+    def build_rx_frame(self, zone, cmd_id, data):
+        """ build a frame in the format sent by the controller """
+        frame = bytearray(LYNC_HEADER)
+        frame.append(zone)
+        frame.append(cmd_id)
+        frame.extend(data)
+        frame.append(sum(frame) & 0xff)
+        return frame
+
+    def status_frame(self, zone, info):
+        """ build the 'zone status' frame the controller sends for a zone info dict """
+        flags = 0
+        for key in ('power', 'mute', 'dnd'):
+            if info[key] == 'on':
+                flags |= LYNC_RX_CMDS[0x05][2][key]
+        data = [flags, 0, 0, 0, info['source']]
+        data += [info[key] & 0xff for key in ('volume', 'treble', 'bass', 'balance')]
+        return self.build_rx_frame(zone, 0x05, bytes(data))
+
+    def state_frames(self, zone='all'):
+        """ return the controller frames which reproduce the cached state
+            :param zone: 'all' or a zone as a 1 based number or name.
+        """
+        snap = self._snapshot
+        frames = bytearray()
+        if self.zone_to_name(zone) == 'all':
+            zones = self.active_zones()
+            bits = [0, 0, 0, 0]
+            for (i, info) in enumerate(snap.zones):
+                if info['exists'] == 'yes':
+                    bits[2 * (i // 8)] |= 1 << (i % 8)
+                if info['keypad'] == 'yes':
+                    bits[2 * (i // 8) + 1] |= 1 << (i % 8)
+            frames.extend(self.build_rx_frame(0, 0x06, bytes([0] + bits + [0] * 4)))
         else:
-            zone_number = self.zone_lookup[zone_name.lower()]
+            zones = (self.zone_to_num(zone),)
+        for zn in zones:
+            info = snap.zones[zn]
+            if info['name'] != 'unknown':
+                frames.extend(self.build_rx_frame(zn, 0x0D, info['name'].encode()[:11].ljust(13, b'\0')))
+            for (source, name) in info['source_list'].items():
+                data = bytearray(name.encode()[:10].ljust(13, b'\0'))
+                data[11] = source
+                frames.extend(self.build_rx_frame(zn, 0x0E, data))
+            if info['source'] != 'unknown':
+                frames.extend(self.status_frame(zn, info))
+        return bytes(frames)
+
+    def start_trace(self, size=LYNC_TRACE_SIZE, dump_on_error=True):
+        """ Keep the last frames sent and received in an in memory ring buffer
+            :param size: number of frames kept
+            :param dump_on_error: log the trace at debug level on receive errors
+        """
+        self._trace_dump = dump_on_error
+        self._trace = LyncTrace(size)
+
+    def stop_trace(self):
+        self._trace = None
+
+    def dump_trace(self):
+        """ Log the traced frames and return them as (ts, direction, zone, cmd, data) """
+        trace = self._trace
+        if trace is None:
+            return []
+        trace.dump()
+        return trace.records()
+
+    def __trace_error(self, c, start, end):
+        self._trace.record(LYNC_CAPTURE_RX, c, start, min(end, len(c)))
+        if self._trace_dump:
+            self._trace.dump()
+
+    def _trace_tx(self, data):
+        # record each frame of a batched write separately
+        offset = 0
+        while offset + len(LYNC_HEADER) + 2 <= len(data):
+            end = offset + len(LYNC_HEADER) + 3 + LYNC_TX_LENGTHS.get(data[offset + 3], 1)
+            self._trace.record(LYNC_CAPTURE_TX, data, offset, min(end, len(data)))
+            offset = end
+
+    def build_frame(self, cmd, zone, args=b'\x00'):
+        """ build a single command frame for a zone number """
+        cmd_id=LYNC_TX_CMDS[cmd][0]
+        frame = bytearray()
+        frame.extend(LYNC_HEADER)
+        frame.extend(int(zone).to_bytes(1,byteorder='little'))
+        frame.extend(cmd_id.to_bytes(1,byteorder='little'))
+        frame.extend(args)
+        # fill
+        s = sum(frame)
+        s &= 0xFF
+        frame.extend(s.to_bytes(1,byteorder='little'))
+        return frame
+
+    def encode_args(self, cmd, val=None):
+        """ convert a command argument to the bytes sent on the wire
+            :return the argument bytes or None if the argument is not valid
+        """
         arg=b'\x00'
         # Generate the arguments
         if LYNC_TX_CMDS[cmd][1] > 1:
@@ -309,9 +695,29 @@ class LyncBase:
                 # Convert string to command byte value
                 arg=LYNC_TX_CMDS[cmd][2][val].to_bytes(1,byteorder='little') 
         else:
-            _LOGGER.error("Unknown argument type %s for command %s", type(arg), cmd)
+            _LOGGER.error("Unknown argument type %s for command %s", type(val), cmd)
             return
-        return gen_frame(cmd, zone_number, arg)
+        return arg
+
+    def create_send_message(self, cmd, zone_name, val=None):
+        """ send a single command """
+        # Verify the command name
+        if not cmd in LYNC_TX_CMDS:
+            _LOGGER.info("Invalid command name %s", cmd)
+            return
+        # Find the zone number from name
+        if not zone_name.lower() in self.zone_lookup:
+            _LOGGER.info("Zone %s does not exist in the list", zone_name)
+            return
+        else:
+            zone_number = self.zone_lookup[zone_name.lower()]
+        if not self.zone_exists(int(zone_number)):
+            _LOGGER.info("Zone %s is not installed", zone_name)
+            return
+        arg = self.encode_args(cmd, val)
+        if arg is None:
+            return
+        return self.build_frame(cmd, zone_number, arg)
 
     def zone_to_num(self, zone):
         """ return the zone number from name or id
@@ -367,23 +773,37 @@ class LyncBase:
         else:
             return source
 
+    def zone_exists(self, zone):
+        """ return True if a zone number is installed, or addressable as a hidden zone
+            Zone 0 addresses all zones and always exists.
+        """
+        if zone == 0 or self.hidden_zones or self._zone_mask is None:
+            return True
+        return bool(self._zone_mask & (1 << zone))
+
+    def active_zones(self):
+        """ return the installed zone numbers, all zones until the controller reports them """
+        return [zn for zn in range(1, LYNC_MAX_ZONES) if self.zone_exists(zn)]
+
     def get_zone_info(self, zone='all'):
         """ return the zone information from the state cache
             :param zone: The zone id as a 1 based number or zone name.
         """
+        zones = self._snapshot.zones
         if self.zone_to_name(zone) == 'all':
-            return self.zone_info[1:]
+            return tuple(zones[zn] for zn in self.active_zones())
         else:
-            return self.zone_info[self.zone_to_num(zone)]
+            return zones[self.zone_to_num(zone)]
 
     def get_source_info(self, zone='all'):
         """ return the sources list for a zone from the state cache
             :param zone: The zone id as a 0 based number or zone name.
         """
+        snap = self._snapshot
         if self.zone_to_name(zone) == 'all':
-            return self.source_info
+            return snap.sources
         else:
-            return self.zone_info[self.zone_to_num(zone)]['source_list']
+            return snap.zones[self.zone_to_num(zone)]['source_list']
 
     def set_power(self, zone, state):
         """ Switch power on/off to a zone
@@ -400,11 +820,15 @@ class LyncBase:
         :param volume: The volume as a 0-100 decimal.
         Converts 0 to 100 to a -60 to 0 scale for lync
         """
-        db = int(((60/100) * volume) - 60)
+        db = self.volume_to_db(volume)
         _LOGGER.debug("zone= %s, change volume to %s (%s)", zone, volume, db)
         return self.create_send_message('volume setting control', 
                                         self.zone_to_name(zone), db)
 
+    def volume_to_db(self, volume):
+        """ Convert a 0-100 volume to the -60 to 0 scale of the lync """
+        return int(((60/100) * volume) - 60)
+
     def set_source(self, zone, source):
         """ Set source for a zone - 0 based value for source or name """
         _LOGGER.debug("zone= %s change source to %s.", zone, source)
@@ -448,6 +872,81 @@ class LyncBase:
             volume_level = int(((1-(volume_level/-60)) * 100))
         return volume_level
 
+    def get_scene(self, zones='all'):
+        """ Capture the state of zones from the state cache as a scene
+        :param zones: 'all' or a list of zones as 1 based numbers or names.
+        :param return a dict of zone number to state dict
+        """
+        if zones == 'all':
+            zones = self.active_zones()
+        snap = self._snapshot
+        scene = {}
+        for zone in zones:
+            zn = self.zone_to_num(zone)
+            scene[zn] = { key : snap.zones[zn][key] for key in LYNC_SCENE_KEYS }
+        return scene
+
+    def set_scene(self, scene):
+        """ Generate the minimal frames to move the current state to a scene
+        :param scene: dict of zone to state dict as returned by get_scene.  Keys that
+                      are missing are left unchanged.  Volume, treble, bass and balance
+                      are in the controller units stored in the zone info.
+        :param return a list of frames to send
+        """
+        frames = []
+        pending = {}
+        snap = self._snapshot
+        for zone, target in scene.items():
+            zn = self.zone_to_num(zone)
+            if not 0 <= zn < LYNC_MAX_ZONES or (zn == 0 and zone not in (0, '0')):
+                # an unknown name resolves to zone 0, which addresses every zone
+                _LOGGER.error("Unknown zone %s in scene", zone)
+                continue
+            if not self.zone_exists(zn):
+                _LOGGER.debug("Skipping scene for missing zone %s", zone)
+                continue
+            current = snap.zones[zn]
+            wanted = {}
+            for key in LYNC_SCENE_KEYS:
+                if key not in target or target[key] in (None, 'unknown'):
+                    continue
+                if key != 'power' and target.get('power', current['power']) == 'off':
+                    # settings of a zone that ends up off don't matter
+                    continue
+                if current[key] != target[key]:
+                    frame = self.__scene_frame(zn, key, target[key])
+                    if frame is None:
+                        _LOGGER.error("Invalid scene %s value %s for zone %s", key, target[key], zone)
+                        return []
+                    frames.append(frame)
+                wanted[key] = target[key]
+            if wanted:
+                pending[zn] = wanted
+        # the new scene replaces any previous one still in flight
+        self._scene_pending = pending
+        # zones which already match are complete
+        for zn in list(pending):
+            self.__check_scene(zn)
+        return frames
+
+    def __scene_frame(self, zone, key, value):
+        if key in ('power', 'mute'):
+            cmd, val = 'zone', key + ' ' + value
+        elif key == 'source':
+            cmd, val = 'zone', 'input' + str(value)
+        else:
+            cmd, val = key + ' setting control', value
+        arg = self.encode_args(cmd, val)
+        if arg is None:
+            return None
+        return self.build_frame(cmd, zone, arg)
+
+    def __check_scene(self, zone):
+        wanted = self._scene_pending.get(zone)
+        if wanted is not None and all(self.zone_info[zone][key] == value
+                                      for key, value in wanted.items()):
+            self._scene_pending.pop(zone, None)
+
     def print_state(self):
         _LOGGER.info("zone status")
         _LOGGER.info(self.zone_info)
@@ -456,6 +955,511 @@ class LyncBase:
         _LOGGER.info("source info")
         _LOGGER.info(self.source_info)
 
+class LyncSendQueue:
+    """ writer queue with priority classes, see LYNC_PRIORITIES
+        get returns the oldest write of the highest class which has one, unless
+        the oldest write of a lower class waited longer than its aging limit.
+        The time every write waited is kept per class.
+    """
+    def __init__(self, maxsize=LYNC_SEND_QUEUE_SIZE):
+        self._cond = threading.Condition()
+        self._maxsize = maxsize
+        self._queues = collections.OrderedDict((p, collections.deque()) for p in LYNC_PRIORITIES)
+        self._closed = False
+        # seconds each of the last writes waited, per class
+        self.waits = { p : collections.deque(maxlen=LYNC_RTT_SAMPLES) for p in LYNC_PRIORITIES }
+        self.stats = { p : { 'writes' : 0, 'aged' : 0 } for p in LYNC_PRIORITIES }
+
+    def put(self, item, priority, timeout=None):
+        """ Queue an item, raises queue.Full when its class stays full for timeout seconds """
+        q = self._queues[priority]
+        with self._cond:
+            if not self._cond.wait_for(lambda: len(q) < self._maxsize, timeout):
+                raise queue.Full
+            q.append((time.monotonic(), item))
+            self._cond.notify_all()
+
+    def get(self):
+        """ return the next item, or None once the queue is closed and empty """
+        with self._cond:
+            while True:
+                chosen = self.__choose()
+                if chosen is not None:
+                    break
+                if self._closed:
+                    return None
+                self._cond.wait()
+            (queued, item) = self._queues[chosen].popleft()
+            self._cond.notify_all()
+        self.waits[chosen].append(time.monotonic() - queued)
+        self.stats[chosen]['writes'] += 1
+        return item
+
+    def __choose(self):
+        now = time.monotonic()
+        first = None
+        overdue = None
+        for (priority, q) in self._queues.items():
+            if not q:
+                continue
+            if first is None:
+                first = priority
+                continue
+            # the lower class which waited longest past its limit
+            waited = now - q[0][0] - LYNC_PRIORITY_AGING.get(priority, float('inf'))
+            if waited >= 0 and (overdue is None or waited > overdue[1]):
+                overdue = (priority, waited)
+        if overdue is not None:
+            self.stats[overdue[0]]['aged'] += 1
+            return overdue[0]
+        return first
+
+    def close(self):
+        """ Let get return None once the queued items are taken """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def qsize(self, priority=None):
+        """ return the items waiting, or those of a class and the classes above it """
+        with self._cond:
+            if priority is None:
+                return sum(len(q) for q in self._queues.values())
+            count = 0
+            for (p, q) in self._queues.items():
+                count += len(q)
+                if p == priority:
+                    return count
+
+def write_priority(data):
+    """ return the default priority class of frame data, background for queries """
+    if len(data) > 3 and data[3] in LYNC_QUERY_IDS:
+        return 'background'
+    return 'interactive'
+
+class LyncBase(LyncProtocol):
+    '''class providing basic processing for HTD Lync commands
+       Runs the protocol engine for threaded transports: received chunks are
+       processed under a lock and frames are written in order by a writer
+       thread.  Transports implement connect, close and _transport_write and
+       call process_data with the received bytes.'''
+    def __init__(self):
+        super().__init__()
+        # Held while a received chunk updates the state cache, readers use snapshots
+        self._lock = threading.Lock()
+        # Outgoing frames are written in order by a single writer thread
+        self._txq = None
+        self._txt = None
+        self._txlock = threading.Lock()
+        # raw wire capture, see start_capture
+        self._capture = None
+        # notified when a new snapshot is published, see wait_state
+        self._state_cond = threading.Condition()
+        # callbacks for every received chunk, see add_listener
+        self._listeners = ()
+        # events decoded under _lock, queued to the subscribers once it is released
+        # so a 'block' subscriber never holds up the decoder
+        self._outbox = collections.deque()
+        self._decoding = False
+        # held by the one thread queueing the outbox, which keeps the events in order
+        self._emit_lock = threading.Lock()
+        # running volume ramp of each zone, see ramp_volume
+        self._ramps = {}
+        # LyncTracer timing the commands sent in a trace, see lync.tracing
+        self.tracer = None
+        # seconds from a write to the zone status reply, see rtt
+        self._rtt = collections.deque(maxlen=LYNC_RTT_SAMPLES)
+        # window of the commands awaiting a reply, None writes without waiting
+        self.flow = LyncFlowControl()
+        # held to change _awaiting and the window, notified when a reply frees a place
+        self._flow_cond = threading.Condition()
+        # commands written and not yet answered, _awaiting holds a deque of
+        # (trace, time written) for each zone
+        self._in_flight = 0
+        # (time, event, detail) of recent connects, disconnects and errors
+        self.connection_log = collections.deque(maxlen=LYNC_CONNECTION_LOG)
+        self.stats.update({ 'tx_bytes' : 0,
+                            'tx_frames' : 0,
+                            'tx_errors' : 0,
+                            'connects' : 0 })
+
+    def wait_state(self, zone, expected, timeout=None):
+        """ Wait for the cached state of a zone to match
+            :param zone: The zone as a 1 based number or name.
+            :param expected: dict of zone info keys to the values to wait for
+            :return True if the state matched before the timeout
+        """
+        zn = self.zone_to_num(zone)
+        def matches():
+            info = self._snapshot.zones[zn]
+            return all(info.get(key) == value for (key, value) in expected.items())
+        with self._state_cond:
+            return self._state_cond.wait_for(matches, timeout)
+
+    def process_data(self, data):
+        """ Add received data to the buffer and process all complete frames in it """
+        if self._capture is not None:
+            self._capture.record(LYNC_CAPTURE_RX, data)
+        with self._lock:
+            self._decoding = True
+            try:
+                super().process_data(data)
+            finally:
+                self._decoding = False
+        while self._outbox:
+            # a thread already queueing the outbox takes the events of this chunk too
+            if not self._emit_lock.acquire(blocking=False):
+                break
+            try:
+                while self._outbox:
+                    event = self._outbox.popleft()
+                    for subscriber in self._subscribers:
+                        subscriber.put(event)
+            finally:
+                self._emit_lock.release()
+        for listener in self._listeners:
+            listener(data)
+
+    def _emit(self, event):
+        if not self._decoding:
+            super()._emit(event)
+            return
+        if self._pending_events is not None:
+            self._pending_events.append(event)
+        if self._subscribers:
+            self._outbox.append(event)
+
+    def add_listener(self, callback):
+        """ Call callback(data) with every raw chunk after it updated the state cache """
+        self._listeners = self._listeners + (callback,)
+
+    def remove_listener(self, callback):
+        self._listeners = tuple(l for l in self._listeners if l != callback)
+
+    def _state_changed(self):
+        with self._state_cond:
+            self._state_cond.notify_all()
+
+    def _write(self, data, priority=None, timeout=LYNC_SOCKET_TIMEOUT):
+        """ Queue raw frame data for the writer thread
+            :param priority: class from LYNC_PRIORITIES, by default background
+                             for queries and interactive for other commands
+            :param timeout: seconds to wait while the class is full, 0 from scheduler callbacks
+        """
+        if data is None:
+            return
+        if priority is None:
+            priority = write_priority(data)
+        with self._txlock:
+            if self._txt is None:
+                self._start_writer()
+            txq = self._txq
+        trace = current_trace() if self.tracer is not None else None
+        try:
+            txq.put((bytes(data), trace, time.monotonic() if trace else 0), priority,
+                    timeout=timeout)
+        except queue.Full:
+            _LOGGER.error("Send queue full, dropping %d %s bytes", len(data), priority)
+
+    def _start_writer(self):
+        self._txq = LyncSendQueue()
+        self._txt = threading.Thread(target=self.__writer, args=(self._txq,), daemon=True)
+        self._txt.start()
+
+    def _stop_writer(self):
+        """ Let the writer thread finish the queued frames and exit """
+        with self._txlock:
+            txt = self._txt
+            if txt is None:
+                return
+            self._txt = None
+            self._txq.close()
+        txt.join(LYNC_SOCKET_TIMEOUT)
+
+    def __writer(self, txq):
+        while True:
+            # the highest class is chosen only once the window has room
+            if self.flow is not None:
+                self.__wait_window()
+            item = txq.get()
+            if item is None:
+                break
+            (data, trace, queued) = item
+            if self.flow is None:
+                self.__send(data, trace, queued)
+                continue
+            # every command of a batch is admitted by the window for the replies it awaits
+            for (part, count) in self.__window_parts(data):
+                if count:
+                    self.__wait_window(count)
+                self.__send(part, trace, queued)
+
+    def __window_parts(self, data):
+        """ Split written data before every command awaiting replies
+            :return a list of (data, replies awaited by the command it starts with)
+        """
+        parts = []
+        (begin, count) = (0, 0)
+        offset = 0
+        for frame in split_tx_frames(data)[0]:
+            start = data.find(frame, offset)
+            offset = start + len(frame)
+            replies = len(self.__reply_zones(frame))
+            if replies:
+                if start > begin:
+                    parts.append((data[begin:start], count))
+                (begin, count) = (start, replies)
+        parts.append((data[begin:], count))
+        return parts
+
+    def __reply_zones(self, frame):
+        """ return the zones answering a command frame with a zone status """
+        if frame[3] not in LYNC_STATUS_CMDS:
+            return ()
+        zone = frame[2]
+        if zone == 0:
+            # only the installed zones answer, none are counted until they are known
+            mask = self._zone_mask or 0
+            return [zn for zn in range(1, LYNC_MAX_ZONES) if mask & (1 << zn)]
+        return (zone,)
+
+    def __send(self, data, trace, queued):
+        if self._trace is not None:
+            self._trace_tx(data)
+        if self._capture is not None:
+            self._capture.record(LYNC_CAPTURE_TX, data)
+        start = time.monotonic()
+        if trace is not None:
+            self.tracer.record(trace, 'queue', queued, start)
+        self._sent(data, trace, start)
+        try:
+            self._transport_write(data)
+        except Exception as e:
+            self.stats['tx_errors'] += 1
+            _LOGGER.error("Error writing to Lync: %s", e)
+        if trace is not None:
+            self.tracer.record(trace, 'write', start, time.monotonic(), bytes=len(data))
+
+    def __wait_window(self, count=1):
+        """ Block the writer until the flow window has room for a command awaiting count replies """
+        flow = self.flow
+        blocked = False
+        with self._flow_cond:
+            while True:
+                now = time.monotonic()
+                flow.errors(self.stats['checksum_errors'] + self.stats['resyncs'], now)
+                oldest = self.__expire_replies(now, flow.timeout())
+                if flow.can_send(self._in_flight, count):
+                    break
+                blocked = True
+                self._flow_cond.wait(oldest + flow.timeout() - now)
+        if blocked:
+            flow.stats['blocked'] += 1
+
+    def __expire_replies(self, now, timeout):
+        """ Drop the commands not answered within the timeout, called with _flow_cond held
+            :param return the time of the oldest command still awaiting its reply
+        """
+        oldest = now
+        for zone in list(self._awaiting):
+            pending = self._awaiting[zone]
+            while pending and now - pending[0][1] >= timeout:
+                pending.popleft()
+                self._in_flight -= 1
+                if self.flow is not None:
+                    self.flow.lost(now)
+            if pending:
+                oldest = min(oldest, pending[0][1])
+            else:
+                del self._awaiting[zone]
+        return oldest
+
+    def _sent(self, data, trace=None, start=None):
+        """ Count frames written to the controller and time the zone status replies """
+        frames = split_tx_frames(data)[0]
+        self.stats['tx_bytes'] += len(data)
+        self.stats['tx_frames'] += len(frames)
+        start = start if start is not None else time.monotonic()
+        with self._flow_cond:
+            if self.flow is None:
+                self.__expire_replies(start, LYNC_RTT_EXPIRE)
+            for frame in frames:
+                for zn in self.__reply_zones(frame):
+                    self._awaiting.setdefault(zn, collections.deque()).append((trace, start))
+                    self._in_flight += 1
+
+    def _status_received(self, zone):
+        """ match a zone status to the oldest command awaiting it """
+        now = time.monotonic()
+        with self._flow_cond:
+            pending = self._awaiting.get(zone)
+            if not pending:
+                return
+            (trace, start) = pending.popleft()
+            if not pending:
+                del self._awaiting[zone]
+            self._in_flight -= 1
+            if now - start > LYNC_RTT_EXPIRE:
+                # the reply to that write was lost, this status is unrelated
+                return
+            self._rtt.append(now - start)
+            if self.flow is not None:
+                self.flow.confirmed(now - start, now)
+                self._flow_cond.notify()
+        if trace is not None and self.tracer is not None:
+            self.tracer.record(trace, 'confirm', start, now, zone=zone)
+
+    def rtt(self):
+        """ return the count, percentiles and max of recent command round trips in seconds """
+        return percentiles(list(self._rtt))
+
+    def flow_stats(self):
+        """ return the flow control window, commands in flight and counters, or None """
+        if self.flow is None:
+            return None
+        with self._flow_cond:
+            return self.flow.metrics(self._in_flight)
+
+    def _connection_event(self, event, detail=None):
+        """ Add a transport event such as 'connected' or 'closed' to the connection log """
+        if event == 'connected':
+            self.stats['connects'] += 1
+        self.connection_log.append((time.time(), event, detail))
+
+    def create_send_message(self, cmd, zone_name, val=None):
+        trace = current_trace() if self.tracer is not None else None
+        if trace is None:
+            return super().create_send_message(cmd, zone_name, val)
+        start = time.monotonic()
+        frame = super().create_send_message(cmd, zone_name, val)
+        self.tracer.record(trace, 'encode', start, time.monotonic(), cmd=cmd)
+        return frame
+
+    def _transport_write(self, data):
+        """ write raw frame data to the transport, implemented by the transports """
+        raise NotImplementedError
+
+    def tx_pending(self, priority=None):
+        """ return the number of writes waiting for the writer thread
+            :param priority: only count the writes of this class and the classes above it
+        """
+        txq = self._txq
+        return txq.qsize(priority) if txq is not None else 0
+
+    def tx_latency(self):
+        """ return the percentiles of the seconds recent writes waited in the queue, per class """
+        txq = self._txq
+        return collections.OrderedDict((p, percentiles(list(txq.waits[p]) if txq is not None else []))
+                                       for p in LYNC_PRIORITIES)
+
+    def start_capture(self, path):
+        """ Record every raw RX and TX chunk to a binary capture file
+            :param path: capture file name, see lync.capture for the format
+        """
+        self.stop_capture()
+        self._capture = LyncCapture(path)
+        _LOGGER.info("Capturing wire data to %s", path)
+
+    def stop_capture(self):
+        """ Stop and close the current capture """
+        if self._capture is not None:
+            capture = self._capture
+            self._capture = None
+            capture.close()
+
+    def send_command(self, cmd, zone_name, val=None, priority=None):
+        """ send a single command
+            :param priority: class from LYNC_PRIORITIES, background for queries by default
+        """
+        self._write(self.create_send_message(cmd, zone_name, val), priority)
+
+    def refresh_zone(self, zone=0):
+        """ Ask the controller to send the state of a zone, or of all zones """
+        self.send_command('query all zones', self.zone_to_name(zone))
+
+    def update(self, zone='none'):
+        # Refetch the tables if they are not present
+        if not zone.lower() in self.zone_lookup:
+            self.init()
+
+    def init(self):
+        self.refresh_zone('all')
+        # Wait for the response to be processed
+        time.sleep(LYNC_REFRESH_TIMEOUT)
+
+    def set_power(self, zone, power):
+        self._write(super().set_power(zone,power))
+
+    def set_volume(self, zone, volume):
+        self._write(super().set_volume(zone,volume))
+
+    def set_source(self, zone, source):
+        self._write(super().set_source(zone,source))
+
+    def all_on_off(self, power):
+        self._write(super().all_on_off(power))
+
+    def set_mute(self, zone, mute):
+        self._write(super().set_mute(zone,mute))
+
+    def set_scene(self, scene, timeout=None):
+        """ Apply a scene as a single paced burst of frames
+        :param timeout: seconds to wait for the controller to confirm the scene or None
+        :param return True if the scene was sent, or confirmed when a timeout is given
+        """
+        # the reader thread checks the pending scene under the same lock
+        with self._lock:
+            frames = super().set_scene(scene)
+        self._write_batch(frames, 'automation')
+        if timeout is None:
+            return True
+        return self.wait_scene(timeout)
+
+    def ramp_volume(self, zones, volume, duration, curve='linear'):
+        """ Fade the volume of zones to a level over a duration
+        :param zones: a zone or a list of zones as 1 based numbers or names.
+        :param volume: the target as a 0-100 decimal.
+        :param duration: seconds the ramp takes.
+        :param curve: 'linear', 'ease-in', 'ease-out', 's-curve' or a function mapping 0..1 to 0..1
+        :param return the running LyncRamp to wait for, cancel or retarget
+        A zone which is already ramping is taken over from its previous ramp.
+        """
+        if isinstance(zones, (str, int)):
+            zones = (zones,)
+        zns = []
+        for zone in zones:
+            zn = self.zone_to_num(zone)
+            if zn == 0 or not self.zone_exists(zn):
+                _LOGGER.info("Zone %s can't be ramped", zone)
+                continue
+            zns.append(zn)
+        ramp = LyncRamp(self, zns, self.volume_to_db(volume), duration, curve)
+        for zn in zns:
+            previous = self._ramps.get(zn)
+            if previous is not None:
+                previous.release(zn)
+            self._ramps[zn] = ramp
+        ramp.start()
+        return ramp
+
+    def wait_scene(self, timeout=None):
+        """ Wait for the controller to confirm the last scene
+        :param return True when every zone reported the scene state
+        """
+        with self._state_cond:
+            return self._state_cond.wait_for(lambda: not self._scene_pending, timeout)
+
+    def _write_batch(self, frames, priority=None):
+        """ Write frames in bursts of LYNC_BATCH_FRAMES paced by the scheduler """
+        scheduler = get_scheduler()
+        for (n, i) in enumerate(range(0, len(frames), LYNC_BATCH_FRAMES)):
+            burst = b''.join(frames[i:i + LYNC_BATCH_FRAMES])
+            if n == 0:
+                self._write(burst, priority)
+            else:
+                # the shared scheduler thread must not wait for room in the queue
+                scheduler.call_later(n * LYNC_BATCH_PACING, self._write, burst, priority, 0)
+
 class LyncSerial(LyncBase):
     """class to operate the HTD lync serial API directly using the UART control port.
        This does not require the (W)GW-SL1 Valet capability"""
@@ -463,22 +1467,28 @@ class LyncSerial(LyncBase):
         self._tty=port
         self._baud=baud
         self._buf = bytearray() # initialized empty buffer
+        self._ser = None
+        self._wst = None
+        self._wst_run = False
         super().__init__()
 
     def connect(self, tty=None, baud=None):
         """ Connect to the serial port """
         self._tty = tty if tty is not None else self._tty
         self._baud = baud if baud is not None else self._baud
-        self._ser = serial.Serial(self._tty, self._baud)  # open serial port
-        self._ser.open()
-        if not self._ser.is_open:
-            _LOGGER.error("Error trying to open serial port %s", self._tty)
+        try:
+            # opens the port, the timeout lets the reader thread notice close
+            self._ser = serial.Serial(self._tty, self._baud, timeout=LYNC_SOCKET_TIMEOUT)
+        except serial.SerialException as e:
+            _LOGGER.error("Error trying to open serial port %s: %s", self._tty, e)
+            self._connection_event('connect failed', self._tty)
             return False
         self._wst = threading.Thread(target=self.__ser_run_forever)
         self._wst.daemon = True
         self._wst_run = True
         self._wst.start()
         _LOGGER.info("Successfully opened serial port %s", self._tty)
+        self._connection_event('connected', self._tty)
         return True
 
     def is_connected(self):
@@ -490,31 +1500,28 @@ class LyncSerial(LyncBase):
     def close(self):
         if self._ser is None:
             return 
+        self._wst_run = False
+        self._stop_writer()
+        if self._wst is not None and self._wst is not threading.current_thread():
+            self._wst.join(LYNC_SOCKET_TIMEOUT * 2)
         self._ser.close()
+        self._connection_event('closed', self._tty)
 
-    def set_power(self, zone, power):
-        self._ser.write(super().set_power(zone,power))
-
-    def set_volume(self, zone, volume):
-        self._ser.write(super().set_volume(zone,volume))
-
-    def set_source(self, zone, source):
-        self._ser.write(super().set_source(zone,source))
-
-    def all_on_off(self, power):
-        self._ser.write(super().all_on_off(power))
-
-    def set_mute(self, zone, mute):
-        self._ser.write(super().set_mute(zone,mute))
-
-    def __send_command(self, cmd, zone_name, val=None):
-        """ send a single command """
-        self._ser.write(super().send_command(cmd, zone_name, val))
+    def _transport_write(self, data):
+        """ write raw frame data to the serial port """
+        self._ser.write(data)
 
     def __ser_run_forever(self):
         self._buf = bytearray()
-        while True:
-            self._buf = self._ser.read()
+        while self._wst_run:
+            try:
+                data = self._ser.read(self._ser.in_waiting or 1)
+            except serial.SerialException as e:
+                _LOGGER.error("Error reading serial port %s: %s", self._tty, e)
+                break
+            if not data:
+                continue
+            self.process_data(data)
         _LOGGER.error("Exiting reader thread...")
 
     def __exit__(self, exception_type, exception_value, traceback):
@@ -522,7 +1529,7 @@ class LyncSerial(LyncBase):
         try:
             self._ser.close()
             _LOGGER.info("Closed connection to Lync %s", self._tty)
-        except self._ser.is_open:
+        except serial.SerialException:
             _LOGGER.error("Couldn't disconnect serial port")
 
 class LyncRemote(LyncBase):
@@ -535,15 +1542,22 @@ class LyncRemote(LyncBase):
         self._username=username
         self._password=password
         self._timeout = LYNC_SOCKET_TIMEOUT
-        self._lock = threading.Lock()   # Used to ensure only one thread sends commands
         self._buf = bytearray() # initialized empty buffer
         self._connecting = False
         self._ws = None
         self._wst = None
-        self._wst_run = False
+        # set to stop the websocket thread instead of reconnecting
+        self._wst_stop = threading.Event()
         self._ct = None
-        self._ct_run = False
+        self._opened = threading.Event()
+        # pooled http session reused for every login
+        self._session = requests.Session()
+        self._session.auth = requests.auth.HTTPBasicAuth(self._username, self._password)
+        self._auth_time = None
         super().__init__()
+        self.stats['login_count'] = 0
+        self.stats['login_skipped'] = 0
+        self.stats['login_time'] = None
 
     def connect(self, host=None, port=None):
         # wait for previous connection request to complete
@@ -557,45 +1571,68 @@ class LyncRemote(LyncBase):
 
         """ Connect to the GW-SL1 gatway """
         self._connecting = True
+        if host is not None and host != self._hostname:
+            # a login is only valid for the gateway it was made to
+            self._auth_time = None
         self._hostname = host if host is not None else self._hostname
         self._port = port if port is not None else self._port
         # Do the http basic auth
-        r = requests.get('http://' + self._hostname + '/login.cgi', 
-                              auth=requests.auth.HTTPBasicAuth(self._username, self._password))
-        if r.status_code != requests.codes.ok:
-            _LOGGER.error("Error trying to authenticate to HTD controller.")
-            _LOGGER.error(r.status_code)
+        if not self.__login():
+            self._connection_event('login failed', self._hostname)
             self._connecting = False
             return False
-        _LOGGER.info("Successfully authenticated to HTD Lync at %s", self._hostname)
 
         # open the websocket and run in a thread
+        self._opened.clear()
         self._ws = websocket.WebSocketApp('ws://' + self._hostname + ':' + str(self._port) + '/',
+                              on_open = self.__on_open,
                               on_message = self.__on_message,
                               on_error = self.__on_error,
                               on_close = self.__on_close)
         self._wst = threading.Thread(target=self.__ws_run_forever)
         self._wst.daemon = True
-        self._wst_run = True
+        self._wst_stop.clear()
         self._wst.start()
 
-        timeout = LYNC_WS_CONNECT_TIMEOUT
-        while (self._ws.sock is None or not self._ws.sock.connected) and timeout:
-            time.sleep(1)
-            timeout -= 1
-
-        if timeout == 0:
+        if not self._opened.wait(LYNC_WS_CONNECT_TIMEOUT):
             _LOGGER.error("Error trying to connect to Lync websocket.")
-            _LOGGER.error(self._ws.sock.status)
-            self._wst_run = False
+            self._connection_event('connect failed', self._hostname)
+            # the login may have expired on the gateway
+            self._auth_time = None
+            self._wst_stop.set()
+            self._ws.close()
             self._connecting = False
             return False
         _LOGGER.info("Successfully connected to HTD Lync on %s:%s", self._hostname, self._port)
+        self._connection_event('connected', '%s:%s' % (self._hostname, self._port))
 
         # Set connected state
         self._connecting = False
         return True
 
+    def __login(self):
+        """ Authenticate to the gateway unless the last login is still valid """
+        if self._auth_time is not None and time.monotonic() - self._auth_time < LYNC_AUTH_VALID:
+            self.stats['login_skipped'] += 1
+            return True
+        start = time.monotonic()
+        try:
+            r = self._session.get('http://' + self._hostname + '/login.cgi',
+                                  timeout=LYNC_HTTP_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            _LOGGER.error("Error trying to authenticate to HTD controller: %s", e)
+            return False
+        self.stats['login_time'] = time.monotonic() - start
+        self.stats['login_count'] += 1
+        if r.status_code != requests.codes.ok:
+            _LOGGER.error("Error trying to authenticate to HTD controller.")
+            _LOGGER.error(r.status_code)
+            return False
+        self._auth_time = time.monotonic()
+        _LOGGER.info("Successfully authenticated to HTD Lync at %s in %.3fs",
+                     self._hostname, self.stats['login_time'])
+        return True
+
     def is_connected(self):
         """ Check we are connected """
         if self._ws is None or self._ws.sock is None:
@@ -605,104 +1642,70 @@ class LyncRemote(LyncBase):
 
     def close(self, delay=0):
         # Reset timer if already running
-        if self._ct_run:
-            self._ct_delay = delay
+        if self._ct is not None and self._ct.active():
+            self._ct.reschedule(delay)
             return True
         # Start a new timer to close
         _LOGGER.info("Starting close timer for %s seconds", delay)
-        self._ct = threading.Thread(target=self.__close_timer, daemon=True)
-        self._ct_delay = delay
-        self._ct_run = True
-        self._ct.start()
+        self._ct = get_scheduler().call_later(delay, self.__start_close)
         return True
 
-    def __close_timer(self):
-        while(self._ct_run and self._ct_delay > 0):
-            time.sleep(1)
-            self._ct_delay -= 1
-        if self._ct_run:
-            self._ct_run = False
-            self.__close()
+    def __start_close(self):
+        # closing the websocket can take seconds, keep it off the shared scheduler thread
+        threading.Thread(target=self.__close, daemon=True, name='lync-close').start()
 
     def __close(self):
         if self._ws is None:
             return 
         try:
-            self._wst_run = False
+            self._wst_stop.set()
+            self._stop_writer()
             self._ws.close()
-            self._wst.join()
+            self._wst.join(LYNC_WS_CONNECT_TIMEOUT)
             _LOGGER.info("Closed connection to Lync GW on %s:%s", self._hostname, self._port)
         except self._ws.socket.error as msg:
             _LOGGER.error("Couldn't disconnect")
             _LOGGER.error(msg)
 
-    def refresh_zone(self, zone=0):
-        # Call a thread to refresh the state
-        # Set longer timeout for multiple responses
-        zn = super().zone_to_name(zone)
-        if zn == 'all':
-            orig = self._timeout
-            self._timeout = LYNC_REFRESH_TIMEOUT;
-            self.__send_command('query all zones', zn)
-            self._timeout = orig
-        else:
-            self.__send_command('query all zones', zn)
-
-    def update(self, zone='none'):
-        # Refetch the tables if they are not present
-        if not zone.lower() in self.zone_lookup:
-            self.init()
-
-    def init(self):
-        self.refresh_zone('all')
-        # Wait for the response to be processed
-        time.sleep(3)
-        #_LOGGER.debug("%s", self.zone_info)
-
-    def set_power(self, zone, power):
-        self._ws.send(super().set_power(zone,power))
-
-    def set_volume(self, zone, volume):
-        self._ws.send(super().set_volume(zone,volume))
-
-    def set_source(self, zone, source):
-        self._ws.send(super().set_source(zone,source))
-
-    def all_on_off(self, power):
-        self._ws.send(super().all_on_off(power))
-
-    def set_mute(self, zone, mute):
-        self._ws.send(super().set_mute(zone,mute))
+    def _transport_write(self, data):
+        """ write raw frame data to the gateway """
+        self._ws.send(data)
 
     # Websocket command handlers
     def __on_message(self, ws, message):
-        self._buf.extend(message)
-        while True:
-            # process one command from the byte stream and pop it off
-            frame_len = super().process_command(self._buf)
-            if frame_len <= 0:
-                break
-            del self._buf[0:frame_len]
+        self.process_data(message)
+
+    def __on_open(self, ws):
+        self._opened.set()
 
     def __on_error(self, ws, error):
         _LOGGER.info("WS error %s", error)
+        self._connection_event('error', str(error))
     
     def __on_close(self, ws, status, msg):
         _LOGGER.info("WS closed with: %s", msg)
+        self._connection_event('closed', msg)
 
     def __ws_run_forever(self):
-        while self._wst_run:
+        delay = LYNC_RECONNECT_DELAY
+        while not self._wst_stop.is_set():
+            self._opened.clear()
             self._ws.run_forever()
+            if self._wst_stop.is_set():
+                break
+            # back off while the gateway can't be reached, promptly after a working connection
+            if self._opened.is_set():
+                delay = LYNC_RECONNECT_DELAY
+            _LOGGER.info("Reconnecting to Lync GW in %.1f seconds", delay)
+            self._connection_event('reconnecting', '%.1fs' % delay)
+            self._wst_stop.wait(delay)
+            delay = min(delay * 2, LYNC_RECONNECT_MAX_DELAY)
         _LOGGER.error("Exiting WS thread...")
 
-    def __send_command(self, cmd, zone_name, val=None):
-        """ send a single command """
-        self._ws.send(super().create_send_message(cmd, zone_name, val))
-
     def __exit__(self, exception_type, exception_value, traceback):
         """ Close connection to gateway """
         try:
-            self._wst_run = False
+            self._wst_stop.set()
             self._ws.close()
             _LOGGER.info("Closed connection to Lync GW on %s:%s", self._hostname, self._port)
         except self._ws.socket.error as msg:
@@ -0,0 +1,238 @@
+"""
+Local multiplexing proxy for the HTD Lync.
+
+LyncProxy holds the only connection to the controller and keeps the state
+cache.  Local clients connect to a Unix socket and speak the plain Lync serial
+protocol:
+
+* on connect a client receives frames reproducing the cached state
+* 'query all zones' requests are answered from the cache
+* every other command is forwarded through the upstream writer queue, so the
+  writes of all clients are sent in one order
+* every chunk received from the controller is forwarded to all clients
+
+LyncProxyClient is a drop in replacement for LyncRemote which talks to the
+proxy, so the existing bridges can share one gateway connection.
+
+Run a proxy for a gateway with:  python -m lync.proxy <gateway host>
+"""
+
+import argparse
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+
+from .lync import LyncBase, LyncRemote, LYNC_TX_CMDS, split_tx_frames
+
+# Default path of the proxy socket
+LYNC_PROXY_SOCKET = '/tmp/lync.sock'
+# Chunks buffered for a client before it is disconnected as too slow
+LYNC_PROXY_CLIENT_QUEUE = 256
+# Command ids answered from the cache
+LYNC_PROXY_QUERY_IDS = (0x05, LYNC_TX_CMDS['query all zones'][0])
+
+_LOGGER = logging.getLogger(__name__)
+
+class _LyncProxyHandler(socketserver.BaseRequestHandler):
+    """ one connected client """
+    def setup(self):
+        self._txq = queue.Queue(LYNC_PROXY_CLIENT_QUEUE)
+        self._sender = threading.Thread(target=self.__send_forever, daemon=True)
+        self._sender.start()
+
+    def handle(self):
+        proxy = self.server.proxy
+        upstream = proxy.upstream
+        # send the cached state before any live data
+        proxy._add_client(self)
+        buf = bytearray()
+        while True:
+            try:
+                data = self.request.recv(4096)
+            except OSError:
+                break
+            if not data:
+                break
+            buf.extend(data)
+            (frames, used) = split_tx_frames(buf)
+            del buf[0:used]
+            for frame in frames:
+                if frame[3] in LYNC_PROXY_QUERY_IDS:
+                    zone = frame[2]
+                    self.push(upstream.state_frames('all' if zone == 0 else zone))
+                else:
+                    upstream._write(frame)
+
+    def finish(self):
+        self.server.proxy._remove_client(self)
+        self._txq.put(None)
+
+    def push(self, data):
+        """ queue data for the client, drop the client if it is not keeping up """
+        try:
+            self._txq.put_nowait(data)
+        except queue.Full:
+            _LOGGER.warning("Proxy client too slow, disconnecting")
+            try:
+                self.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __send_forever(self):
+        while True:
+            data = self._txq.get()
+            if data is None:
+                break
+            try:
+                self.request.sendall(data)
+            except OSError:
+                break
+
+class LyncProxy:
+    """ share one upstream Lync connection with local clients over a Unix socket """
+    def __init__(self, upstream, path=LYNC_PROXY_SOCKET):
+        self.upstream = upstream
+        self._path = path
+        self._clients = ()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """ Start serving clients, the upstream must already be connected """
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        self._server = socketserver.ThreadingUnixStreamServer(self._path, _LyncProxyHandler)
+        self._server.daemon_threads = True
+        self._server.proxy = self
+        self.upstream.add_listener(self.__on_upstream)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        _LOGGER.info("Lync proxy listening on %s", self._path)
+
+    def stop(self):
+        if self._server is None:
+            return
+        self.upstream.remove_listener(self.__on_upstream)
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        os.unlink(self._path)
+
+    def client_count(self):
+        return len(self._clients)
+
+    def _add_client(self, client):
+        # the state frames are built and queued under the lock, a chunk decoded before is
+        # in them and a chunk decoded after is forwarded once the client is added
+        with self._lock:
+            client.push(self.upstream.state_frames())
+            self._clients = self._clients + (client,)
+
+    def _remove_client(self, client):
+        with self._lock:
+            self._clients = tuple(c for c in self._clients if c is not client)
+
+    def __on_upstream(self, data):
+        data = bytes(data)
+        with self._lock:
+            for client in self._clients:
+                client.push(data)
+
+class LyncProxyClient(LyncBase):
+    """ class to operate the HTD lync through a local LyncProxy """
+    def __init__(self, path=LYNC_PROXY_SOCKET):
+        self._path = path
+        self._sock = None
+        self._rdt = None
+        super().__init__()
+
+    def connect(self, path=None):
+        """ Connect to the proxy socket """
+        if self.is_connected():
+            return True
+        self._path = path if path is not None else self._path
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._path)
+        except OSError as e:
+            _LOGGER.error("Error trying to connect to Lync proxy %s: %s", self._path, e)
+            self._connection_event('connect failed', str(e))
+            sock.close()
+            return False
+        self._sock = sock
+        self._rdt = threading.Thread(target=self.__read_forever, args=(sock,), daemon=True)
+        self._rdt.start()
+        _LOGGER.info("Connected to Lync proxy %s", self._path)
+        self._connection_event('connected', self._path)
+        return True
+
+    def is_connected(self):
+        return self._sock is not None
+
+    def close(self, delay=0):
+        """ The proxy keeps the gateway connection, the local socket is kept open """
+        return True
+
+    def disconnect(self):
+        if self._sock is None:
+            return
+        self._stop_writer()
+        sock = self._sock
+        self._sock = None
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    def update(self, zone='none'):
+        # the proxy sends its cached state on connect
+        pass
+
+    def init(self):
+        self.refresh_zone('all')
+
+    def _transport_write(self, data):
+        """ write raw frame data to the proxy """
+        self._sock.sendall(data)
+
+    def __read_forever(self, sock):
+        while True:
+            try:
+                data = sock.recv(4096)
+            except OSError:
+                break
+            if not data:
+                break
+            self.process_data(data)
+        if self._sock is sock:
+            self._sock = None
+        _LOGGER.info("Lync proxy connection closed")
+        self._connection_event('closed', self._path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Share one HTD Lync gateway connection")
+    parser.add_argument('host', help="GW-SL1 gateway host name or address")
+    parser.add_argument('--port', default='8000', help="gateway websocket port")
+    parser.add_argument('--socket', default=LYNC_PROXY_SOCKET, help="proxy socket path")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    upstream = LyncRemote(args.host, args.port)
+    if not upstream.connect():
+        return 1
+    upstream.init()
+    proxy = LyncProxy(upstream, args.socket)
+    proxy.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    proxy.stop()
+    return 0
+
+if __name__ == '__main__':
+    main()
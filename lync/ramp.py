@@ -0,0 +1,180 @@
+"""
+Timed volume ramps for the Lync clients.
+
+A LyncRamp moves the volume of one or more zones to a target level over a
+duration.  The level of every zone at every step is computed up front from
+the curve, and the frame for each level is built once, so a step only joins
+prebuilt frames.  The frames of all zones of a step go out as one write.
+
+Steps are run by the shared scheduler at time.monotonic() deadlines and are
+written as automation traffic.  When a step runs late the ramp jumps to the
+step that is due, and while interactive or automation writes are still
+waiting for the link a step is dropped, except the last one, so a saturated
+link only loses intermediate levels.
+"""
+
+import logging
+import threading
+import time
+
+from .scheduler import get_scheduler
+
+__all__ = ['LyncRamp', 'LYNC_RAMP_STEP', 'LYNC_RAMP_BACKLOG', 'LYNC_RAMP_CURVES']
+
+# Seconds between ramp steps
+LYNC_RAMP_STEP = 0.05
+# Writes waiting for the link before a ramp step is dropped
+LYNC_RAMP_BACKLOG = 1
+
+LYNC_RAMP_CURVES = {
+    'linear' : lambda t: t,
+    'ease-in' : lambda t: t * t,
+    'ease-out' : lambda t: 1 - (1 - t) * (1 - t),
+    's-curve' : lambda t: t * t * (3 - 2 * t),
+    }
+
+_LOGGER = logging.getLogger(__name__)
+
+class LyncRamp:
+    """ volume ramp of one or more zones, see LyncBase.ramp_volume
+        :param lync: the LyncBase writing the frames
+        :param zones: zone numbers to ramp
+        :param level: target volume in controller units, -60 to 0
+        :param duration: seconds the ramp takes
+        :param curve: name from LYNC_RAMP_CURVES or a function mapping 0..1 to 0..1
+        :param step: seconds between steps
+    """
+    def __init__(self, lync, zones, level, duration, curve='linear', step=LYNC_RAMP_STEP):
+        self._lync = lync
+        self._step = step
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._timer = None
+        self._frames = {}
+        self.stats = { 'steps' : 0,
+                       'skipped' : 0,
+                       'dropped' : 0 }
+        snap = lync.snapshot()
+        # last level written for each zone
+        self._sent = { zn : snap.zones[zn]['volume'] for zn in zones }
+        self.__plan(level, duration, curve)
+
+    @property
+    def zones(self):
+        return tuple(self._sent)
+
+    def __plan(self, level, duration, curve):
+        """ compute the levels of every step from the levels last sent, called with the lock held """
+        if not callable(curve):
+            curve = LYNC_RAMP_CURVES[curve]
+        count = max(1, int(round(duration / self._step)))
+        start = dict(self._sent)
+        steps = []
+        last = start
+        for k in range(1, count + 1):
+            fraction = curve(k / count)
+            levels = { zn : int(round(begin + (level - begin) * fraction))
+                       for (zn, begin) in start.items() }
+            if levels == last and k < count:
+                continue
+            steps.append((k * self._step, levels))
+            last = levels
+            for zn_level in levels.items():
+                if zn_level not in self._frames:
+                    self._frames[zn_level] = self.__frame(*zn_level)
+        self.level = level
+        self._steps = steps
+        self._index = 0
+        self._start = time.monotonic()
+
+    def __frame(self, zone, level):
+        lync = self._lync
+        arg = lync.encode_args('volume setting control', level)
+        return bytes(lync.build_frame('volume setting control', zone, arg))
+
+    def start(self):
+        """ Start stepping, the first step is written one step interval from now """
+        with self._lock:
+            self._done.clear()
+            self.__schedule()
+
+    def cancel(self):
+        """ Stop the ramp at the level reached """
+        with self._lock:
+            self.__finish()
+
+    def retarget(self, volume, duration=None, curve='linear'):
+        """ Ramp from the level reached to a new target
+            :param volume: the new target as a 0-100 decimal
+            :param duration: seconds from now, by default the time the ramp had left
+        """
+        with self._lock:
+            if duration is None:
+                remaining = self._steps[-1][0] if self._steps else 0
+                duration = max(0, self._start + remaining - time.monotonic())
+            if self._timer is not None:
+                self._timer.cancel()
+            self.__plan(self._lync.volume_to_db(volume), duration, curve)
+            self._done.clear()
+            self.__schedule()
+
+    def release(self, zone):
+        """ Stop ramping a zone, the ramp is cancelled when no zone is left """
+        with self._lock:
+            self._sent.pop(zone, None)
+            if not self._sent:
+                self.__finish()
+
+    def active(self):
+        return not self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ Wait for the last step to be written
+            :param return True when the ramp finished or was cancelled
+        """
+        return self._done.wait(timeout)
+
+    def __finish(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._steps = []
+        self._done.set()
+
+    def __schedule(self):
+        if self._index >= len(self._steps):
+            self.__finish()
+            return
+        deadline = self._start + self._steps[self._index][0]
+        self._timer = get_scheduler().call_at(deadline, self.__run)
+
+    def __run(self):
+        with self._lock:
+            if self._done.is_set():
+                return
+            steps = self._steps
+            elapsed = time.monotonic() - self._start
+            # jump to the latest step which is due
+            index = self._index
+            while index + 1 < len(steps) and steps[index + 1][0] <= elapsed:
+                index += 1
+            self.stats['skipped'] += index - self._index
+            self._index = index + 1
+            last = self._index == len(steps)
+            if not last and self._lync.tx_pending('automation') > LYNC_RAMP_BACKLOG:
+                self.stats['dropped'] += 1
+            else:
+                self.__write(steps[index][1])
+            self.__schedule()
+
+    def __write(self, levels):
+        burst = []
+        for (zn, level) in levels.items():
+            # zones released since the step was computed are left alone
+            if zn in self._sent and self._sent[zn] != level:
+                burst.append(self._frames[(zn, level)])
+                self._sent[zn] = level
+        if burst:
+            self.stats['steps'] += 1
+            # runs on the shared scheduler thread, which must not wait for room in the queue
+            self._lync._write(b''.join(burst), 'automation', 0)
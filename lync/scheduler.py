@@ -0,0 +1,134 @@
+"""
+Single thread timer scheduler shared by the Lync clients.
+
+Deferred work such as idle close, paced writes and debounced actions is kept in
+one heap ordered by time.monotonic() deadlines and run from one daemon thread,
+instead of a sleeping thread per timer.  Moving a timer to a later deadline,
+the common case for idle timers, only updates the timer; its heap entry is
+pushed back when it comes due.
+
+Callbacks share the thread and must not block: writes from them don't wait
+for room in the send queue, and work which can take seconds, such as closing
+a websocket, is handed to a thread of its own.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+__all__ = ['LyncScheduler', 'LyncTimer', 'get_scheduler']
+
+_LOGGER = logging.getLogger(__name__)
+
+class LyncTimer:
+    """ handle to a scheduled callback """
+    def __init__(self, scheduler, deadline, callback, args):
+        self._scheduler = scheduler
+        self._deadline = deadline
+        self._callback = callback
+        self._args = args
+        self._cancelled = False
+        self._done = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def reschedule(self, delay):
+        """ Move the timer to delay seconds from now, also restarts a finished timer """
+        self._scheduler._reschedule(self, time.monotonic() + delay)
+
+    def active(self):
+        """ return True while the callback is still to run """
+        return not (self._cancelled or self._done)
+
+    def remaining(self):
+        """ return the seconds until the callback runs """
+        return max(0.0, self._deadline - time.monotonic())
+
+class LyncScheduler:
+    """ heap based timer loop running on one daemon thread """
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def call_later(self, delay, callback, *args):
+        """ Run callback(*args) on the scheduler thread after delay seconds
+            :return a LyncTimer to cancel or reschedule the call
+        """
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def call_at(self, deadline, callback, *args):
+        """ Run callback(*args) at a time.monotonic() deadline """
+        timer = LyncTimer(self, deadline, callback, args)
+        with self._cond:
+            self._push(timer, deadline)
+        return timer
+
+    def _reschedule(self, timer, deadline):
+        with self._cond:
+            pushed = timer._deadline
+            timer._deadline = deadline
+            if timer._done or timer._cancelled:
+                # the heap entry may already have been discarded
+                timer._done = False
+                timer._cancelled = False
+                self._push(timer, deadline)
+            elif deadline < pushed:
+                # the existing entry is too late, it is skipped when it comes due
+                self._push(timer, deadline)
+
+    def _push(self, timer, deadline):
+        heapq.heappush(self._heap, (deadline, next(self._seq), timer))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.__run, daemon=True,
+                                            name='lync-scheduler')
+            self._thread.start()
+        if self._heap[0][2] is timer:
+            self._cond.notify()
+
+    def __run(self):
+        while True:
+            with self._cond:
+                timer = self.__next_due()
+            try:
+                timer._callback(*timer._args)
+            except Exception:
+                _LOGGER.exception("Error in scheduled callback %s", timer._callback)
+
+    def __next_due(self):
+        """ wait for and return the next timer to run, called with the lock held """
+        while True:
+            if not self._heap:
+                self._cond.wait()
+                continue
+            (deadline, seq, timer) = self._heap[0]
+            if timer._cancelled or timer._done or timer._deadline < deadline:
+                # cancelled, finished or superseded by an earlier entry
+                heapq.heappop(self._heap)
+                continue
+            if timer._deadline > deadline:
+                # postponed, move the entry to the new deadline
+                heapq.heapreplace(self._heap, (timer._deadline, next(self._seq), timer))
+                continue
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self._cond.wait(delay)
+                continue
+            heapq.heappop(self._heap)
+            timer._done = True
+            return timer
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    """ return the scheduler shared by all Lync clients """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = LyncScheduler()
+        return _scheduler
@@ -0,0 +1,216 @@
+"""
+Simulated HTD Lync controller.
+
+LyncSimulator is sans-IO like LyncProtocol: command bytes go in through
+receive_data and the frames the controller answers with come out.  The
+simulated state is kept by a LyncProtocol fed with those answers, so the
+simulator and the clients share one decoder and one encoder.
+
+LyncSimulatorClient is a LyncBase transport connected to a simulator, for
+tests and benchmarks without hardware.  Given a buffer and a rate it also
+models the GW-SL1 gateway, which serves the commands to the controller at a
+fixed rate and drops the commands written while its buffer is full.
+"""
+
+import logging
+import time
+
+from .lync import LyncBase, LyncProtocol, LYNC_TX_CMDS, LYNC_MAX_ZONES, split_tx_frames
+from .scheduler import get_scheduler
+
+__all__ = ['LyncSimulator', 'LyncSimulatorClient', 'LYNC_SIM_ZONES', 'LYNC_SIM_SOURCES',
+           'LYNC_SIM_RANGES', 'LYNC_SIM_GATEWAY_RATE']
+
+# Zones and sources of the default simulated controller
+LYNC_SIM_ZONES = 6
+LYNC_SIM_SOURCES = 6
+# Range of the zone settings in controller units
+LYNC_SIM_RANGES = { 'volume' : (-60, 0),
+                    'treble' : (-10, 10),
+                    'bass' : (-10, 10),
+                    'balance' : (-18, 18) }
+# Commands per second the simulated gateway passes to the controller
+LYNC_SIM_GATEWAY_RATE = 200
+
+# setting command id to zone info key
+_SETTINGS = { LYNC_TX_CMDS[key + ' setting control'][0] : key for key in LYNC_SIM_RANGES }
+# 'zone' command argument byte to argument name
+_ZONE_ARGS = { value : name for (name, value) in LYNC_TX_CMDS['zone'][2].items() }
+_ZONE_CMD = LYNC_TX_CMDS['zone'][0]
+_ZONE_NAME_CMD = LYNC_TX_CMDS['zone name'][0]
+_QUERY_IDS = (0x05, LYNC_TX_CMDS['query all zones'][0],
+              LYNC_TX_CMDS['query zone name'][0], LYNC_TX_CMDS['query zone source name'][0])
+
+_LOGGER = logging.getLogger(__name__)
+
+class LyncSimulator:
+    """ sans-IO model of a Lync controller
+        :param zones: number of installed zones, numbered from 1
+        :param sources: number of sources of every zone, numbered from 1
+    """
+    def __init__(self, zones=LYNC_SIM_ZONES, sources=LYNC_SIM_SOURCES):
+        self.state = LyncProtocol()
+        self._buf = bytearray()
+        self.stats = { 'commands' : 0,
+                       'checksum_errors' : 0,
+                       'ignored' : 0 }
+        self.state.process_data(self.__initial(min(zones, LYNC_MAX_ZONES - 1), sources))
+
+    def __initial(self, zones, sources):
+        state = self.state
+        # every installed zone has a keypad
+        mask = (1 << (zones + 1)) - 2
+        bits = [mask & 0xff, mask & 0xff, mask >> 8, mask >> 8]
+        frames = bytearray(state.build_rx_frame(0, 0x06, bytes([0] + bits + [0] * 4)))
+        for zn in range(1, zones + 1):
+            frames.extend(state.build_rx_frame(zn, 0x0D, ('zone%d' % zn).encode().ljust(13, b'\0')))
+            for source in range(1, sources + 1):
+                data = bytearray(('source%d' % source).encode().ljust(13, b'\0'))
+                data[11] = source
+                frames.extend(state.build_rx_frame(zn, 0x0E, data))
+            info = dict(state.zone_info[zn], source=1, volume=-40)
+            frames.extend(state.status_frame(zn, info))
+        return frames
+
+    def receive_data(self, data):
+        """ Process command bytes sent to the controller
+            :param data: bytes of command frames, frames may be split anywhere
+            :return the bytes the controller sends in reply
+        """
+        self._buf.extend(data)
+        (frames, used) = split_tx_frames(self._buf)
+        del self._buf[0:used]
+        reply = bytearray()
+        for frame in frames:
+            reply.extend(self.__command(frame))
+        return bytes(reply)
+
+    def __command(self, frame):
+        if sum(frame[:-1]) & 0xff != frame[-1]:
+            self.stats['checksum_errors'] += 1
+            return b''
+        self.stats['commands'] += 1
+        zone = frame[2]
+        cmd_id = frame[3]
+        arg = frame[4:-1]
+        if zone != 0 and not self.state.zone_exists(zone):
+            # the controller does not answer for zones which are not installed
+            self.stats['ignored'] += 1
+            return b''
+        if cmd_id in _QUERY_IDS:
+            return self.state.state_frames('all' if zone == 0 else zone)
+        if cmd_id == _ZONE_CMD:
+            return self.__zone_command(zone, _ZONE_ARGS.get(arg[0]))
+        if cmd_id in _SETTINGS:
+            key = _SETTINGS[cmd_id]
+            (offset, scale) = LYNC_TX_CMDS[key + ' setting control'][2]
+            (low, high) = LYNC_SIM_RANGES[key]
+            value = min(max(arg[0] + offset - scale, low), high)
+            return self.__update(self.__zones(zone), { key : value })
+        if cmd_id == _ZONE_NAME_CMD:
+            name = bytes(arg[0:11]).rstrip(b'\0')
+            reply = self.state.build_rx_frame(zone, 0x0D, name.ljust(13, b'\0'))
+            self.state.process_data(reply)
+            return reply
+        self.stats['ignored'] += 1
+        return b''
+
+    def __zone_command(self, zone, name):
+        if name is None or name == 'intercom':
+            self.stats['ignored'] += 1
+            return b''
+        if name.startswith('all '):
+            return self.__update(self.state.active_zones(), { 'power' : name[4:] })
+        if name.startswith('input'):
+            return self.__update(self.__zones(zone), { 'source' : int(name[5:]) })
+        (key, value) = name.split(' ')
+        return self.__update(self.__zones(zone), { key : value })
+
+    def __zones(self, zone):
+        return self.state.active_zones() if zone == 0 else (zone,)
+
+    def __update(self, zones, changes):
+        """ apply changes to zones and return the status frames the controller sends """
+        state = self.state
+        reply = bytearray()
+        for zn in zones:
+            info = dict(state.snapshot().zones[zn])
+            info.update(changes)
+            reply.extend(state.status_frame(zn, info))
+        state.process_data(reply)
+        return reply
+
+class LyncSimulatorClient(LyncBase):
+    """ class to operate a LyncSimulator as if it were a connected controller
+        :param simulator: the simulated controller, a new default one if None
+        :param latency: seconds before the simulator replies are received
+        :param buffer: commands the simulated gateway holds, None for no gateway
+        :param rate: commands per second the simulated gateway passes to the controller
+    """
+    def __init__(self, simulator=None, latency=0, buffer=None, rate=LYNC_SIM_GATEWAY_RATE):
+        self.simulator = simulator if simulator is not None else LyncSimulator()
+        self._latency = latency
+        self._buffer = buffer
+        self._rate = rate
+        # time.monotonic() at which the gateway has passed on every buffered command
+        self._gateway_free = 0
+        self._connected = False
+        self._ct = None
+        super().__init__()
+        self.stats['gateway_dropped'] = 0
+
+    def connect(self):
+        self._connected = True
+        self._connection_event('connected', 'simulator')
+        return True
+
+    def is_connected(self):
+        return self._connected
+
+    def close(self, delay=0):
+        if self._ct is not None and self._ct.active():
+            self._ct.reschedule(delay)
+            return True
+        self._ct = get_scheduler().call_later(delay, self.__close)
+        return True
+
+    def __close(self):
+        self._connected = False
+        self._stop_writer()
+        self._connection_event('closed', 'simulator')
+
+    def init(self):
+        # the simulator answers at once
+        self.process_data(self.simulator.receive_data(
+            self.build_frame('query all zones', 0)))
+
+    def _transport_write(self, data):
+        """ write raw frame data to the simulator """
+        if not self._connected:
+            raise ConnectionError("Simulator is not connected")
+        if self._buffer is not None:
+            self.__gateway_write(data)
+            return
+        reply = self.simulator.receive_data(data)
+        if not reply:
+            return
+        if self._latency:
+            get_scheduler().call_later(self._latency, self.process_data, reply)
+        else:
+            self.process_data(reply)
+
+    def __gateway_write(self, data):
+        """ queue the frames in the simulated gateway, dropping them while it is full """
+        now = time.monotonic()
+        for frame in split_tx_frames(data)[0]:
+            free = max(self._gateway_free, now)
+            if (free - now) * self._rate >= self._buffer:
+                self.stats['gateway_dropped'] += 1
+                continue
+            self._gateway_free = free + 1 / self._rate
+            get_scheduler().call_at(self._gateway_free + self._latency, self.__gateway_reply, frame)
+
+    def __gateway_reply(self, frame):
+        reply = self.simulator.receive_data(frame)
+        if reply:
+            self.process_data(reply)
@@ -0,0 +1,237 @@
+"""
+Soak test of the Lync client against the simulated controller.
+
+    python -m lync.soak [--days 7] [--seed 0] [--json]
+
+Runs days of traffic in accelerated time through a LyncSimulatorClient:
+commands, refreshes, zone and source renames, scenes, volume ramps, event
+subscriptions and disconnects, at the daily rates of LYNC_SOAK_DAY.  After
+every simulated hour it samples:
+
+    rss             resident set size of the process
+    traced          bytes allocated by Python, from tracemalloc
+    threads         live threads
+    the others      sizes of the client's buffers, tables and queues
+
+The first LYNC_SOAK_WARMUP of the samples are skipped.  A metric fails when
+its mean over the second half of the remaining samples exceeds the mean of
+the first half by more than its allowance.  The lines which allocated the
+most memory since the warm up are reported from tracemalloc, and the exit
+status is 1 when any metric grew.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+from .scheduler import get_scheduler
+from .simulator import LyncSimulatorClient
+
+# Simulated days of the default run
+LYNC_SOAK_DAYS = 7
+# Operations of one simulated day
+LYNC_SOAK_DAY = { 'command' : 1000,
+                  'refresh' : 288,
+                  'rename' : 4,
+                  'scene' : 20,
+                  'ramp' : 10,
+                  'subscribe' : 10,
+                  'disconnect' : 2 }
+# Fraction of the samples skipped while caches fill
+LYNC_SOAK_WARMUP = 0.25
+# Growth allowed from the first to the second half as (absolute, fraction of the first half)
+LYNC_SOAK_ALLOWANCE = { 'rss' : (2 << 20, 0.05),
+                        'traced' : (256 << 10, 0.05),
+                        'rx_buffer' : (16, 0) }
+LYNC_SOAK_DEFAULT_ALLOWANCE = (1, 0)
+# Allocation differences reported from tracemalloc
+LYNC_SOAK_TOP = 10
+
+def _rss():
+    """ return the resident set size in bytes, or None where it can't be read """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _allocations():
+    """ return a tracemalloc snapshot without the allocations of the soak test itself """
+    return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, __file__),
+                                                      tracemalloc.Filter(False, tracemalloc.__file__)))
+
+def _traced():
+    """ return the bytes allocated by Python outside the soak test, or None when not tracing """
+    if not tracemalloc.is_tracing():
+        return None
+    return sum(stat.size for stat in _allocations().statistics('filename'))
+
+def sample(lync):
+    """ return the memory, thread and buffer metrics of a process running a client """
+    metrics = { 'rss' : _rss(),
+                'traced' : _traced(),
+                'threads' : threading.active_count(),
+                'timers' : len(get_scheduler()._heap),
+                'rx_buffer' : len(lync._buf),
+                'tx_queue' : lync.tx_pending(),
+                'in_flight' : lync._in_flight,
+                'zone_lookup' : len(lync.zone_lookup),
+                'source_names' : sum(len(sources) for sources in lync.source_info),
+                'fingerprints' : len(lync._fingerprints),
+                'subscribers' : len(lync._subscribers),
+                'listeners' : len(lync._listeners),
+                'ramps' : sum(ramp.active() for ramp in list(lync._ramps.values())) }
+    return { key : value for (key, value) in metrics.items() if value is not None }
+
+class _Traffic:
+    """ the operations of the soak run on one client """
+    def __init__(self, lync, rng):
+        self.lync = lync
+        self.rng = rng
+        self.renames = 0
+
+    def command(self):
+        lync = self.lync
+        zone = self.rng.choice(lync.active_zones())
+        choice = self.rng.random()
+        if choice < 0.5:
+            lync.set_volume(zone, self.rng.randrange(101))
+        elif choice < 0.7:
+            lync.set_power(zone, self.rng.choice(('on', 'off')))
+        elif choice < 0.85:
+            lync.set_mute(zone, self.rng.choice(('on', 'off')))
+        else:
+            lync.set_source(zone, self.rng.choice(list(lync.snapshot().sources[zone].values())))
+
+    def refresh(self):
+        self.lync.refresh_zone('all')
+
+    def rename(self):
+        """ rename a zone through the controller and a source on the keypad """
+        lync = self.lync
+        self.renames += 1
+        zone = self.rng.choice(lync.active_zones())
+        name = ('room%d' % self.renames).encode()
+        lync._write(lync.build_frame('zone name', zone, name.ljust(12, b'\0')))
+        source = self.rng.randrange(1, 7)
+        data = bytearray(('input%d' % self.renames).encode().ljust(13, b'\0'))
+        data[11] = source
+        lync.process_data(lync.build_rx_frame(zone, 0x0E, bytes(data)))
+
+    def scene(self):
+        lync = self.lync
+        scene = lync.get_scene()
+        zone = self.rng.choice(list(scene))
+        scene[zone] = dict(scene[zone], volume=lync.volume_to_db(self.rng.randrange(101)))
+        lync.set_scene(scene)
+
+    def ramp(self):
+        lync = self.lync
+        lync.ramp_volume(self.rng.choice(lync.active_zones()), self.rng.randrange(101), 0.05)
+
+    def subscribe(self):
+        lync = self.lync
+        subscription = lync.subscribe()
+        lync.set_mute(self.rng.choice(lync.active_zones()), 'on')
+        lync.unsubscribe(subscription)
+
+    def disconnect(self):
+        lync = self.lync
+        _drain(lync)
+        lync.close()
+        while lync.is_connected():
+            time.sleep(0.001)
+        lync.connect()
+        lync.init()
+
+def _drain(lync):
+    """ wait for the queued writes and the scheduled ramp steps and close """
+    while lync.tx_pending() or any(ramp.active() for ramp in list(lync._ramps.values())):
+        time.sleep(0.001)
+
+def _growth(samples):
+    """ return metric to (first half mean, second half mean, allowed growth) """
+    half = len(samples) // 2
+    growth = {}
+    for key in samples[0]:
+        first = sum(s[key] for s in samples[:half]) / half
+        second = sum(s[key] for s in samples[half:]) / (len(samples) - half)
+        (absolute, relative) = LYNC_SOAK_ALLOWANCE.get(key, LYNC_SOAK_DEFAULT_ALLOWANCE)
+        growth[key] = (first, second, max(absolute, relative * first))
+    return growth
+
+def soak(days=LYNC_SOAK_DAYS, seed=0, lync=None):
+    """ Run the soak test
+        :param lync: the LyncBase to run, a new LyncSimulatorClient by default
+        :return a dict with the hourly samples, the growth of every metric,
+                the failed metrics and the top allocation differences
+    """
+    rng = random.Random(seed)
+    lync = lync if lync is not None else LyncSimulatorClient()
+    traffic = _Traffic(lync, rng)
+    hours = int(days * 24)
+    # every operation at its time in simulated hours
+    schedule = sorted((rng.uniform(0, hours), name)
+                      for (name, per_day) in LYNC_SOAK_DAY.items()
+                      for i in range(int(per_day * days)))
+    warmup = max(1, int(hours * LYNC_SOAK_WARMUP))
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    lync.connect()
+    lync.init()
+    samples = []
+    start = None
+    index = 0
+    try:
+        for hour in range(hours):
+            while index < len(schedule) and schedule[index][0] < hour + 1:
+                getattr(traffic, schedule[index][1])()
+                index += 1
+            _drain(lync)
+            if hour + 1 == warmup:
+                start = _allocations()
+            elif hour + 1 > warmup:
+                samples.append(sample(lync))
+        end = _allocations()
+    finally:
+        lync.close()
+        if not tracing:
+            tracemalloc.stop()
+    growth = _growth(samples)
+    failed = [key for (key, (first, second, allowed)) in growth.items() if second - first > allowed]
+    top = [str(stat) for stat in end.compare_to(start, 'lineno')[:LYNC_SOAK_TOP]]
+    return { 'days' : days,
+             'samples' : samples,
+             'growth' : growth,
+             'failed' : failed,
+             'top' : top }
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak test the Lync client against the simulator")
+    parser.add_argument('--days', type=float, default=LYNC_SOAK_DAYS, help="simulated days")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the traffic")
+    parser.add_argument('--json', action='store_true', help="print the result as json")
+    args = parser.parse_args()
+    started = time.monotonic()
+    result = soak(args.days, args.seed)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print("%g simulated days in %.1fs, %d hourly samples after the warm up" % (
+            args.days, time.monotonic() - started, len(result['samples'])))
+        for (key, (first, second, allowed)) in result['growth'].items():
+            print("%-14s %14.1f %14.1f %+12.1f  %s" % (key, first, second, second - first,
+                                                      'GREW' if key in result['failed'] else 'ok'))
+        print("top allocations since the warm up:")
+        for line in result['top']:
+            print("  " + line)
+    return 1 if result['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,316 @@
+"""
+Compact binary export of the Lync state cache.
+
+encode_state turns a LyncSnapshot into a few hundred bytes, either in full or
+as a delta holding only what changed since an earlier snapshot, and
+decode_state turns them back into a LyncSnapshot.  A record starts with the
+header, all values little endian:
+
+    magic       2 bytes, LYNC_STATE_MAGIC
+    format      byte, LYNC_STATE_FORMAT
+    kind        byte, LYNC_STATE_FULL or LYNC_STATE_DELTA
+    version     unsigned 32 bit snapshot version
+    base        unsigned 32 bit version a delta applies to, 0 for a full record
+    zones       16 bit mask of the zone records which follow
+    sources     16 bit mask of the source records which follow
+    exists      16 bit mask of the installed zones
+    keypads     16 bit mask of the zones with a keypad
+    flags       byte, LYNC_STATE_MP3 when the mp3 record follows
+
+then a zone record for every bit in zones, a source record for every bit in
+sources and the mp3 record, in that order:
+
+    zone        flags byte (power, mute, dnd, source unknown, name follows,
+                source list follows), source byte, signed volume, treble,
+                bass and balance bytes, then the name and a count byte and
+                (source byte, name) for each source_list entry when they
+                differ from the base
+    source      count byte and (name, source byte) for each entry, or the
+                count LYNC_STATE_MIRROR when the entries are the zone's
+                source_list the other way round, as they usually are
+    mp3         state byte, 1 for on, file name, artist name
+
+Names are a length byte and UTF-8.  A full record is a delta against the
+state of a new LyncProtocol, so zones and sources which were never reported
+take no space.  Snapshots share the zones which did not change, and the
+encoded parts of a zone are kept while its read only dict lives, so encoding
+the next snapshot only encodes the zones which changed.
+"""
+
+import struct
+import weakref
+
+from .lync import LyncProtocol, LyncSnapshot, LyncFrozenDict, LYNC_MAX_ZONES
+
+__all__ = ['encode_state', 'decode_state', 'apply_state', 'state_versions', 'LYNC_STATE_MAGIC',
+           'LYNC_STATE_FORMAT', 'LYNC_STATE_FULL', 'LYNC_STATE_DELTA', 'LYNC_STATE_MP3',
+           'LYNC_STATE_MIRROR']
+
+# record identifier and format version, a decoder rejects newer formats
+LYNC_STATE_MAGIC = b'LS'
+LYNC_STATE_FORMAT = 1
+# record kinds
+LYNC_STATE_FULL = 0
+LYNC_STATE_DELTA = 1
+# header flags
+LYNC_STATE_MP3 = 1 << 0
+# source record count of a zone whose sources mirror its source_list
+LYNC_STATE_MIRROR = 0xff
+
+_HEADER = struct.Struct('<2sBBIIHHHHB')
+_ZONE = struct.Struct('<Bbbbb')
+_FLAGS = (('power', 1 << 0), ('mute', 1 << 1), ('dnd', 1 << 2))
+_SOURCE_UNKNOWN = 1 << 3
+_NAME = 1 << 4
+_SOURCE_LIST = 1 << 5
+
+# the state of a new LyncProtocol, which full records are encoded against
+_INITIAL = LyncProtocol().snapshot()
+
+def encode_state(snapshot, base=None):
+    """ Encode a snapshot of the state cache
+        :param snapshot: the LyncSnapshot to encode
+        :param base: an earlier LyncSnapshot of the same LyncProtocol which the
+                     receiver holds, to only encode what changed since, or None
+        :return the bytes of the record
+    """
+    (kind, against) = (LYNC_STATE_FULL, _INITIAL) if base is None else (LYNC_STATE_DELTA, base)
+    parts = [None]
+    zone_mask = 0
+    source_mask = 0
+    exists = 0
+    keypads = 0
+    for (zn, info) in enumerate(snapshot.zones):
+        if info['exists'] == 'yes':
+            exists |= 1 << zn
+        if info['keypad'] == 'yes':
+            keypads |= 1 << zn
+        if info is against.zones[zn] or info == against.zones[zn]:
+            continue
+        zone_mask |= 1 << zn
+        (flags, fixed, name, source_list) = _memo(info, _encode_zone)
+        old = against.zones[zn]
+        if info['name'] != old['name']:
+            flags |= _NAME
+        if info['source_list'] != old['source_list']:
+            flags |= _SOURCE_LIST
+        parts.append(bytes([flags]))
+        parts.append(fixed)
+        if flags & _NAME:
+            parts.append(name)
+        if flags & _SOURCE_LIST:
+            parts.append(source_list)
+    for (zn, sources) in enumerate(snapshot.sources):
+        if sources is against.sources[zn] or sources == against.sources[zn]:
+            continue
+        source_mask |= 1 << zn
+        parts.append(_encode_sources(sources, snapshot.zones[zn]['source_list']))
+    flags = 0
+    mp3 = snapshot.mp3
+    if mp3 is not against.mp3 and mp3 != against.mp3:
+        flags |= LYNC_STATE_MP3
+        parts.append(_memo(mp3, _encode_mp3))
+    parts[0] = _HEADER.pack(LYNC_STATE_MAGIC, LYNC_STATE_FORMAT, kind, snapshot.version,
+                            0 if base is None else base.version,
+                            zone_mask, source_mask, exists, keypads, flags)
+    return b''.join(parts)
+
+class _Memo:
+    """ values kept for read only snapshot dicts until the dicts are collected
+        The dicts can't be hashed, so they are held by weak references keyed by id.
+    """
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, value):
+        entry = self._entries.get(id(value))
+        if entry is not None and entry[0]() is value:
+            return entry[1]
+        return None
+
+    def set(self, value, memo):
+        key = id(value)
+        entries = self._entries
+        def drop(ref):
+            if entries.get(key, (None,))[0] is ref:
+                entries.pop(key, None)
+        entries[key] = (weakref.ref(value, drop), memo)
+
+    def __len__(self):
+        return len(self._entries)
+
+# encoded zones and mp3 status, and (source_list, record) of the sources
+_ENCODED = _Memo()
+_SOURCES = _Memo()
+
+def _memo(value, encode):
+    """ return encode(value), kept for the read only snapshot dicts which are reused """
+    encoded = _ENCODED.get(value)
+    if encoded is None:
+        encoded = encode(value)
+        if isinstance(value, LyncFrozenDict):
+            _ENCODED.set(value, encoded)
+    return encoded
+
+def _encode_zone(info):
+    """ return the flags, the other fixed fields, the name and the source list of a zone """
+    flags = 0
+    for (key, bit) in _FLAGS:
+        if info[key] == 'on':
+            flags |= bit
+    source = info['source']
+    if not isinstance(source, int):
+        flags |= _SOURCE_UNKNOWN
+        source = 0
+    fixed = _ZONE.pack(source, info['volume'], info['treble'], info['bass'], info['balance'])
+    source_list = [bytes([len(info['source_list'])])]
+    for (number, name) in info['source_list'].items():
+        source_list.append(bytes([number]))
+        source_list.append(_text(name))
+    return (flags, fixed, _text(info['name']), b''.join(source_list))
+
+def _encode_sources(sources, source_list):
+    """ return the source record, kept on the sources with the source_list it was checked against """
+    memo = _SOURCES.get(sources)
+    if memo is not None and memo[0] is source_list:
+        return memo[1]
+    if (len(sources) == len(source_list) and
+            all(source_list.get(number) == name for (name, number) in sources.items())):
+        record = bytes([LYNC_STATE_MIRROR])
+    elif len(sources) >= LYNC_STATE_MIRROR:
+        raise ValueError("Too many sources for the state export")
+    else:
+        parts = [bytes([len(sources)])]
+        for (name, number) in sources.items():
+            parts.append(_text(name))
+            parts.append(bytes([number]))
+        record = b''.join(parts)
+    if isinstance(sources, LyncFrozenDict):
+        _SOURCES.set(sources, (source_list, record))
+    return record
+
+def _encode_mp3(mp3):
+    return bytes([mp3['state'] == 'on']) + _text(mp3['file']) + _text(mp3['artist'])
+
+def _text(value):
+    data = str(value).encode()
+    if len(data) > 255:
+        raise ValueError("Name too long for the state export: %r" % value)
+    return bytes([len(data)]) + data
+
+def state_versions(data):
+    """ return (version, base version) of a record, base is None for a full record """
+    header = _header(data)
+    return (header[3], header[4] if header[2] == LYNC_STATE_DELTA else None)
+
+def _header(data):
+    if len(data) < _HEADER.size:
+        raise ValueError("Truncated Lync state record")
+    header = _HEADER.unpack_from(data)
+    if header[0] != LYNC_STATE_MAGIC:
+        raise ValueError("Not a Lync state record")
+    if header[1] > LYNC_STATE_FORMAT:
+        raise ValueError("Unsupported Lync state format %d" % header[1])
+    if header[2] not in (LYNC_STATE_FULL, LYNC_STATE_DELTA):
+        raise ValueError("Unknown Lync state record kind %d" % header[2])
+    return header
+
+def decode_state(data, base=None):
+    """ Decode a record made by encode_state
+        :param data: bytes of the record
+        :param base: the LyncSnapshot a delta was encoded against
+        :return the LyncSnapshot, sharing the unchanged zones with base
+        Raises ValueError for malformed records and deltas against another version.
+    """
+    (magic, fmt, kind, version, base_version,
+     zone_mask, source_mask, exists, keypads, flags) = _header(data)
+    if kind == LYNC_STATE_FULL:
+        base = _INITIAL
+    elif base is None or base.version != base_version:
+        raise ValueError("Lync state delta applies to version %d, not %s" %
+                         (base_version, None if base is None else base.version))
+    reader = _Reader(data, _HEADER.size)
+    try:
+        zones = list(base.zones)
+        for zn in range(LYNC_MAX_ZONES):
+            if zone_mask & (1 << zn):
+                zones[zn] = reader.zone(zones[zn], exists & (1 << zn), keypads & (1 << zn))
+        sources = list(base.sources)
+        for zn in range(LYNC_MAX_ZONES):
+            if source_mask & (1 << zn):
+                count = reader.byte()
+                if count == LYNC_STATE_MIRROR:
+                    sources[zn] = LyncFrozenDict((name, number) for (number, name)
+                                                 in zones[zn]['source_list'].items())
+                else:
+                    sources[zn] = LyncFrozenDict((reader.text(), reader.byte())
+                                                 for i in range(count))
+        mp3 = base.mp3
+        if flags & LYNC_STATE_MP3:
+            mp3 = LyncFrozenDict(state='on' if reader.byte() else 'off',
+                                 file=reader.text(), artist=reader.text())
+    except (IndexError, struct.error, UnicodeDecodeError):
+        raise ValueError("Truncated or corrupt Lync state record")
+    if reader.offset != len(data):
+        raise ValueError("%d extra bytes after the Lync state record" % (len(data) - reader.offset))
+    return LyncSnapshot(version, tuple(zones), tuple(sources), mp3)
+
+class _Reader:
+    """ cursor over the records following the header """
+    def __init__(self, data, offset):
+        self.data = data
+        self.offset = offset
+
+    def byte(self):
+        value = self.data[self.offset]
+        self.offset += 1
+        return value
+
+    def text(self):
+        length = self.byte()
+        end = self.offset + length
+        if end > len(self.data):
+            raise IndexError(end)
+        value = bytes(self.data[self.offset:end]).decode()
+        self.offset = end
+        return value
+
+    def zone(self, old, exists, keypad):
+        flags = self.byte()
+        (source, volume, treble, bass, balance) = _ZONE.unpack_from(self.data, self.offset)
+        self.offset += _ZONE.size
+        name = self.text() if flags & _NAME else old['name']
+        if flags & _SOURCE_LIST:
+            source_list = LyncFrozenDict((self.byte(), self.text()) for i in range(self.byte()))
+        else:
+            source_list = old['source_list']
+        # same keys in the same order as LyncProtocol.zone_info
+        return LyncFrozenDict(name=name,
+                              source='unknown' if flags & _SOURCE_UNKNOWN else source,
+                              source_list=source_list,
+                              exists='yes' if exists else 'no',
+                              keypad='yes' if keypad else 'no',
+                              power='on' if flags & 1 << 0 else 'off',
+                              mute='on' if flags & 1 << 1 else 'off',
+                              dnd='on' if flags & 1 << 2 else 'off',
+                              volume=volume, treble=treble, bass=bass, balance=balance)
+
+def apply_state(lync, snapshot):
+    """ Replace the state cache of a LyncProtocol with a decoded snapshot
+        Used to start from a cached state before the transport is connected.
+        The LyncProtocol keeps its own snapshot version.
+    """
+    lync.zone_lookup = { 'all' : 0 }
+    mask = 0
+    for (zn, info) in enumerate(snapshot.zones):
+        lync.zone_info[zn] = dict(info, source_list=dict(info['source_list']))
+        lync.source_info[zn] = dict(snapshot.sources[zn])
+        if info['name'] != 'unknown':
+            lync.zone_lookup[info['name']] = str(zn)
+        if info['exists'] == 'yes':
+            mask |= 1 << zn
+    lync.mp3_status = dict(snapshot.mp3)
+    lync._zone_mask = mask or None
+    # the state no longer matches the last frames seen by the streaming decoder
+    lync._fingerprints.clear()
+    lync._publish()
@@ -0,0 +1,17 @@
+""" Timing tests only run with --benchmark, they need a quiet machine """
+
+import pytest
+
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true', help="run the timing tests")
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', "benchmark: timing test, run with --benchmark")
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark'):
+        return
+    skip = pytest.mark.skip(reason="timing test, run with --benchmark")
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
@@ -0,0 +1,43 @@
+""" Tests of lync.bulk against the streaming decoder """
+
+import random
+
+import pytest
+
+from lync import LyncProtocol, LyncFrameEvent, LYNC_MAX_ZONES
+from lync.benchmark import status_stream
+from lync.fuzz import random_stream
+
+np = pytest.importorskip('numpy')
+
+from lync.bulk import bulk_decode
+
+STATUS_KEYS = ('power', 'mute', 'dnd', 'source', 'volume', 'treble', 'bass', 'balance')
+
+def check(stream):
+    """ decode a stream in one piece both ways and compare the frames and zone status """
+    proto = LyncProtocol()
+    proto.dedup = False
+    events = [event for event in proto.receive_data(stream) if isinstance(event, LyncFrameEvent)]
+    frames = bulk_decode(stream)
+    assert len(frames) == proto.stats['rx_frames']
+    assert frames.checksum_errors() == proto.stats['checksum_errors']
+    assert frames.resyncs == proto.stats['resyncs']
+    # the streaming decoder parses the frames of valid zones, bad checksums included
+    parsed = [(int(zone), int(cmd)) for (zone, cmd) in zip(frames.zone, frames.cmd)
+              if zone < LYNC_MAX_ZONES]
+    assert parsed == [(event.zone, event.cmd_id) for event in events]
+    bulk = LyncProtocol()
+    frames.apply(bulk)
+    for zone in range(LYNC_MAX_ZONES):
+        if zone in frames.status['zone']:
+            assert ({ key : bulk.zone_info[zone][key] for key in STATUS_KEYS } ==
+                    { key : proto.zone_info[zone][key] for key in STATUS_KEYS })
+
+def test_clean_frames():
+    check(status_stream(100))
+
+def test_resyncs_and_bad_checksums():
+    rng = random.Random(3)
+    for trial in range(200):
+        check(random_stream(rng, rng.randrange(1, 64)))
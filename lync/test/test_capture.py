@@ -0,0 +1,50 @@
+""" Capture of a simulator session and its replay, see lync.capture """
+
+import time
+
+from lync import LyncProtocol, LyncSimulatorClient, LyncReplay, LYNC_CAPTURE_RX, LYNC_CAPTURE_TX
+
+def wait_sent(client, timeout=5):
+    end = time.monotonic() + timeout
+    while client.tx_pending() and time.monotonic() < end:
+        time.sleep(0.005)
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'session.cap')
+    client = LyncSimulatorClient(latency=0.005)
+    received = []
+    client.add_listener(lambda data: received.append(bytes(data)))
+    written = []
+    transport_write = client._transport_write
+    def write(data):
+        written.append(bytes(data))
+        transport_write(data)
+    client._transport_write = write
+    client.start_capture(path)
+    client.connect()
+    client.refresh_zone('all')
+    wait_sent(client)
+    time.sleep(0.05)
+    for zone in range(1, 7):
+        client.set_power(zone, 'on')
+        client.set_volume(zone, 10 * zone)
+    client.set_mute(2, 'on')
+    wait_sent(client)
+    time.sleep(0.05)
+    client.stop_capture()
+    client.close()
+
+    with LyncReplay(path) as replay:
+        records = [(ts, direction, bytes(data)) for (ts, direction, data) in replay]
+        # the records of the reader and writer are in time order, every reply after its command
+        assert [ts for (ts, d, data) in records] == sorted(ts for (ts, d, data) in records)
+        assert records[0][1] == LYNC_CAPTURE_TX
+        assert [data for (ts, d, data) in records if d == LYNC_CAPTURE_TX] == written
+        assert [data for (ts, d, data) in records if d == LYNC_CAPTURE_RX] == received
+        proto = LyncProtocol()
+        assert replay.replay(proto) == len(received)
+    snap = proto.snapshot()
+    expected = client.snapshot()
+    assert (snap.version, snap.zones, snap.sources, snap.mp3) == (
+        expected.version, expected.zones, expected.sources, expected.mp3)
+    assert snap.zones[2]['mute'] == 'on'
@@ -0,0 +1,55 @@
+""" Differential and speed tests of the decoder against lync.fuzz.LyncReferenceDecoder """
+
+import pytest
+
+from lync import LyncProtocol
+from lync.fuzz import fuzz, differential, check_performance
+
+def test_differential():
+    failures = fuzz(trials=1000, seed=1)
+    assert not failures, failures[0]
+
+def test_header_split_across_chunks():
+    proto = LyncProtocol()
+    status = proto.status_frame(1, dict(proto.zone_info[1], source=1, volume=-20))
+    stream = b'\x13\x37\x02' + status
+    # the header starts in the last byte of the first chunk
+    assert differential(stream, [stream[:3], stream[3:]]) is None
+
+def test_damaged_names():
+    proto = LyncProtocol()
+    proto.receive_data(proto.build_rx_frame(2, 0x0D, b'\xffkitchen'.ljust(13, b'\0')))
+    proto.receive_data(proto.build_rx_frame(2, 0x0C, b'den'.ljust(13, b'\0')))
+    assert proto.zone_info[2]['name'] == '�kitchen'
+    # the zone has no known source, the name is dropped
+    assert proto.source_info[2] == {}
+
+def test_zone_out_of_range():
+    proto = LyncProtocol()
+    proto.receive_data(proto.build_rx_frame(0x30, 0x0D, b'attic'.ljust(13, b'\0')))
+    assert 'attic' not in proto.zone_lookup
+    assert proto.stats['rx_frames'] == 1
+
+@pytest.mark.benchmark
+def test_speed_baseline():
+    regressions = check_performance()
+    assert not regressions, regressions
+
+def test_dedup_source_names():
+    proto = LyncProtocol()
+    name = proto.build_rx_frame(2, 0x0C, b'den'.ljust(12, b'\0'))
+    proto.receive_data(name)
+    # dropped while the source is unknown, so not remembered as a repeat
+    proto.receive_data(proto.status_frame(2, dict(proto.zone_info[2], source=3)))
+    proto.receive_data(name)
+    assert proto.zone_info[2]['source_list'] == { 3 : 'den' }
+    proto.receive_data(name)
+    assert proto.stats['dedup_hits'] == 1
+    # a source name frame renames the same source, the next zone source name applies again
+    data = bytearray(b'tv'.ljust(13, b'\0'))
+    data[11] = 3
+    proto.receive_data(proto.build_rx_frame(2, 0x0E, bytes(data)))
+    assert proto.source_info[2] == { 'tv' : 3 }
+    proto.receive_data(name)
+    assert proto.source_info[2] == { 'den' : 3 }
+    assert proto.stats['dedup_hits'] == 1
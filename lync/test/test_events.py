@@ -0,0 +1,103 @@
+""" Event subscriptions, see lync.events """
+
+import asyncio
+import threading
+import time
+
+from lync import (LyncProtocol, LyncSimulatorClient, LyncSubscription,
+                  LyncFrameEvent, LyncStateEvent)
+
+def frame(zone, cmd_id=0x05):
+    return LyncFrameEvent(zone, cmd_id, 'zone status', b'')
+
+def test_drop_oldest():
+    proto = LyncProtocol()
+    subscription = proto.subscribe(maxsize=2)
+    for zone in (1, 2, 3):
+        subscription.put(frame(zone))
+    assert subscription.dropped == 1
+    assert [subscription.get(0).zone for i in range(2)] == [2, 3]
+    assert subscription.get(0) is None
+
+def test_coalesce():
+    proto = LyncProtocol()
+    subscription = proto.subscribe(maxsize=2, policy='coalesce')
+    subscription.put(LyncStateEvent(1, 1, { 'volume' : -20 }))
+    subscription.put(frame(1))
+    subscription.put(LyncStateEvent(2, 1, { 'mute' : 'on' }))
+    subscription.put(frame(1))
+    # merged into the queued events of the zone, nothing is dropped
+    assert len(subscription) == 2
+    assert subscription.dropped == 0
+    state = subscription.get(0)
+    assert (state.version, state.changes) == (2, { 'volume' : -20, 'mute' : 'on' })
+    assert subscription.get(0) == frame(1)
+
+def test_block():
+    subscription = LyncSubscription(LyncProtocol(), maxsize=1, policy='block', block_timeout=5)
+    subscription.put(frame(1))
+    consumer = threading.Timer(0.1, subscription.get)
+    consumer.start()
+    start = time.monotonic()
+    subscription.put(frame(2))
+    # waited for the consumer instead of dropping
+    assert 0.05 < time.monotonic() - start < 5
+    assert subscription.dropped == 0
+    assert subscription.get(0).zone == 2
+    subscription = LyncSubscription(LyncProtocol(), maxsize=1, policy='block', block_timeout=0.05)
+    subscription.put(frame(1))
+    subscription.put(frame(2))
+    assert subscription.dropped == 1
+
+def test_block_outside_decoder_lock():
+    client = LyncSimulatorClient()
+    client.connect()
+    client.init()
+    subscription = client.subscribe(maxsize=1, policy='block')
+    stream = b''.join(client.status_frame(zone, dict(client.zone_info[zone], volume=-zone))
+                      for zone in range(1, 7))
+    reader = threading.Thread(target=client.process_data, args=(stream,))
+    reader.start()
+    time.sleep(0.1)
+    # the reader waits for the full subscription without holding the state cache
+    assert reader.is_alive()
+    assert client._lock.acquire(timeout=0.5)
+    client._lock.release()
+    while reader.is_alive():
+        subscription.get(0.1)
+    reader.join()
+    client.close()
+
+def test_unsubscribe_on_close():
+    proto = LyncProtocol()
+    subscription = proto.subscribe()
+    subscription.close()
+    assert proto._subscribers == ()
+    events = proto.iter_events()
+    proto.receive_data(proto.status_frame(1, dict(proto.zone_info[1], source=1)))
+    assert isinstance(next(events), LyncFrameEvent)
+    events.close()
+    assert proto._subscribers == ()
+
+def test_async_iterator():
+    proto = LyncProtocol()
+    async def consume():
+        received = []
+        events = proto.events()
+        async def read():
+            async for event in events:
+                received.append(event)
+                if isinstance(event, LyncStateEvent):
+                    break
+        task = asyncio.ensure_future(read())
+        await asyncio.sleep(0.01)
+        status = proto.status_frame(2, dict(proto.zone_info[2], source=3, volume=-30))
+        # events are put by the decoder thread
+        await asyncio.get_running_loop().run_in_executor(None, proto.receive_data, status)
+        await asyncio.wait_for(task, 5)
+        await events.aclose()
+        return received
+    received = asyncio.run(consume())
+    assert isinstance(received[0], LyncFrameEvent)
+    assert received[-1].changes['volume'] == -30
+    assert proto._subscribers == ()
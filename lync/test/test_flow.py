@@ -0,0 +1,108 @@
+""" Adaptive flow control, see LyncFlowControl and LyncBase.flow """
+
+import time
+
+import pytest
+
+from lync import LyncFlowControl, LyncProtocol, LyncSimulatorClient
+from lync.flow import LYNC_FLOW_TIMEOUT, LYNC_FLOW_MIN_TIMEOUT, LYNC_FLOW_MAX_TIMEOUT
+
+def test_additive_increase():
+    flow = LyncFlowControl(window=4)
+    for i in range(4):
+        flow.confirmed(0.01, i)
+    # every prompt reply adds 1/window, about one command per window of replies
+    assert 4.9 < flow.window < 5
+    assert flow.stats['increases'] == 4
+    assert flow.can_send(4) and not flow.can_send(5)
+
+def test_cuts_and_recovery():
+    flow = LyncFlowControl(window=16)
+    flow.confirmed(0.01, 0)
+    flow.lost(1)
+    assert flow.window == pytest.approx(16.0625 / 2)
+    # the same overrun within a round trip is only cut once
+    flow.lost(1.001)
+    flow.errors(0, 1.002)
+    flow.errors(3, 1.003)
+    assert flow.window == pytest.approx(16.0625 / 2)
+    assert flow.stats['decreases'] == 1
+    assert flow.stats['timeouts'] == 2 and flow.stats['errors'] == 3
+    # a reply much later than the shortest round trip is a delay signal
+    flow.confirmed(0.2, 2)
+    assert flow.stats['delays'] == 1 and flow.stats['decreases'] == 2
+    for i in range(100):
+        flow.lost(3 + i)
+    assert flow.window == flow.min_window
+
+def test_timeout():
+    flow = LyncFlowControl()
+    assert flow.timeout() == LYNC_FLOW_TIMEOUT
+    flow.confirmed(0.1, 0)
+    # srtt + 4 * rttvar with rttvar starting at half the first round trip
+    assert flow.timeout() == pytest.approx(0.3)
+    for i in range(50):
+        flow.confirmed(0.001, i)
+    assert flow.timeout() == LYNC_FLOW_MIN_TIMEOUT
+    flow.confirmed(30, 100)
+    assert flow.timeout() == LYNC_FLOW_MAX_TIMEOUT
+
+def wait_sent(client, timeout=5):
+    end = time.monotonic() + timeout
+    while client.tx_pending() and time.monotonic() < end:
+        time.sleep(0.005)
+
+def test_zone_zero_before_zones_known():
+    client = LyncSimulatorClient()
+    client.connect()
+    client.refresh_zone('all')
+    wait_sent(client)
+    # the simulator has 6 zones, nothing is left waiting for the other 9
+    assert client._in_flight == 0
+    assert client.flow.stats['timeouts'] == 0
+    client.close()
+
+def overrun(flow):
+    client = LyncSimulatorClient(buffer=4, rate=200)
+    if not flow:
+        client.flow = None
+    client.connect()
+    client.init()
+    for i in range(100):
+        client.set_volume(1 + i % 6, i)
+    wait_sent(client)
+    # the gateway passes on what it buffered
+    time.sleep(0.1)
+    client.close()
+    return client.stats['gateway_dropped']
+
+def test_gateway_overrun():
+    assert overrun(flow=False) > 50
+    assert overrun(flow=True) <= 5
+
+def max_in_flight(client, data, window=4):
+    """ write data in one piece with a fixed window, return the most commands in flight """
+    client.flow = LyncFlowControl(window, min_window=window, max_window=window)
+    written = []
+    transport_write = client._transport_write
+    def write(data):
+        written.append(client._in_flight)
+        transport_write(data)
+    client._transport_write = write
+    client._write(data)
+    wait_sent(client)
+    client._transport_write = transport_write
+    return max(written)
+
+def test_batch_admitted_per_command():
+    client = LyncSimulatorClient(latency=0.01)
+    client.connect()
+    client.init()
+    wait_sent(client)
+    time.sleep(0.1)
+    burst = b''.join(LyncProtocol.set_volume(client, 1 + i % 6, i) for i in range(16))
+    assert max_in_flight(client, burst) <= 4
+    # a query of all zones is answered by the 6 zones, it goes alone
+    queries = bytes(client.build_frame('query all zones', 0)) * 3
+    assert max_in_flight(client, queries) == 6
+    client.close()
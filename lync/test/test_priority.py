@@ -0,0 +1,45 @@
+""" Priority classes of the writer queue, see LyncSendQueue """
+
+import time
+
+from lync import LyncProtocol, LyncSendQueue, LyncSimulatorClient, write_priority
+import lync.lync
+
+def test_classes_drain_in_order():
+    q = LyncSendQueue()
+    q.put('refresh', 'background')
+    q.put('ramp', 'automation')
+    q.put('mute', 'interactive')
+    q.close()
+    assert [q.get(), q.get(), q.get(), q.get()] == ['mute', 'ramp', 'refresh', None]
+    assert q.qsize() == 0
+
+def test_aging(monkeypatch):
+    monkeypatch.setitem(lync.lync.LYNC_PRIORITY_AGING, 'background', 0.01)
+    q = LyncSendQueue()
+    q.put('refresh', 'background')
+    time.sleep(0.02)
+    q.put('mute', 'interactive')
+    assert q.get() == 'refresh'
+    assert q.stats['background']['aged'] == 1
+    assert q.qsize('interactive') == 1
+
+def test_default_classes():
+    proto = LyncProtocol()
+    assert write_priority(proto.build_frame('query all zones', 1)) == 'background'
+    assert write_priority(proto.build_frame('zone', 1, proto.encode_args('zone', 'mute on'))) == 'interactive'
+
+def test_latency_per_class():
+    client = LyncSimulatorClient(latency=0.001)
+    client.connect()
+    client.init()
+    for zone in client.active_zones():
+        client.refresh_zone(zone)
+        client.set_volume(zone, 20)
+    while client.tx_pending():
+        time.sleep(0.01)
+    latency = client.tx_latency()
+    client.close()
+    assert latency['interactive']['count'] == 6
+    assert latency['background']['count'] == 6
+    assert latency['automation']['count'] == 0
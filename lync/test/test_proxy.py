@@ -0,0 +1,41 @@
+""" LyncProxy sharing a simulated controller with local clients """
+
+import time
+
+from lync import LyncSimulatorClient
+from lync.proxy import LyncProxy, LyncProxyClient
+
+def settle(condition, timeout=2):
+    end = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end:
+        time.sleep(0.01)
+    return condition()
+
+def test_proxy(tmp_path):
+    upstream = LyncSimulatorClient()
+    upstream.connect()
+    upstream.init()
+    upstream.set_power(2, 'on')
+    assert settle(lambda: upstream.get_zone_info(2)['power'] == 'on')
+    proxy = LyncProxy(upstream, str(tmp_path / 'lync.sock'))
+    proxy.start()
+    clients = [LyncProxyClient(str(tmp_path / 'lync.sock')) for i in range(2)]
+    try:
+        for client in clients:
+            assert client.connect()
+        # the cached state arrives on connect
+        assert settle(lambda: all(c.snapshot().zones == upstream.snapshot().zones for c in clients))
+        assert settle(lambda: proxy.client_count() == 2)
+        # a command from one client reaches the controller and every client sees the reply
+        clients[0].set_mute(3, 'on')
+        assert settle(lambda: all(c.get_zone_info(3)['mute'] == 'on' for c in clients + [upstream]))
+        # queries are answered from the cache
+        commands = upstream.simulator.stats['commands']
+        clients[1].refresh_zone('all')
+        assert settle(lambda: clients[1].stats['rx_frames'] > clients[0].stats['rx_frames'])
+        assert upstream.simulator.stats['commands'] == commands
+    finally:
+        for client in clients:
+            client.disconnect()
+        proxy.stop()
+        upstream.close()
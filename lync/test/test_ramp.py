@@ -0,0 +1,58 @@
+""" Volume ramps, see lync.ramp """
+
+import time
+
+from lync import LyncSimulatorClient
+
+def client():
+    lync = LyncSimulatorClient()
+    lync.connect()
+    lync.init()
+    return lync
+
+def test_reaches_target():
+    lync = client()
+    ramp = lync.ramp_volume([1, 2], 50, 0.2, 's-curve')
+    assert ramp.wait(2)
+    assert lync.wait_state(1, { 'volume' : lync.volume_to_db(50) }, 2)
+    assert lync.wait_state(2, { 'volume' : lync.volume_to_db(50) }, 2)
+    assert not ramp.active()
+    lync.close()
+
+def test_retarget():
+    lync = client()
+    ramp = lync.ramp_volume(1, 80, 1)
+    time.sleep(0.1)
+    ramp.retarget(20, 0.1)
+    assert ramp.level == lync.volume_to_db(20)
+    assert ramp.wait(2)
+    assert lync.wait_state(1, { 'volume' : lync.volume_to_db(20) }, 2)
+    lync.close()
+
+def test_takeover_releases_previous():
+    lync = client()
+    first = lync.ramp_volume([1, 2], 80, 5)
+    second = lync.ramp_volume(2, 10, 0.1)
+    # the first ramp keeps zone 1 only
+    assert first.zones == (1,)
+    assert first.active()
+    assert second.wait(2)
+    assert lync.wait_state(2, { 'volume' : lync.volume_to_db(10) }, 2)
+    # no zone is left, the first ramp is done
+    third = lync.ramp_volume(1, 10, 0.1)
+    assert not first.active()
+    assert third.wait(2)
+    lync.close()
+
+def test_cancel():
+    lync = client()
+    target = lync.volume_to_db(100)
+    ramp = lync.ramp_volume(3, 100, 2)
+    time.sleep(0.2)
+    ramp.cancel()
+    assert ramp.wait(0)
+    time.sleep(0.1)
+    level = lync.snapshot().zones[3]['volume']
+    time.sleep(0.2)
+    assert lync.snapshot().zones[3]['volume'] == level != target
+    lync.close()
@@ -0,0 +1,49 @@
+""" Scene capture and restore, see LyncProtocol.set_scene """
+
+from lync import LyncProtocol, LyncSimulator, LyncSimulatorClient
+
+def controller():
+    sim = LyncSimulator()
+    proto = LyncProtocol()
+    proto.receive_data(sim.receive_data(proto.build_frame('query all zones', 0)))
+    return (sim, proto)
+
+def test_minimal_frames():
+    (sim, proto) = controller()
+    scene = proto.get_scene()
+    assert sorted(scene) == [1, 2, 3, 4, 5, 6]
+    # an unchanged scene sends nothing and is complete
+    assert proto.set_scene(scene) == []
+    assert not proto._scene_pending
+    scene[2] = dict(scene[2], power='on', volume=-20)
+    # settings of a zone which stays off don't matter
+    scene[3] = dict(scene[3], volume=-10)
+    frames = proto.set_scene(scene)
+    assert frames == [proto.set_power(2, 'on'), proto.build_frame('volume setting control', 2,
+                                                                   proto.encode_args('volume setting control', -20))]
+    assert list(proto._scene_pending) == [2]
+    # the controller confirms the scene
+    for frame in frames:
+        proto.receive_data(sim.receive_data(frame))
+    assert not proto._scene_pending
+    assert proto.get_zone_info(2)['volume'] == -20
+
+def test_unknown_zone():
+    (sim, proto) = controller()
+    frames = proto.set_scene({ 'kitchen' : { 'power' : 'on', 'volume' : -10 },
+                               2 : { 'power' : 'on' },
+                               40 : { 'power' : 'on' } })
+    # nothing for the unknown name, which would have addressed every zone
+    assert [frame[2] for frame in frames] == [2]
+
+def test_wait_scene():
+    client = LyncSimulatorClient(latency=0.01)
+    client.connect()
+    client.init()
+    scene = client.get_scene()
+    for zn in scene:
+        scene[zn] = dict(scene[zn], power='on', mute='on', volume=-30 + zn)
+    assert client.set_scene(scene, timeout=2)
+    assert all(client.get_zone_info(zn)['volume'] == -30 + zn for zn in scene)
+    assert client.wait_scene(0)
+    client.close()
@@ -0,0 +1,61 @@
+""" Timer scheduler shared by the Lync clients, see LyncScheduler """
+
+import threading
+import time
+
+from lync import LyncScheduler
+
+def recorder():
+    calls = []
+    done = threading.Event()
+    def callback(name):
+        calls.append(name)
+        done.set()
+    return (calls, done, callback)
+
+def test_order():
+    scheduler = LyncScheduler()
+    (calls, done, callback) = recorder()
+    for (delay, name) in ((0.06, 'c'), (0.02, 'a'), (0.04, 'b')):
+        scheduler.call_later(delay, callback, name)
+    time.sleep(0.15)
+    assert calls == ['a', 'b', 'c']
+
+def test_cancel_and_reschedule():
+    scheduler = LyncScheduler()
+    (calls, done, callback) = recorder()
+    later = scheduler.call_later(0.02, callback, 'later')
+    later.reschedule(0.08)
+    earlier = scheduler.call_later(0.1, callback, 'earlier')
+    earlier.reschedule(0.01)
+    cancelled = scheduler.call_later(0.01, callback, 'cancelled')
+    cancelled.cancel()
+    assert not cancelled.active()
+    time.sleep(0.05)
+    assert calls == ['earlier']
+    time.sleep(0.1)
+    assert calls == ['earlier', 'later']
+
+def test_reschedule_after_cancel():
+    scheduler = LyncScheduler()
+    (calls, done, callback) = recorder()
+    timer = scheduler.call_later(0.01, callback, 'timer')
+    timer.cancel()
+    # let the scheduler discard the cancelled entry
+    time.sleep(0.05)
+    timer.reschedule(0.01)
+    assert timer.active()
+    assert done.wait(1)
+    assert calls == ['timer'] and not timer.active()
+
+def test_restart_and_errors():
+    scheduler = LyncScheduler()
+    (calls, done, callback) = recorder()
+    scheduler.call_later(0, lambda: 1 / 0)
+    timer = scheduler.call_later(0.01, callback, 'timer')
+    assert done.wait(1)
+    done.clear()
+    # a finished timer runs again, a failed callback doesn't stop the loop
+    timer.reschedule(0.01)
+    assert done.wait(1)
+    assert calls == ['timer', 'timer']
@@ -0,0 +1,47 @@
+""" LyncSerial against a simulated controller on a pseudo terminal """
+
+import os
+import select
+import threading
+
+import pytest
+
+from lync import LyncSerial, LyncSimulator
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'openpty'), reason="needs a pseudo terminal")
+
+def serve(master, simulator, stop):
+    """ answer the commands written to the pty like a controller on the UART """
+    while not stop.is_set():
+        if not select.select([master], [], [], 0.05)[0]:
+            continue
+        try:
+            data = os.read(master, 256)
+        except OSError:
+            break
+        reply = simulator.receive_data(data)
+        if reply:
+            os.write(master, reply)
+
+def test_serial_pty():
+    (master, slave) = os.openpty()
+    stop = threading.Event()
+    thread = threading.Thread(target=serve, args=(master, LyncSimulator(), stop), daemon=True)
+    thread.start()
+    lync = LyncSerial(os.ttyname(slave))
+    try:
+        assert not lync.is_connected()
+        assert lync.connect()
+        assert lync.is_connected()
+        lync.refresh_zone('all')
+        assert lync.wait_state(3, { 'name' : 'zone3' }, 2)
+        lync.set_power(3, 'on')
+        assert lync.wait_state(3, { 'power' : 'on' }, 2)
+    finally:
+        lync.close()
+        stop.set()
+        thread.join()
+        os.close(master)
+        os.close(slave)
+    assert not lync.is_connected()
+    assert not lync._wst.is_alive()
@@ -0,0 +1,40 @@
+""" Read only state snapshots, see LyncFrozenDict """
+
+import copy
+import json
+import pickle
+
+import pytest
+
+from lync import LyncFrozenDict, LyncProtocol
+
+def zone():
+    proto = LyncProtocol()
+    proto.receive_data(proto.status_frame(1, dict(proto.zone_info[1], source=2, volume=-20)))
+    return (proto, proto.get_zone_info(1))
+
+def test_mutation_rejected():
+    (proto, info) = zone()
+    for mutate in (lambda z: z.__setitem__('power', 'on'),
+                   lambda z: z.__delitem__('power'),
+                   lambda z: z.update(power='on'),
+                   lambda z: z.setdefault('spare', 1),
+                   lambda z: z.pop('power'),
+                   lambda z: z.popitem(),
+                   lambda z: z.clear()):
+        with pytest.raises(TypeError):
+            mutate(info)
+    with pytest.raises(TypeError):
+        info |= { 'power' : 'on' }
+    assert proto.snapshot().zones[1]['power'] == 'off'
+    # the merge operator returns a new plain dict
+    assert (info | { 'power' : 'on' })['power'] == 'on'
+
+def test_copy_and_pickle():
+    (proto, info) = zone()
+    for other in (copy.copy(info), copy.deepcopy(info), pickle.loads(pickle.dumps(info))):
+        assert isinstance(other, LyncFrozenDict)
+        assert other == info
+        assert isinstance(other['source_list'], LyncFrozenDict)
+    assert copy.deepcopy(proto.snapshot()) == proto.snapshot()
+    assert json.loads(json.dumps(info)) == info
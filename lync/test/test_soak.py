@@ -0,0 +1,18 @@
+""" Soak test against the simulator and the renames which used to grow the lookups """
+
+from lync import LyncProtocol
+from lync.soak import soak
+
+def test_soak():
+    result = soak(days=2, seed=1)
+    assert not result['failed'], (result['failed'], result['top'])
+
+def test_renames_replace_names():
+    proto = LyncProtocol()
+    for name in (b'den', b'office', b'study'):
+        proto.receive_data(proto.build_rx_frame(2, 0x0D, name.ljust(13, b'\0')))
+        data = bytearray(name.ljust(13, b'\0'))
+        data[11] = 3
+        proto.receive_data(proto.build_rx_frame(2, 0x0E, bytes(data)))
+    assert proto.zone_lookup == { 'all' : 0, 'study' : '2' }
+    assert proto.source_info[2] == { 'study' : 3 }
@@ -0,0 +1,69 @@
+""" Round trips of the binary state export in lync.state """
+
+import random
+
+import pytest
+
+from lync import LyncProtocol, LyncSimulator, encode_state, decode_state, apply_state, state_versions
+from lync.fuzz import random_stream
+
+def controller():
+    sim = LyncSimulator(zones=12)
+    proto = LyncProtocol()
+    proto.receive_data(sim.receive_data(proto.build_frame('query all zones', 0)))
+    return (sim, proto)
+
+def test_full_and_delta():
+    (sim, proto) = controller()
+    snap = proto.snapshot()
+    full = decode_state(encode_state(snap))
+    assert full == snap
+    proto.receive_data(sim.receive_data(proto.set_volume(3, 40)))
+    delta = encode_state(proto.snapshot(), snap)
+    assert state_versions(delta) == (proto.snapshot().version, snap.version)
+    new = decode_state(delta, full)
+    assert new == proto.snapshot()
+    # unchanged zones are shared with the base
+    assert new.zones[1] is full.zones[1]
+    with pytest.raises(ValueError):
+        decode_state(delta, new)
+
+def test_random_states():
+    rng = random.Random(2)
+    for trial in range(200):
+        proto = LyncProtocol()
+        (base, decoded) = (proto.snapshot(), decode_state(encode_state(proto.snapshot())))
+        for step in range(3):
+            proto.receive_data(random_stream(rng, 30))
+            snap = proto.snapshot()
+            assert decode_state(encode_state(snap)) == snap
+            decoded = decode_state(encode_state(snap, base), decoded)
+            assert decoded == snap
+            base = snap
+
+def test_malformed():
+    data = encode_state(controller()[1].snapshot())
+    for bad in (data[:-1], data + b'\0', b'XX' + data[2:], data[:10]):
+        with pytest.raises(ValueError):
+            decode_state(bad)
+
+def test_apply():
+    (sim, proto) = controller()
+    client = LyncProtocol()
+    apply_state(client, decode_state(encode_state(proto.snapshot())))
+    assert client.active_zones() == proto.active_zones()
+    assert client.snapshot().zones == proto.snapshot().zones
+    assert client.set_source('zone2', 'source3') == proto.set_source(2, 3)
+
+def test_memo_dropped_with_snapshots():
+    from lync import state
+    (sim, proto) = controller()
+    before = len(state._ENCODED)
+    for volume in range(0, 100, 10):
+        proto.receive_data(sim.receive_data(proto.set_volume(3, volume)))
+        encode_state(proto.snapshot())
+    # nothing is stored on the snapshot dicts
+    assert vars(proto.snapshot().zones[3]) == {}
+    assert len(state._ENCODED) > before
+    del proto, sim
+    assert len(state._ENCODED) <= before
@@ -0,0 +1,37 @@
+""" In memory wire trace, see lync.trace """
+
+import time
+
+from lync import LyncSimulatorClient, LyncTrace, LYNC_CAPTURE_RX, LYNC_CAPTURE_TX
+
+def test_dump_in_order():
+    lync = LyncSimulatorClient(latency=0.01)
+    lync.connect()
+    lync.init()
+    lync.start_trace()
+    lync.set_volume(2, 40)
+    lync.set_mute(3, 'on')
+    assert lync.wait_state(3, { 'mute' : 'on' }, 2)
+    records = lync.dump_trace()
+    # every command is traced before the status frame answering it
+    assert [(direction, zone) for (ts, direction, zone, cmd, data) in records] == [
+        (LYNC_CAPTURE_TX, 2), (LYNC_CAPTURE_TX, 3), (LYNC_CAPTURE_RX, 2), (LYNC_CAPTURE_RX, 3)]
+    assert [cmd for (ts, direction, zone, cmd, data) in records if direction == LYNC_CAPTURE_RX] == [5, 5]
+    assert [ts for (ts, direction, zone, cmd, data) in records] == sorted(r[0] for r in records)
+    assert records[0][4] == bytes(lync.build_frame('volume setting control', 2,
+                                                   lync.encode_args('volume setting control',
+                                                                    lync.volume_to_db(40))))
+    lync.close()
+
+def test_ring_wraps():
+    trace = LyncTrace(size=3, frame_size=6)
+    for i in range(5):
+        frame = bytes([0x02, 0x00, i, 0x05, 1, 2, 3, 4])
+        trace.record(LYNC_CAPTURE_RX, b'xx' + frame, 2, 2 + len(frame))
+    records = trace.records()
+    assert len(trace) == 3
+    # the oldest frames are overwritten, the frames are cut to frame_size
+    assert [zone for (ts, direction, zone, cmd, data) in records] == [2, 3, 4]
+    assert records[-1][4] == bytes([0x02, 0x00, 4, 0x05, 1, 2])
+    trace.clear()
+    assert trace.records() == []
@@ -0,0 +1,49 @@
+""" Latency tracing spans, see lync.tracing """
+
+import json
+
+from lync import LyncSimulatorClient
+from lync.tracing import LyncTracer, summarize
+
+def client(tracer=None):
+    lync = LyncSimulatorClient(latency=0.01)
+    lync.tracer = tracer
+    lync.connect()
+    lync.init()
+    return lync
+
+def test_no_spans_without_opt_in(tmp_path):
+    # no tracer on the client, nothing is timed in a trace
+    lync = client()
+    tracer = LyncTracer()
+    with tracer.trace():
+        lync.set_volume(1, 30)
+    assert lync.wait_state(1, { 'volume' : lync.volume_to_db(30) }, 2)
+    assert tracer.summary() == {}
+    lync.close()
+    # a tracer on the client records nothing outside a trace and writes no file by default
+    tracer = LyncTracer()
+    lync = client(tracer)
+    lync.set_volume(1, 50)
+    assert lync.wait_state(1, { 'volume' : lync.volume_to_db(50) }, 2)
+    assert tracer.summary() == {}
+    assert list(tmp_path.iterdir()) == []
+    lync.close()
+
+def test_spans(tmp_path):
+    path = str(tmp_path / 'spans.jsonl')
+    tracer = LyncTracer(path)
+    lync = client(tracer)
+    with tracer.trace() as trace_id:
+        with tracer.span('parse'):
+            pass
+        lync.set_volume(2, 60)
+    assert lync.wait_state(2, { 'volume' : lync.volume_to_db(60) }, 2)
+    lync.close()
+    tracer.close()
+    with open(path) as f:
+        spans = [json.loads(line) for line in f]
+    assert {span['trace'] for span in spans} == {trace_id}
+    assert [span['stage'] for span in spans] == ['parse', 'encode', 'queue', 'write', 'confirm']
+    assert list(summarize(path)) == ['parse', 'encode', 'queue', 'write', 'confirm']
+    assert tracer.summary()['confirm']['count'] == 1
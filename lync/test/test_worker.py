@@ -0,0 +1,44 @@
+""" Command worker, see lync.worker """
+
+import threading
+
+import pytest
+
+from lync import LyncSimulatorClient, LyncWorker
+
+def test_results_and_queue_depth():
+    lync = LyncSimulatorClient()
+    lync.connect()
+    lync.init()
+    worker = LyncWorker(lync, idle=None)
+    (running, released) = (threading.Event(), threading.Event())
+    def hold():
+        running.set()
+        return released.wait(5)
+    lync.hold = hold
+    held = worker.submit('hold')
+    assert running.wait(5)
+    futures = [worker.submit('zone_exists', zone) for zone in (1, 2, 12)]
+    # the worker is busy with the first command, the others wait in the queue
+    assert worker.queue_depth() == 3
+    released.set()
+    assert held.result(5) is True
+    assert [future.result(5) for future in futures] == [True, True, False]
+    assert worker.queue_depth() == 0
+    assert worker.stats['commands'] == 4
+    assert futures[-1].latency is not None
+    worker.stop()
+    lync.close()
+
+def test_confirm_and_failure():
+    lync = LyncSimulatorClient()
+    worker = LyncWorker(lync, idle=None)
+    confirmed = worker.submit('set_volume', 2, 40, confirm=(2, { 'volume' : lync.volume_to_db(40) }),
+                              timeout=5)
+    assert confirmed.result(10) is True
+    failed = worker.submit('no_such_command', 1)
+    with pytest.raises(AttributeError):
+        failed.result(5)
+    assert worker.stats['failures'] == 1
+    worker.stop()
+    lync.close()
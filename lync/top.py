@@ -0,0 +1,248 @@
+"""
+Live console monitor of a Lync link.
+
+    lync-top --host HTD-GW-SL1
+    lync-top --serial /dev/ttyUSB0
+    lync-top --capture wire.cap [--speed 4]
+    lync-top --simulator
+
+Shows the frames and bytes per second in each direction, the checksum and
+resync error rates, command round trip percentiles, the flow control window,
+the state of every zone with the fields which just changed highlighted, and
+the connection history.
+The screen is redrawn at a fixed rate from the counters and the state
+snapshot, so the monitor never holds the decoder lock.
+"""
+
+import argparse
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+from .lync import LyncBase, LyncRemote, LyncSerial, LYNC_SCENE_KEYS
+from .capture import LyncReplay
+from .simulator import LyncSimulatorClient
+
+# Screen refreshes per second
+LYNC_TOP_RATE = 1.0
+# Seconds a changed zone field stays highlighted
+LYNC_TOP_HIGHLIGHT = 3
+# Commands per second sent to the simulator
+LYNC_TOP_ACTIVITY = 5
+# Counters shown as rates
+LYNC_TOP_COUNTERS = ('rx_frames', 'rx_bytes', 'tx_frames', 'tx_bytes', 'checksum_errors', 'resyncs')
+
+_CLEAR = '\x1b[H\x1b[2J'
+_HIGHLIGHT = '\x1b[7m'
+_RESET = '\x1b[0m'
+
+_LOGGER = logging.getLogger(__name__)
+
+class LyncMonitor:
+    """ turns the counters and state snapshots of a LyncBase into a screen
+        :param lync: the LyncBase to monitor
+        :param color: highlight changed fields with terminal escapes
+    """
+    def __init__(self, lync, title='', color=True):
+        self.lync = lync
+        self._title = title
+        self._color = color
+        self._last = None
+        self._snapshot = lync.snapshot()
+        # (zone, key) to the time the field changed
+        self._changed = {}
+        self.rates = dict.fromkeys(LYNC_TOP_COUNTERS, 0.0)
+
+    def sample(self):
+        """ Update the rates and the changed fields since the last sample """
+        now = time.monotonic()
+        stats = dict(self.lync.stats)
+        if self._last is not None:
+            (then, previous) = self._last
+            elapsed = max(now - then, 1e-6)
+            self.rates = { key : (stats.get(key, 0) - previous.get(key, 0)) / elapsed
+                           for key in LYNC_TOP_COUNTERS }
+        self._last = (now, stats)
+        snap = self.lync.snapshot()
+        old = self._snapshot
+        if snap is not old:
+            for (zn, info) in enumerate(snap.zones):
+                if info is old.zones[zn]:
+                    continue
+                for key in LYNC_SCENE_KEYS:
+                    if info[key] != old.zones[zn][key]:
+                        self._changed[(zn, key)] = now
+            self._snapshot = snap
+        for (field, changed) in list(self._changed.items()):
+            if now - changed > LYNC_TOP_HIGHLIGHT:
+                del self._changed[field]
+
+    def render(self):
+        """ return the screen as a string """
+        lync = self.lync
+        stats = self._last[1] if self._last is not None else lync.stats
+        rates = self.rates
+        snap = self._snapshot
+        lines = ["lync-top  %s  state version %d  %s" % (self._title, snap.version,
+                                                          time.strftime('%H:%M:%S')),
+                 "",
+                 "%-9s %10s %10s %12s" % ('', 'frames/s', 'bytes/s', 'frames')]
+        for direction in ('rx', 'tx'):
+            lines.append("%-9s %10.1f %10.1f %12d" % (direction,
+                                                      rates[direction + '_frames'],
+                                                      rates[direction + '_bytes'],
+                                                      stats.get(direction + '_frames', 0)))
+        frames = rates['rx_frames']
+        lines.append("%-9s checksum %5.1f%% (%d)  resyncs %.1f/s (%d)  repeats %.0f%%" % (
+            'errors',
+            100 * rates['checksum_errors'] / frames if frames else 0.0,
+            stats.get('checksum_errors', 0),
+            rates['resyncs'], stats.get('resyncs', 0),
+            100 * lync.dedup_hit_rate()))
+        rtt = lync.rtt()
+        if rtt['count']:
+            lines.append("%-9s %d  p50 %.1f  p90 %.1f  p99 %.1f  max %.1f ms" % (
+                'rtt', rtt['count'], rtt['p50'] * 1000, rtt['p90'] * 1000,
+                rtt['p99'] * 1000, rtt['max'] * 1000))
+        else:
+            lines.append("%-9s -" % 'rtt')
+        flow = lync.flow_stats()
+        if flow is not None:
+            lines.append("%-9s window %.1f  in flight %d  timeout %.0f ms  cuts %d (%d delayed, %d lost)" % (
+                'flow', flow['window'], flow['in_flight'], flow['timeout'] * 1000,
+                flow['decreases'], flow['delays'], flow['timeouts']))
+        lines.append("")
+        lines.append("%-4s %-12s %-5s %-12s %6s %-4s %6s %4s %7s" % (
+            'zone', 'name', 'power', 'source', 'volume', 'mute', 'treble', 'bass', 'balance'))
+        for zn in lync.active_zones():
+            info = snap.zones[zn]
+            source = info['source_list'].get(info['source'], info['source'])
+            fields = [('power', '%-5s', info['power']),
+                      ('source', '%-12s', str(source)[:12]),
+                      ('volume', '%6s', info['volume']),
+                      ('mute', '%-4s', info['mute']),
+                      ('treble', '%6s', info['treble']),
+                      ('bass', '%4s', info['bass']),
+                      ('balance', '%7s', info['balance'])]
+            cells = [self.__cell(zn, key, fmt % (value,)) for (key, fmt, value) in fields]
+            lines.append("%-4d %-12s %s" % (zn, info['name'][:12], ' '.join(cells)))
+        lines.append("")
+        lines.append("connections (%d connects)" % stats.get('connects', 0))
+        for (when, event, detail) in list(lync.connection_log)[-5:]:
+            lines.append("  %s  %-14s %s" % (time.strftime('%H:%M:%S', time.localtime(when)),
+                                             event, detail if detail is not None else ''))
+        return '\n'.join(lines) + '\n'
+
+    def __cell(self, zone, key, text):
+        if self._color and (zone, key) in self._changed:
+            return _HIGHLIGHT + text + _RESET
+        return text
+
+class _LyncReplayClient(LyncBase):
+    """ plays a capture file as if it were a live link """
+    def __init__(self, path, speed=1.0):
+        self._path = path
+        self._speed = speed
+        self._thread = None
+        super().__init__()
+
+    def connect(self):
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+        self._connection_event('connected', self._path)
+        return True
+
+    def is_connected(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def close(self, delay=0):
+        return True
+
+    def init(self):
+        # the capture holds the state refresh
+        pass
+
+    def _transport_write(self, data):
+        raise ConnectionError("A capture replay can't be written to")
+
+    def __run(self):
+        with LyncReplay(self._path) as replay:
+            replay.replay(self, realtime=self._speed > 0, speed=self._speed, tx=self._sent)
+        self._connection_event('closed', 'end of capture')
+
+def _simulate(lync, rate):
+    """ send random commands to the simulator """
+    while True:
+        time.sleep(1 / rate)
+        zone = random.choice(lync.active_zones())
+        choice = random.random()
+        if choice < 0.5:
+            lync.set_volume(zone, random.randrange(101))
+        elif choice < 0.7:
+            lync.set_power(zone, random.choice(('on', 'off')))
+        elif choice < 0.85:
+            lync.set_mute(zone, random.choice(('on', 'off')))
+        else:
+            lync.set_source(zone, random.choice(list(lync.snapshot().sources[zone].values())))
+
+def main():
+    parser = argparse.ArgumentParser(description="Monitor an HTD Lync link")
+    link = parser.add_mutually_exclusive_group(required=True)
+    link.add_argument('--host', help="GW-SL1 gateway host name or address")
+    link.add_argument('--serial', help="serial port of the controller")
+    link.add_argument('--capture', help="capture file to play back")
+    link.add_argument('--simulator', action='store_true', help="run against a simulated controller")
+    parser.add_argument('--port', default='8000', help="gateway websocket port")
+    parser.add_argument('--baud', type=int, default=38400, help="serial baud rate")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="capture playback speed, 0 plays as fast as possible")
+    parser.add_argument('--activity', type=float, default=LYNC_TOP_ACTIVITY,
+                        help="commands per second sent to the simulator")
+    parser.add_argument('--rate', type=float, default=LYNC_TOP_RATE, help="refreshes per second")
+    parser.add_argument('--once', action='store_true', help="print one refresh and exit")
+    parser.add_argument('--no-color', action='store_true', help="don't highlight changes")
+    parser.add_argument('--log', default=os.devnull, help="log file, the screen is not logged to")
+    args = parser.parse_args()
+    logging.basicConfig(filename=args.log, level=logging.INFO)
+
+    if args.host is not None:
+        (lync, title) = (LyncRemote(args.host, args.port), args.host)
+    elif args.serial is not None:
+        (lync, title) = (LyncSerial(args.serial, args.baud), args.serial)
+    elif args.capture is not None:
+        (lync, title) = (_LyncReplayClient(args.capture, args.speed), args.capture)
+    else:
+        (lync, title) = (LyncSimulatorClient(latency=0.01), 'simulator')
+    if not lync.connect():
+        print("Can't connect to %s" % title, file=sys.stderr)
+        return 1
+    lync.init()
+    if args.simulator and args.activity > 0:
+        threading.Thread(target=_simulate, args=(lync, args.activity), daemon=True).start()
+
+    monitor = LyncMonitor(lync, title, color=not args.no_color and sys.stdout.isatty())
+    monitor.sample()
+    interval = 1 / args.rate
+    deadline = time.monotonic()
+    try:
+        while True:
+            # fixed rate, a slow refresh doesn't shift the next one
+            deadline += interval
+            time.sleep(max(0, deadline - time.monotonic()))
+            monitor.sample()
+            screen = monitor.render()
+            if args.once:
+                sys.stdout.write(screen)
+                break
+            sys.stdout.write(_CLEAR + screen)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    lync.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+In memory wire trace for the HTD Lync serial protocol.
+
+LyncTrace keeps the last frames sent and received in a fixed size ring buffer.
+All storage is allocated up front and recording only copies the frame bytes
+into it, so tracing can stay enabled in production and be dumped when an error
+is seen instead of formatting every frame for the debug log.
+"""
+
+import array
+import binascii
+import logging
+import time
+
+from .capture import LYNC_CAPTURE_TX
+
+__all__ = ['LyncTrace', 'LYNC_TRACE_SIZE', 'LYNC_TRACE_FRAME']
+
+# Default number of frames kept
+LYNC_TRACE_SIZE = 256
+# Bytes kept per frame, enough for the longest mp3 frames
+LYNC_TRACE_FRAME = 72
+
+_LOGGER = logging.getLogger(__name__)
+
+class LyncTrace:
+    """ fixed size ring buffer of (timestamp, direction, zone, command id, raw bytes) """
+    def __init__(self, size=LYNC_TRACE_SIZE, frame_size=LYNC_TRACE_FRAME):
+        self._size = size
+        self._frame_size = frame_size
+        self._ts = array.array('d', bytes(8 * size))
+        self._dir = bytearray(size)
+        self._zone = bytearray(size)
+        self._cmd = bytearray(size)
+        self._len = array.array('H', bytes(2 * size))
+        self._data = bytearray(size * frame_size)
+        self._next = 0
+        self._count = 0
+
+    def record(self, direction, buf, start, end):
+        """ Copy the frame buf[start:end] into the ring
+            :param direction: LYNC_CAPTURE_RX or LYNC_CAPTURE_TX
+        """
+        i = self._next
+        n = min(end - start, self._frame_size)
+        offset = i * self._frame_size
+        # copy through a view, slicing buf would make a bytes object for every frame,
+        # released at once since the receive buffer is resized after decoding
+        with memoryview(buf) as view:
+            self._data[offset:offset + n] = view[start:start + n]
+        self._ts[i] = time.monotonic()
+        self._dir[i] = direction
+        self._zone[i] = buf[start + 2] if n > 2 else 0
+        self._cmd[i] = buf[start + 3] if n > 3 else 0
+        self._len[i] = n
+        self._next = (i + 1) % self._size
+        if self._count < self._size:
+            self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def records(self):
+        """ return the traced frames oldest first as (ts, direction, zone, cmd, data) """
+        result = []
+        first = (self._next - self._count) % self._size
+        for j in range(self._count):
+            i = (first + j) % self._size
+            offset = i * self._frame_size
+            result.append((self._ts[i], self._dir[i], self._zone[i], self._cmd[i],
+                           bytes(self._data[offset:offset + self._len[i]])))
+        return result
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+
+    def dump(self, logger=_LOGGER, level=logging.DEBUG):
+        """ Log the traced frames, formatting them only when the level is enabled """
+        if not logger.isEnabledFor(level):
+            return
+        for (ts, direction, zone, cmd, data) in self.records():
+            logger.log(level, "%.6f %s zone %d cmd 0x%02x %s", ts,
+                       'TX' if direction == LYNC_CAPTURE_TX else 'RX',
+                       zone, cmd, binascii.hexlify(data).decode())
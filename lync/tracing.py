@@ -0,0 +1,161 @@
+"""
+Latency tracing spans for the Lync clients and bridges.
+
+A trace id follows one directive through the stages it passes, each stage is
+recorded as a span with its start and duration.  The bridge opens a trace
+with LyncTracer.trace() and times its own stages with span(); a LyncBase with
+a tracer attribute adds the stages inside the client:
+
+    encode      building the command frame
+    queue       waiting for the writer thread
+    write       the transport write
+    confirm     from the write until the controller sent the zone status
+
+Spans are appended to a JSON-lines file, one object per span, and the last
+samples of every stage are kept for summary().  A file is summarized with:
+
+    lync-trace spans.jsonl
+"""
+
+import argparse
+import collections
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+# Durations kept per stage for the percentiles
+LYNC_TRACING_SAMPLES = 1024
+# Percentiles reported by summary
+LYNC_TRACING_PERCENTILES = (50, 90, 99)
+
+_LOGGER = logging.getLogger(__name__)
+
+_current_trace = contextvars.ContextVar('lync_trace', default=None)
+
+def current_trace():
+    """ return the trace id of the current context or None """
+    return _current_trace.get()
+
+def percentiles(values, points=LYNC_TRACING_PERCENTILES):
+    """ return a dict of count, max and the nearest rank percentiles of values """
+    values = sorted(values)
+    result = { 'count' : len(values) }
+    if not values:
+        return result
+    for point in points:
+        rank = max(1, -(-point * len(values) // 100))
+        result['p%d' % point] = values[rank - 1]
+    result['max'] = values[-1]
+    return result
+
+class LyncTracer:
+    """ records spans of traces to a JSON-lines file and keeps per stage samples
+        :param path: file the spans are appended to, or None to only keep samples
+    """
+    def __init__(self, path=None, samples=LYNC_TRACING_SAMPLES):
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', buffering=1) if path is not None else None
+        self._samples = samples
+        self._stages = collections.OrderedDict()
+        # converts monotonic times to wall clock times for the export
+        self._epoch = time.time() - time.monotonic()
+
+    def new_id(self):
+        return os.urandom(8).hex()
+
+    @contextlib.contextmanager
+    def trace(self, trace_id=None):
+        """ Make a trace id current for the block, a new one by default
+            The id is seen by the Lync calls made in the block.
+        """
+        trace_id = trace_id if trace_id is not None else self.new_id()
+        token = _current_trace.set(trace_id)
+        try:
+            yield trace_id
+        finally:
+            _current_trace.reset(token)
+
+    @contextlib.contextmanager
+    def span(self, stage, trace_id=None, **attrs):
+        """ Time the block as a stage of the current trace, or of trace_id """
+        trace_id = trace_id if trace_id is not None else current_trace()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            if trace_id is not None:
+                self.record(trace_id, stage, start, time.monotonic(), **attrs)
+
+    def record(self, trace_id, stage, start, end, **attrs):
+        """ Record a span measured elsewhere
+            :param start: time.monotonic() the stage started
+            :param end: time.monotonic() the stage ended
+            :param attrs: extra values exported with the span
+        """
+        duration = end - start
+        span = { 'trace' : trace_id,
+                 'stage' : stage,
+                 'start' : round(start + self._epoch, 6),
+                 'duration' : round(duration, 6) }
+        span.update(attrs)
+        with self._lock:
+            samples = self._stages.get(stage)
+            if samples is None:
+                samples = self._stages[stage] = collections.deque(maxlen=self._samples)
+            samples.append(duration)
+            if self._file is not None:
+                self._file.write(json.dumps(span) + '\n')
+
+    def summary(self):
+        """ return a dict of stage to the percentiles of its recent durations in seconds """
+        with self._lock:
+            stages = [(stage, list(samples)) for (stage, samples) in self._stages.items()]
+        return collections.OrderedDict((stage, percentiles(samples)) for (stage, samples) in stages)
+
+    def log_summary(self, logger=_LOGGER, level=logging.INFO):
+        for (stage, stats) in self.summary().items():
+            logger.log(level, "%s", format_stage(stage, stats))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def summarize(path):
+    """ return the per stage percentiles of the spans in a JSON-lines file """
+    stages = collections.OrderedDict()
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                span = json.loads(line)
+            except ValueError:
+                _LOGGER.warning("Skipping invalid span %s", line.strip())
+                continue
+            stages.setdefault(span['stage'], []).append(span['duration'])
+    return collections.OrderedDict((stage, percentiles(values)) for (stage, values) in stages.items())
+
+def format_stage(stage, stats):
+    """ format the percentiles of a stage in milliseconds """
+    if not stats['count']:
+        return "%-10s %6d" % (stage, 0)
+    points = ' '.join("%s %8.1f" % (key, stats[key] * 1000)
+                      for key in stats if key != 'count')
+    return "%-10s %6d  %s ms" % (stage, stats['count'], points)
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize Lync latency spans")
+    parser.add_argument('path', help="JSON-lines span file")
+    args = parser.parse_args()
+    for (stage, stats) in summarize(args.path).items():
+        print(format_stage(stage, stats))
+    return 0
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Long lived command worker for the Lync clients.
+
+Integrations such as the Node-RED functions submit commands to a LyncWorker and
+return at once.  One worker thread keeps the connection open, runs the commands
+in order and closes the connection only after it has been idle for a while.
+"""
+
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+
+__all__ = ['LyncWorker', 'LYNC_WORKER_IDLE', 'LYNC_WORKER_RETRIES', 'LYNC_WORKER_RETRY_DELAY',
+           'LYNC_WORKER_QUEUE_SIZE']
+
+# Seconds without commands before the connection is closed
+LYNC_WORKER_IDLE = 300
+# Connection attempts before a command fails
+LYNC_WORKER_RETRIES = 3
+# Seconds between connection attempts
+LYNC_WORKER_RETRY_DELAY = 3
+# Maximum number of queued commands
+LYNC_WORKER_QUEUE_SIZE = 64
+
+_LOGGER = logging.getLogger(__name__)
+
+class LyncWorker:
+    """ runs Lync commands on one long lived thread
+        idle is the number of seconds before the connection is closed, or None to keep
+        it open, as for LyncSerial.
+    """
+    def __init__(self, lync, idle=LYNC_WORKER_IDLE, retries=LYNC_WORKER_RETRIES):
+        self.lync = lync
+        # arguments passed to lync.connect, such as the gateway address
+        self.connect_args = ()
+        self._idle = idle
+        self._retries = retries
+        self._queue = queue.Queue(LYNC_WORKER_QUEUE_SIZE)
+        self.stats = { 'commands' : 0,
+                       'failures' : 0,
+                       'latency' : None }
+        self._thread = threading.Thread(target=self.__run, daemon=True, name='lync-worker')
+        self._thread.start()
+
+    def submit(self, method, *args, confirm=None, timeout=None):
+        """ Queue a command for the worker
+            :param method: name of the Lync method to call, such as 'set_power'
+            :param confirm: optional (zone, dict of expected zone info) to wait for
+            :param timeout: seconds to wait for the confirmation
+            :return a concurrent.futures.Future with the command result, True once the
+                    state is confirmed or False on timeout when confirm is given.
+                    The latency attribute holds the seconds from submit to completion.
+        """
+        future = concurrent.futures.Future()
+        future.latency = None
+        self._queue.put_nowait((future, time.monotonic(), method, args, confirm, timeout))
+        return future
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def __connect(self, zone):
+        lync = self.lync
+        tries = self._retries
+        while not lync.is_connected() and tries > 0:
+            lync.connect(*self.connect_args)
+            if lync.is_connected():
+                if zone is not None:
+                    lync.update(zone)
+            else:
+                tries -= 1
+                if tries:
+                    time.sleep(LYNC_WORKER_RETRY_DELAY)
+        return lync.is_connected()
+
+    def __run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            (future, start, method, args, confirm, timeout) = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            self.stats['commands'] += 1
+            try:
+                zone = str(args[0]).lower() if args else None
+                if not self.__connect(zone):
+                    raise ConnectionError("Can't connect to the Lync")
+                result = getattr(self.lync, method)(*args)
+                if confirm is not None:
+                    result = self.lync.wait_state(confirm[0], confirm[1], timeout)
+                future.latency = time.monotonic() - start
+                self.stats['latency'] = future.latency
+                future.set_result(result)
+            except Exception as e:
+                self.stats['failures'] += 1
+                future.latency = time.monotonic() - start
+                _LOGGER.error("Lync command %s failed: %s", method, e)
+                future.set_exception(e)
+            # keep the connection warm until the worker has been idle
+            if self._idle is not None and self._queue.empty():
+                self.lync.close(delay=self._idle)
@@ -28,6 +28,16 @@ setup(name='lync',
           'websocket-client', 
           'serial' 
           ],
+      extras_require={
+          'bulk': ['numpy'],
+          },
+      entry_points={
+          'console_scripts': [
+              'lync-proxy=lync.proxy:main',
+              'lync-trace=lync.tracing:main',
+              'lync-top=lync.top:main',
+              ],
+          },
       maintainer='Dustin McIntire',
       maintainer_email='dustin.mcintire@gmail.com',
       zip_safe=False,